@@ -0,0 +1,282 @@
+"""
+Aggregation pipeline engine for the Vercel Blob adapter
+Runs Mongo-style pipelines as a chain of generators over the documents
+"""
+import json
+import itertools
+from typing import Optional, List, Dict, Any, Iterable, Iterator, Tuple
+
+from query_engine import compile_query, apply_sort, apply_projection, get_field, MISSING
+
+
+# ---------- Expressions ----------
+
+def _arithmetic(op: str, values: List[Any]) -> Any:
+    if any(v is None or v is MISSING for v in values):
+        return None
+    if op == '$add':
+        return sum(values)
+    if op == '$multiply':
+        result = 1
+        for v in values:
+            result *= v
+        return result
+    if op == '$subtract':
+        return values[0] - values[1]
+    if op == '$divide':
+        return values[0] / values[1] if values[1] else None
+    raise ValueError(f"Unsupported aggregation operator: {op}")
+
+
+def evaluate(expression: Any, doc: Dict) -> Any:
+    """Evaluate an aggregation expression: "$field.path", literals, sub-documents
+    and $add/$subtract/$multiply/$divide/$ifNull"""
+    if isinstance(expression, str) and expression.startswith('$'):
+        return get_field(doc, expression[1:])
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            op, args = next(iter(expression.items()))
+            if op == '$ifNull':
+                value = evaluate(args[0], doc)
+                return evaluate(args[1], doc) if value is None or value is MISSING else value
+            if op == '$literal':
+                return args
+            if op.startswith('$'):
+                return _arithmetic(op, [evaluate(arg, doc) for arg in args])
+        result = {}
+        for key, value in expression.items():
+            value = evaluate(value, doc)
+            if value is not MISSING:
+                result[key] = value
+        return result
+    if isinstance(expression, list):
+        return [evaluate(item, doc) for item in expression]
+    return expression
+
+
+def _value(expression: Any, doc: Dict) -> Any:
+    value = evaluate(expression, doc)
+    return None if value is MISSING else value
+
+
+# ---------- $group accumulators ----------
+
+class _Accumulator:
+    """Running state for one accumulator of one group (nothing is buffered but $push)"""
+
+    __slots__ = ('op', 'expression', 'state', 'count')
+
+    def __init__(self, op: str, expression: Any):
+        if op not in ('$sum', '$avg', '$min', '$max', '$count', '$push', '$addToSet', '$first', '$last'):
+            raise ValueError(f"Unsupported accumulator: {op}")
+        self.op = op
+        self.expression = expression
+        self.state = [] if op in ('$push', '$addToSet') else None
+        self.count = 0
+
+    def add(self, doc: Dict):
+        op = self.op
+        if op == '$count':
+            self.count += 1
+            return
+        value = evaluate(self.expression, doc)
+        if op == '$sum' or op == '$avg':
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.state = value if self.state is None else self.state + value
+                self.count += 1
+        elif op == '$min' or op == '$max':
+            if value is None or value is MISSING:
+                return
+            try:
+                if self.state is None or (value < self.state if op == '$min' else value > self.state):
+                    self.state = value
+            except TypeError:
+                pass
+        elif op == '$push':
+            self.state.append(None if value is MISSING else value)
+        elif op == '$addToSet':
+            if value is not MISSING and value not in self.state:
+                self.state.append(value)
+        elif op == '$first':
+            if self.count == 0:
+                self.state = None if value is MISSING else value
+            self.count += 1
+        elif op == '$last':
+            self.state = None if value is MISSING else value
+
+    def result(self) -> Any:
+        if self.op == '$count':
+            return self.count
+        if self.op == '$sum':
+            return self.state if self.state is not None else 0
+        if self.op == '$avg':
+            return self.state / self.count if self.count else None
+        return self.state
+
+
+def _group_key(value: Any) -> Any:
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return json.dumps(value, sort_keys=True, default=str)
+
+
+def _group(docs: Iterable[Dict], spec: Dict) -> Iterator[Dict]:
+    key_expression = spec.get('_id')
+    fields: List[Tuple[str, str, Any]] = []
+    for name, accumulator in spec.items():
+        if name == '_id':
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise ValueError(f"Invalid accumulator for field: {name}")
+        op, expression = next(iter(accumulator.items()))
+        fields.append((name, op, expression))
+
+    groups: Dict[Any, Tuple[Any, List[_Accumulator]]] = {}
+    for doc in docs:
+        key = _value(key_expression, doc)
+        hashed = _group_key(key)
+        group = groups.get(hashed)
+        if group is None:
+            group = groups[hashed] = (key, [_Accumulator(op, expression) for _, op, expression in fields])
+        for accumulator in group[1]:
+            accumulator.add(doc)
+
+    for key, accumulators in groups.values():
+        result = {'_id': key}
+        for (name, _, _), accumulator in zip(fields, accumulators):
+            result[name] = accumulator.result()
+        yield result
+
+
+# ---------- Other stages ----------
+
+def _unwind(docs: Iterable[Dict], spec: Any) -> Iterator[Dict]:
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = spec['path'].lstrip('$')
+    keep_empty = spec.get('preserveNullAndEmptyArrays', False)
+    index_field = spec.get('includeArrayIndex')
+    head, _, rest = path.partition('.')
+
+    def replaced(doc: Dict, value: Any, index: Optional[int]) -> Dict:
+        # Shallow copies along the path only, the source documents stay untouched
+        if rest:
+            out = {**doc, head: _set_path(doc.get(head) or {}, rest, value)}
+        else:
+            out = {**doc, head: value}
+        if index_field:
+            out[index_field] = index
+        return out
+
+    for doc in docs:
+        value = get_field(doc, path)
+        if isinstance(value, list) and value:
+            for index, item in enumerate(value):
+                yield replaced(doc, item, index)
+        elif isinstance(value, list) or value is None or value is MISSING:
+            if keep_empty:
+                out = {**doc}
+                if isinstance(value, list) and not rest:
+                    # Like Mongo, an empty array is dropped rather than output as []
+                    out.pop(head, None)
+                if index_field:
+                    out[index_field] = None
+                yield out
+        else:
+            yield replaced(doc, value, None)
+
+
+def _set_path(doc: Dict, path: str, value: Any) -> Dict:
+    head, _, rest = path.partition('.')
+    if rest:
+        return {**doc, head: _set_path(doc.get(head) or {}, rest, value)}
+    return {**doc, head: value}
+
+
+def _project(docs: Iterable[Dict], spec: Dict) -> Iterator[Dict]:
+    plain = {k: v for k, v in spec.items() if v in (0, 1, True, False)}
+    computed = {k: v for k, v in spec.items() if k not in plain}
+    if not computed:
+        for doc in docs:
+            yield apply_projection(doc, plain)
+        return
+    # Computed fields make it an inclusion projection: listed fields plus the ids
+    keep = [k for k, v in plain.items() if v and k != '_id']
+    if plain.get('_id', 1):
+        keep += ['id', '_id']
+    for doc in docs:
+        out = {k: doc[k] for k in keep if k in doc}
+        for key, expression in computed.items():
+            value = evaluate(expression, doc)
+            if value is not MISSING:
+                out[key] = value
+        yield out
+
+
+def _fuse(pipeline: List[Dict]) -> List[Tuple[str, Any]]:
+    """Merge adjacent $match stages and $sort followed by $skip/$limit into a top-k sort"""
+    stages: List[Tuple[str, Any]] = []
+    for stage in pipeline:
+        if len(stage) != 1:
+            raise ValueError(f"Pipeline stage must have exactly one operator: {stage}")
+        name, spec = next(iter(stage.items()))
+        previous = stages[-1] if stages else None
+        if name == '$match' and previous and previous[0] == '$match':
+            stages[-1] = ('$match', {'$and': [previous[1], spec]})
+        elif name == '$skip' and previous and previous[0] == '$topk' and previous[1][2] is None:
+            sort, skip, _ = previous[1]
+            stages[-1] = ('$topk', (sort, skip + spec, None))
+        elif name == '$limit' and previous and previous[0] == '$topk':
+            sort, skip, limit = previous[1]
+            stages[-1] = ('$topk', (sort, skip, spec if limit is None else min(limit, spec)))
+        elif name == '$sort':
+            stages.append(('$topk', (spec, 0, None)))
+        else:
+            stages.append((name, spec))
+    return stages
+
+
+def split_match(pipeline: List[Dict]) -> Tuple[Optional[Dict], List[Dict]]:
+    """Split leading $match stages off so the caller can use them to pick segments and indexes"""
+    query = None
+    index = 0
+    while index < len(pipeline) and list(pipeline[index]) == ['$match']:
+        match = pipeline[index]['$match']
+        query = match if query is None else {'$and': [query, match]}
+        index += 1
+    return query, pipeline[index:]
+
+
+def run_pipeline(docs: Iterable[Dict], pipeline: List[Dict]) -> List[Dict]:
+    """Run an aggregation pipeline over documents in a single streaming pass.
+
+    Supports $match, $group ($sum/$avg/$min/$max/$count/$push/$addToSet/$first/$last),
+    $sort, $skip, $limit, $project, $unwind and $count. Stages are chained
+    generators, so documents are not copied per stage; only $group and
+    $sort hold state ($sort + $limit keeps just the top documents).
+    """
+    stream: Iterable[Dict] = iter(docs)
+    for name, spec in _fuse(pipeline):
+        if name == '$match':
+            matches = compile_query(spec)
+            stream = (doc for doc in stream if matches(doc))
+        elif name == '$group':
+            stream = _group(stream, spec)
+        elif name == '$topk':
+            sort, skip, limit = spec
+            stream = iter(apply_sort(stream, sort, skip, limit))
+        elif name == '$skip':
+            stream = itertools.islice(stream, spec, None)
+        elif name == '$limit':
+            stream = itertools.islice(stream, spec)
+        elif name == '$project':
+            stream = _project(stream, spec)
+        elif name == '$unwind':
+            stream = _unwind(stream, spec)
+        elif name == '$count':
+            stream = iter([{spec: sum(1 for _ in stream)}])
+        else:
+            raise ValueError(f"Unsupported pipeline stage: {name}")
+    return list(stream)
@@ -0,0 +1,152 @@
+"""
+Collection cache for the Vercel Blob adapter
+Byte-bounded LRU with per-collection TTLs and stale-while-revalidate
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Tuple
+
+
+def _parse_ttls(raw: str) -> Dict[str, float]:
+    """Parse "products=300,orders=5" into {'products': 300.0, 'orders': 5.0}"""
+    ttls = {}
+    for part in (raw or '').split(','):
+        if '=' not in part:
+            continue
+        name, value = part.split('=', 1)
+        try:
+            ttls[name.strip()] = float(value)
+        except ValueError:
+            print(f"WARNING: ignoring invalid cache TTL '{part}'")
+    return ttls
+
+
+# Catalog data changes a few times a day; carts and orders change constantly
+DEFAULT_COLLECTION_TTLS = {
+    'products': 60.0,
+    'config': 60.0,
+    'chatbot_responses': 60.0,
+    'users': 10.0,
+    'subscribers': 10.0,
+    'orders': 2.0,
+    'cart_items': 2.0,
+}
+
+BLOB_CACHE_MAX_BYTES = int(os.environ.get('BLOB_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+BLOB_CACHE_TTL = float(os.environ.get('BLOB_CACHE_TTL', '10'))
+BLOB_CACHE_STALE_TTL = float(os.environ.get('BLOB_CACHE_STALE_TTL', '60'))
+BLOB_CACHE_TTLS = {**DEFAULT_COLLECTION_TTLS, **_parse_ttls(os.environ.get('BLOB_CACHE_TTLS', ''))}
+
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+
+
+class CacheEntry:
+    """Cached blob payload plus the validators needed to revalidate it"""
+
+    __slots__ = ('collection', 'data', 'size', 'etag', 'uploaded_at', 'url', 'checked_at',
+                 'deltas', 'compacted')
+
+    def __init__(self, collection: str, data: Any, size: int, etag: Optional[str] = None,
+                 uploaded_at: Optional[str] = None, url: Optional[str] = None):
+        self.collection = collection
+        self.data = data
+        self.size = size
+        self.etag = etag
+        self.uploaded_at = uploaded_at
+        self.url = url
+        self.checked_at = time.monotonic()
+        # Append-only blobs: applied delta name -> (url, size), and names folded into the snapshot
+        self.deltas: Optional[Dict[str, Any]] = None
+        self.compacted: set = set()
+
+    def touch(self):
+        """Mark the entry as just revalidated"""
+        self.checked_at = time.monotonic()
+
+
+class BlobCache:
+    """LRU cache of blob payloads bounded by their serialized size in bytes"""
+
+    def __init__(self, max_bytes: int = BLOB_CACHE_MAX_BYTES, default_ttl: float = BLOB_CACHE_TTL,
+                 stale_ttl: float = BLOB_CACHE_STALE_TTL, ttls: Dict[str, float] = None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.ttls = BLOB_CACHE_TTLS if ttls is None else ttls
+        self.total_bytes = 0
+        self._entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        # The last entry larger than the whole budget, kept outside of it (see put)
+        self._oversized: Optional[Tuple[str, CacheEntry]] = None
+        self._warned: set = set()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries or (self._oversized is not None and self._oversized[0] == key)
+
+    def __len__(self) -> int:
+        return len(self._entries) + (self._oversized is not None)
+
+    def ttl_for(self, collection: str) -> float:
+        return self.ttls.get(collection, self.default_ttl)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        """Return the entry for key and mark it most recently used"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif self._oversized is not None and self._oversized[0] == key:
+            entry = self._oversized[1]
+        return entry
+
+    def freshness(self, entry: CacheEntry) -> str:
+        """Classify an entry as fresh, stale (serve and revalidate) or expired"""
+        age = time.monotonic() - entry.checked_at
+        ttl = self.ttl_for(entry.collection)
+        if age < ttl:
+            return FRESH
+        if age < ttl + self.stale_ttl:
+            return STALE
+        return EXPIRED
+
+    def put(self, key: str, entry: CacheEntry) -> bool:
+        """Store an entry, evicting least recently used ones to stay within budget.
+
+        A payload larger than the whole budget is kept alone outside of it,
+        replacing the previous such entry, and put returns False. Dropping it
+        would turn every read of that blob into a full download and make a
+        write's post-image a possibly stale CDN read.
+        """
+        self.invalidate(key)
+        if entry.size > self.max_bytes:
+            if key not in self._warned:
+                self._warned.add(key)
+                print(f"WARNING: {key} ({entry.size} bytes) exceeds BLOB_CACHE_MAX_BYTES ({self.max_bytes}); "
+                      f"raise the limit or shard the collection")
+            self._oversized = (key, entry)
+            return False
+        self._entries[key] = entry
+        self.total_bytes += entry.size
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+        return True
+
+    def entries(self) -> List[CacheEntry]:
+        entries = list(self._entries.values())
+        if self._oversized is not None:
+            entries.append(self._oversized[1])
+        return entries
+
+    def invalidate(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+        if self._oversized is not None and self._oversized[0] == key:
+            self._oversized = None
+
+    def clear(self):
+        self._entries.clear()
+        self._oversized = None
+        self.total_bytes = 0
@@ -0,0 +1,306 @@
+"""
+Serialization for the Vercel Blob adapter
+Encodes documents incrementally as JSON (with orjson when installed) or as
+binary msgpack records, optionally compressed; decoding sniffs the magic
+bytes, so every format stays readable
+"""
+import os
+import json
+import zlib
+import struct
+import itertools
+from typing import Optional, List, Dict, Any, Iterable, Iterator, AsyncIterator
+
+# Faster JSON encoding/decoding when the optional "orjson" package is installed
+try:
+    import orjson
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+except ImportError:
+    orjson = None
+
+# zstd needs the optional "zstandard" package; gzip is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The binary record format needs the optional "msgpack" package
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+RECORDS_AVAILABLE = msgpack is not None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+RECORDS_MAGIC = b'DSR\x01'
+RECORDS_TRAILER = b'DSRF'
+
+
+def _compression_method(name: str) -> Optional[str]:
+    name = (name or '').strip().lower()
+    if name == 'zstd' and zstandard is None:
+        print("WARNING: BLOB_COMPRESSION=zstd needs the zstandard package, using gzip")
+        return 'gzip'
+    return name if name in ('gzip', 'zstd') else None
+
+
+# Compression for uploaded collection blobs: none (default), gzip or zstd
+BLOB_COMPRESSION = _compression_method(os.environ.get('BLOB_COMPRESSION', 'none'))
+BLOB_COMPRESSION_LEVEL = os.environ.get('BLOB_COMPRESSION_LEVEL')
+# Documents encoded per chunk of a streamed upload
+BLOB_ENCODE_BATCH = int(os.environ.get('BLOB_ENCODE_BATCH', '500'))
+
+
+def dumps(value: Any) -> bytes:
+    """Encode a value as compact UTF-8 JSON; values JSON has no type for are stringified"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=str, option=_ORJSON_OPTIONS)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which the json module handles
+            pass
+    return json.dumps(value, ensure_ascii=False, default=str, separators=(',', ':')).encode('utf-8')
+
+
+def decompress(content: bytes) -> bytes:
+    """Undo the upload compression, if any (detected from the magic bytes)"""
+    if content[:2] == GZIP_MAGIC:
+        return zlib.decompress(content, wbits=31)
+    if content[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise Exception("Blob is zstd-compressed but the zstandard package is not installed")
+        # Streamed frames do not record their size, so use a decompression object
+        return zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    return content
+
+
+def loads(content: bytes) -> Any:
+    """Decode blob content in any of the supported formats"""
+    content = decompress(content)
+    if is_records(content):
+        reader = RecordReader(content)
+        docs = list(reader)
+        return {**reader.meta, "docs": docs} if reader.meta else docs
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+
+def _array_chunks(docs: Iterable[Any]) -> Iterator[bytes]:
+    yield b'['
+    docs = iter(docs)
+    separator = b''
+    while True:
+        batch = list(itertools.islice(docs, BLOB_ENCODE_BATCH))
+        if not batch:
+            break
+        yield separator + dumps(batch)[1:-1]
+        separator = b','
+    yield b']'
+
+
+def json_chunks(payload: Any) -> Iterator[bytes]:
+    """Encode a payload piece by piece: document arrays (bare or under "docs") batch by batch"""
+    if isinstance(payload, dict) and isinstance(payload.get('docs'), list):
+        rest = dumps({k: v for k, v in payload.items() if k != 'docs'})
+        yield rest[:-1] + (b',' if len(rest) > 2 else b'') + b'"docs":'
+        yield from _array_chunks(payload['docs'])
+        yield b'}'
+    elif isinstance(payload, list):
+        yield from _array_chunks(payload)
+    else:
+        yield dumps(payload)
+
+
+# ---------- Binary record format ----------
+#
+# RECORDS_MAGIC, then per document a 4-byte big-endian length and its msgpack
+# encoding, then a msgpack footer {"ids", "offsets", "columns", "meta"}, its
+# 8-byte offset and RECORDS_TRAILER. The footer lets a reader find documents
+# by id and build hash indexes ("columns" holds the indexed field values)
+# without decoding any document; a full scan reads the records in order.
+# Re-encoding a blob copies the records that were never decoded (RawRecord)
+# instead of decoding and packing them again.
+
+_JSON_EXT = 1
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, int):
+        raise OverflowError(value)
+    return str(value)
+
+
+def _pack(value: Any, packer=None) -> bytes:
+    packer = packer or msgpack.Packer(default=_default, use_bin_type=True)
+    try:
+        return packer.pack(value)
+    except OverflowError:
+        # Integers msgpack has no type for: keep the document as embedded JSON
+        packer.reset()
+        return packer.pack(msgpack.ExtType(_JSON_EXT, dumps(value)))
+
+
+def _ext_hook(code: int, data: bytes) -> Any:
+    if code == _JSON_EXT:
+        # The json module keeps big integers exact
+        return json.loads(data)
+    return msgpack.ExtType(code, data)
+
+
+def _unpack(data: Any) -> Any:
+    return msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_ext_hook)
+
+
+def is_records(content: bytes) -> bool:
+    return content[:len(RECORDS_MAGIC)] == RECORDS_MAGIC
+
+
+class RawRecord:
+    """An encoded record copied as is into a new blob, with its id and indexed field values"""
+
+    __slots__ = ('data', 'id', 'fields')
+
+    def __init__(self, data: bytes, id: Any, fields: Dict[str, Any]):
+        self.data = data
+        self.id = id
+        self.fields = fields
+
+
+def record_chunks(docs: Iterable[Dict], index_fields: Iterable[str] = (), meta: Dict = None) -> Iterator[bytes]:
+    """Encode documents as binary records, batch by batch, followed by the footer"""
+    ids, offsets = [], []
+    columns = {field: [] for field in index_fields}
+    position = len(RECORDS_MAGIC)
+    packer = msgpack.Packer(default=_default, use_bin_type=True)
+    yield RECORDS_MAGIC
+    docs = iter(docs)
+    while True:
+        batch = list(itertools.islice(docs, BLOB_ENCODE_BATCH))
+        if not batch:
+            break
+        parts = []
+        for doc in batch:
+            if type(doc) is RawRecord:
+                record = doc.data
+                ids.append(doc.id)
+                fields = doc.fields
+                if not columns.keys() <= fields.keys():
+                    # A field indexed after the record was written: its value is only in the document
+                    fields = {**_unpack(record), **fields}
+            else:
+                record = _pack(doc, packer)
+                ids.append(doc.get('id', doc.get('_id')))
+                fields = doc
+            parts.append(struct.pack('>I', len(record)))
+            parts.append(record)
+            offsets.append(position)
+            position += 4 + len(record)
+            for field, column in columns.items():
+                column.append(fields.get(field))
+        yield b''.join(parts)
+    footer = _pack({"ids": ids, "offsets": offsets, "columns": columns, "meta": meta or {}})
+    yield footer + struct.pack('>Q', position) + RECORDS_TRAILER
+
+
+class RecordReader:
+    """Random access to the documents of a binary record blob, each decoded only when asked for"""
+
+    def __init__(self, content: bytes):
+        if msgpack is None:
+            raise Exception("Blob uses the binary record format but the msgpack package is not installed")
+        if not is_records(content) or content[-len(RECORDS_TRAILER):] != RECORDS_TRAILER:
+            raise Exception("Invalid or truncated binary record blob")
+        self.buffer = memoryview(content)
+        end = len(content) - len(RECORDS_TRAILER) - 8
+        footer = _unpack(self.buffer[struct.unpack_from('>Q', content, end)[0]:end])
+        self.ids: List[Any] = footer['ids']
+        self.offsets: List[int] = footer['offsets']
+        self.columns: Dict[str, List[Any]] = footer.get('columns') or {}
+        self.meta: Dict = footer.get('meta') or {}
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __iter__(self) -> Iterator[Dict]:
+        for position in range(len(self.offsets)):
+            yield self.decode(position)
+
+    def _record(self, position: int) -> memoryview:
+        start = self.offsets[position] + 4
+        length = struct.unpack_from('>I', self.buffer, start - 4)[0]
+        return self.buffer[start:start + length]
+
+    def decode(self, position: int) -> Dict:
+        """Decode the document at a record position"""
+        return _unpack(self._record(position))
+
+    def raw(self, position: int) -> RawRecord:
+        """The record at a position, undecoded, for re-encoding into another blob"""
+        fields = {field: column[position] for field, column in self.columns.items()}
+        return RawRecord(self._record(position), self.ids[position], fields)
+
+
+def _compressor(method: Optional[str]):
+    if method == 'gzip':
+        level = int(BLOB_COMPRESSION_LEVEL or 6)
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    if method == 'zstd':
+        level = int(BLOB_COMPRESSION_LEVEL or 3)
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return None
+
+
+class EncodedBody:
+    """Upload body that is encoded (and compressed) while it is being sent.
+
+    Only one batch of encoded documents is held at a time instead of the
+    whole serialized collection. The body can be iterated again (a retried
+    upload re-encodes it); after a pass, size is the number of bytes sent
+    and raw_size the uncompressed size.
+    """
+
+    def __init__(self, payload: Any, compression: Optional[str] = BLOB_COMPRESSION, binary: bool = False,
+                 index_fields: Iterable[str] = ()):
+        self.payload = payload
+        self.compression = compression
+        # Binary records apply to document arrays only (bare or under "docs")
+        self.binary = binary and msgpack is not None
+        self.index_fields = list(index_fields)
+        self.size = 0
+        self.raw_size = 0
+
+    def _chunks(self) -> Iterator[bytes]:
+        payload = self.payload
+        if self.binary and isinstance(payload, dict) and isinstance(payload.get('docs'), list):
+            meta = {k: v for k, v in payload.items() if k != 'docs'}
+            return record_chunks(payload['docs'], self.index_fields, meta)
+        if self.binary and isinstance(payload, list):
+            return record_chunks(payload, self.index_fields)
+        return json_chunks(payload)
+
+    def __iter__(self) -> Iterator[bytes]:
+        compressor = _compressor(self.compression)
+        size = raw_size = 0
+        for chunk in self._chunks():
+            raw_size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                size += len(chunk)
+                yield chunk
+        if compressor is not None:
+            chunk = compressor.flush()
+            size += len(chunk)
+            yield chunk
+        self.size = size
+        self.raw_size = raw_size
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """The body as an async stream (httpx treats plain iterables as sync bodies)"""
+        for chunk in self:
+            yield chunk
+
+    def read(self) -> bytes:
+        """The whole encoded body at once (for endpoints that cannot take a stream)"""
+        return b''.join(self)
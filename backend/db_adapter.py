@@ -4,9 +4,25 @@ Supports MongoDB (local) and Vercel Blob Storage (production)
 """
 import os
 import json
+import time
+import zlib
+import random
+import asyncio
+import secrets
+import heapq
+import itertools
+import threading
+import functools
+import contextlib
 import httpx
-from datetime import datetime, timezone
-from typing import Optional, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, Tuple, Union, Iterable, AsyncIterator
+
+from blob_cache import BlobCache, CacheEntry, FRESH, STALE
+from blob_codec import EncodedBody, RecordReader, RECORDS_AVAILABLE, dumps, loads, decompress, is_records
+from document_set import DocumentSet
+from query_engine import compile_query, apply_sort, apply_projection, normalize_sort, SortSpec
+from aggregation import run_pipeline, split_match
 
 
 def _normalize_blob_url(base_url: str) -> str:
@@ -14,6 +30,13 @@ def _normalize_blob_url(base_url: str) -> str:
     normalized = (base_url or '').strip().rstrip('/')
     return normalized or 'https://blob.vercel-storage.com'
 
+def _public_base_url(token: str) -> Optional[str]:
+    """Public URL prefix of a store, from a token like vercel_blob_rw_<storeId>_<secret>"""
+    parts = (token or '').split('_')
+    if len(parts) >= 5 and parts[:3] == ['vercel', 'blob', 'rw'] and parts[3]:
+        return f"https://{parts[3].lower()}.public.blob.vercel-storage.com"
+    return None
+
 # Only import ObjectId if pymongo is available (for MongoDB wrapper)
 try:
     from bson import ObjectId
@@ -21,10 +44,296 @@ except ImportError:
     # ObjectId is only used in MongoDBWrapper, not in VercelBlobDB
     ObjectId = None
 
+# HTTP/2 needs the optional "h2" package (httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # Check if running on Vercel
 IS_VERCEL = os.environ.get('VERCEL') or os.environ.get('VERCEL_ENV')
 BLOB_READ_WRITE_TOKEN = os.environ.get('BLOB_READ_WRITE_TOKEN', '')
 
+# Public URL prefix of the store; derived from the read-write token when not set
+BLOB_PUBLIC_URL = os.environ.get('BLOB_PUBLIC_URL', '')
+# Persist blob URLs that cannot be derived (e.g. random-suffix uploads) in a small pointer blob
+BLOB_POINTERS = os.environ.get('BLOB_POINTERS', '0') == '1'
+BLOB_POINTER_PATH = 'db/_pointers.json'
+
+# Connection pool settings for the shared Blob HTTP client
+BLOB_HTTP_MAX_CONNECTIONS = int(os.environ.get('BLOB_HTTP_MAX_CONNECTIONS', '20'))
+BLOB_HTTP_MAX_KEEPALIVE = int(os.environ.get('BLOB_HTTP_MAX_KEEPALIVE', '10'))
+BLOB_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('BLOB_HTTP_KEEPALIVE_EXPIRY', '60'))
+BLOB_HTTP_TIMEOUT = float(os.environ.get('BLOB_HTTP_TIMEOUT', '30'))
+BLOB_HTTP_CONNECT_TIMEOUT = float(os.environ.get('BLOB_HTTP_CONNECT_TIMEOUT', '5'))
+BLOB_HTTP2 = os.environ.get('BLOB_HTTP2', '1') != '0'
+
+
+def _parse_shards(raw: str) -> Dict[str, Tuple[int, str]]:
+    """Parse "orders:16,cart_items:8:session_id" into {'orders': (16, 'id'), 'cart_items': (8, 'session_id')}"""
+    shards = {}
+    for part in (raw or '').split(','):
+        name, _, rest = part.strip().partition(':')
+        count, _, key = rest.partition(':')
+        if name:
+            shards[name] = (int(count or 16), key or 'id')
+    return shards
+
+
+# Collections stored as hash-partitioned segments instead of one JSON blob (opt-in), partitioned
+# by id unless a key is given: "cart_items:16:session_id" keeps each cart in one segment.
+# Queries that do not pin the partition key read every segment, and a document's key must not change.
+BLOB_SHARDED_COLLECTIONS = _parse_shards(os.environ.get('BLOB_SHARDED_COLLECTIONS', ''))
+
+
+# Collections whose writes are appended as delta records instead of rewriting the blob (opt-in).
+# Revalidating such a blob lists its delta records, and list calls are the costly, rate-limited ones.
+BLOB_APPEND_ONLY_COLLECTIONS = {
+    name.strip() for name in os.environ.get('BLOB_APPEND_ONLY_COLLECTIONS', '').split(',') if name.strip()
+}
+# Collections stored as binary msgpack records, decoded per document on access, instead of JSON.
+# JSON blobs of these collections are rewritten in the new format after they are first read.
+# Cold lookups by id or indexed field decode only what they return, but a full scan is ~2.4x
+# slower than with JSON (msgpack decodes slower than orjson): use it for collections that
+# are mostly read by id or index, not listed whole. A rewrite copies the records it never
+# decoded byte for byte, so a write still costs a copy and an upload of the whole blob,
+# plus re-packing the documents that were read.
+BLOB_BINARY_COLLECTIONS = {
+    name.strip() for name in os.environ.get('BLOB_BINARY_COLLECTIONS', '').split(',') if name.strip()
+}
+if BLOB_BINARY_COLLECTIONS and not RECORDS_AVAILABLE:
+    print("WARNING: BLOB_BINARY_COLLECTIONS needs the msgpack package, collections stay JSON")
+# Merge the delta log into a new snapshot once it grows past either threshold
+BLOB_DELTA_COMPACT_COUNT = int(os.environ.get('BLOB_DELTA_COMPACT_COUNT', '50'))
+BLOB_DELTA_COMPACT_BYTES = int(os.environ.get('BLOB_DELTA_COMPACT_BYTES', str(256 * 1024)))
+# Writes to the same blob arriving within this window share one upload
+BLOB_GROUP_COMMIT_WINDOW = float(os.environ.get('BLOB_GROUP_COMMIT_WINDOW_MS', '5')) / 1000
+# Reload-merge-retry attempts when another instance wrote the same blob first
+BLOB_WRITE_RETRIES = int(os.environ.get('BLOB_WRITE_RETRIES', '5'))
+
+# MongoDB client settings; pymongo calls run on a bounded thread pool so they never block the event loop
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = os.environ.get("DB_NAME", "autoparts_ecommerce")
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '20'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_EXECUTOR_WORKERS = int(os.environ.get('MONGO_EXECUTOR_WORKERS', str(MONGO_MAX_POOL_SIZE)))
+
+
+# Declarative index specification, applied idempotently at startup by ensure_indexes().
+# Ascending keys are the equality filters the endpoints use; _id (descending) is the sort, as ids are time-ordered.
+INDEX_SPECS = {
+    'cart_items': [
+        {'keys': [('session_id', 1), ('product_id', 1), ('sale_type', 1)]},
+        {'keys': [('session_id', 1), ('_id', -1)]},
+    ],
+    'orders': [
+        {'keys': [('order_id', 1)], 'unique': True},
+        {'keys': [('status', 1), ('_id', -1)]},
+        {'keys': [('payment_status', 1), ('_id', -1)]},
+        {'keys': [('source', 1), ('_id', -1)]},
+    ],
+    'users': [
+        {'keys': [('email', 1)], 'unique': True},
+        {'keys': [('role', 1)]},
+    ],
+    'subscribers': [
+        {'keys': [('email', 1)], 'unique': True},
+    ],
+    'config': [
+        {'keys': [('type', 1)]},
+    ],
+    'products': [
+        {'keys': [('category', 1), ('_id', -1)]},
+    ],
+}
+
+
+def _hash_index_fields(specs: Dict[str, List[Dict]]) -> Dict[str, List[str]]:
+    """Equality fields of the index spec, for the blob adapter's hash indexes"""
+    fields: Dict[str, List[str]] = {}
+    for collection, indexes in specs.items():
+        for spec in indexes:
+            for field, direction in spec['keys']:
+                if direction == 1 and field not in fields.setdefault(collection, []):
+                    fields[collection].append(field)
+    return fields
+
+
+def _index_name(keys: List[Tuple[str, int]]) -> str:
+    """Default MongoDB index name, e.g. status_1_created_at_-1"""
+    return '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+
+# Secondary hash indexes for the hot equality filters; more can be added with create_index()
+BLOB_INDEXES = _hash_index_fields(INDEX_SPECS)
+
+
+class BlobConflictError(Exception):
+    """Raised when a conditional Blob write loses against a concurrent writer"""
+
+
+def _shard_index(value: Any, segments: int) -> int:
+    """Stable segment number for a partition key value (crc32, unlike hash(), is not salted per process)"""
+    return zlib.crc32(str(value).encode('utf-8')) % segments
+
+
+def _shard_value(doc: Dict, key: str) -> Any:
+    """Partition key value of a document"""
+    if key == 'id':
+        return doc.get('id', doc.get('_id', ''))
+    return doc.get(key, '')
+
+
+def _shard_values(query: Optional[Dict], key: str = 'id') -> Optional[List[str]]:
+    """Return the partition key values (ids by default) when a query targets them by equality or $in"""
+    if not query:
+        return None
+    for field in (('id', '_id') if key == 'id' else (key,)):
+        value = query.get(field)
+        if isinstance(value, dict) and set(value) == {'$eq'}:
+            value = value['$eq']
+        if isinstance(value, str):
+            return [value]
+        if isinstance(value, dict) and set(value) == {'$in'} and all(isinstance(v, str) for v in value['$in']):
+            return list(value['$in'])
+    return None
+
+def _update_op(doc_id: str, update: Dict) -> Dict:
+    """Field-level write op for a Mongo update document ($set/$inc/$push; a plain dict is a $set)"""
+    if not any(str(key).startswith('$') for key in update):
+        return {"op": "update", "id": doc_id, "set": update}
+    op = {"op": "update", "id": doc_id, "set": update.get('$set', {})}
+    if update.get('$inc'):
+        op["inc"] = update['$inc']
+    if update.get('$push'):
+        op["push"] = update['$push']
+    return op
+
+
+def _upsert_op(query: Dict, update: Dict, doc: Dict) -> Dict:
+    """Write op of an upsert: update the first document matching query when applied, else insert doc"""
+    op = _update_op(doc['id'], update)
+    op.update({"op": "upsert", "filter": query or {}, "doc": doc})
+    return op
+
+
+async def _read(adapter, request: Dict) -> Any:
+    """Run one multi_find request against an adapter"""
+    op = request.get('op', 'find')
+    collection = request['collection']
+    query = request.get('query') or None
+    if op == 'find':
+        return await adapter.find(collection, query, sort=request.get('sort'), skip=request.get('skip', 0),
+                                  limit=request.get('limit'), projection=request.get('projection'))
+    if op == 'find_one':
+        return await adapter.find_one(collection, query or {}, projection=request.get('projection'))
+    if op == 'count':
+        return await adapter.count_documents(collection, query)
+    if op == 'aggregate':
+        return await adapter.aggregate(collection, request['pipeline'])
+    raise ValueError(f"Unsupported read operation: {op}")
+
+
+async def _run_reads(adapter, requests: List[Dict]) -> List[Any]:
+    """Run reads concurrently, executing identical requests once; results keep request order"""
+    unique: Dict[str, Dict] = {}
+    keys = []
+    for request in requests:
+        key = json.dumps(request, sort_keys=True, default=str)
+        keys.append(key)
+        unique.setdefault(key, request)
+    results = await asyncio.gather(*(_read(adapter, request) for request in unique.values()))
+    by_key = dict(zip(unique, results))
+    return [by_key[key] for key in keys]
+
+
+def _object_id(value: Any) -> Any:
+    if ObjectId is not None and isinstance(value, str):
+        try:
+            return ObjectId(value)
+        except Exception:
+            pass
+    return value
+
+
+def _mongo_id_query(query: Dict) -> Dict:
+    """Copy of a query with string ids (plain or in $eq/$in/$lt/... conditions) converted to ObjectId where possible"""
+    query = dict(query)
+    if 'id' in query:
+        query['_id'] = query.pop('id')
+    value = query.get('_id')
+    if isinstance(value, dict):
+        query['_id'] = {
+            op: [_object_id(item) for item in operand] if isinstance(operand, list) else _object_id(operand)
+            for op, operand in value.items()
+        }
+    elif value is not None:
+        query['_id'] = _object_id(value)
+    return query
+
+
+def _mongo_upsert(query: Dict, update: Dict) -> Dict:
+    """Copy of an upsert's update that inserts with a generate_id() _id, like insert_one"""
+    if ObjectId is None or '_id' in query or not any(str(key).startswith('$') for key in update):
+        return update
+    set_on_insert = update.get('$setOnInsert', {})
+    if '_id' in set_on_insert:
+        return update
+    return {**update, '$setOnInsert': {**set_on_insert, '_id': ObjectId(generate_id())}}
+
+
+def _modifies(doc: Dict, op: Dict) -> bool:
+    """Whether an update op changes the document (for modified_count)"""
+    return bool(op.get('inc') or op.get('push') or any(doc.get(key) != value for key, value in op['set'].items()))
+
+
+_id_lock = threading.Lock()
+_id_last_ms = 0
+_id_last_random = 0
+
+
+def generate_id() -> str:
+    """New k-sortable document id (valid ObjectId): 24 hex chars of seconds, milliseconds and 48 random bits"""
+    global _id_last_ms, _id_last_random
+    with _id_lock:
+        now = time.time_ns() // 1_000_000
+        if now > _id_last_ms:
+            _id_last_ms, _id_last_random = now, random.getrandbits(47)
+        else:
+            # Same millisecond, or the clock went back: keep counting from the last id
+            _id_last_random += 1
+            if _id_last_random >> 48:
+                _id_last_ms, _id_last_random = _id_last_ms + 1, random.getrandbits(47)
+        seconds, millis = divmod(_id_last_ms, 1000)
+        return f"{seconds:08x}{millis:04x}{_id_last_random:012x}"
+
+
+def _upsert_document(query: Dict, update: Dict) -> Dict:
+    """Document inserted by an upsert: the query's equality fields plus the update"""
+    doc = {}
+    for key, value in (query or {}).items():
+        if key in ('id', '_id') or str(key).startswith('$'):
+            continue
+        if isinstance(value, dict) and any(str(k).startswith('$') for k in value):
+            if set(value) != {'$eq'}:
+                continue
+            value = value['$eq']
+        doc[key] = value
+    if not any(str(key).startswith('$') for key in update):
+        doc.update(update)
+        return doc
+    doc.update(update.get('$setOnInsert', {}))
+    doc.update(update.get('$set', {}))
+    for field, amount in update.get('$inc', {}).items():
+        doc[field] = (doc.get(field) or 0) + amount
+    for field, value in update.get('$push', {}).items():
+        items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+        doc[field] = list(doc.get(field) or []) + list(items)
+    return doc
+
 class VercelBlobDB:
     """Database adapter using Vercel Blob Storage"""
     
@@ -32,7 +341,23 @@ class VercelBlobDB:
         # Read token from environment variable
         self.token = os.environ.get('BLOB_READ_WRITE_TOKEN', '')
         self.base_url = _normalize_blob_url(os.environ.get('BLOB_API_URL', 'https://blob.vercel-storage.com'))
-        self.cache = {}  # In-memory cache for current request
+        self.public_url = _normalize_blob_url(BLOB_PUBLIC_URL) if BLOB_PUBLIC_URL else _public_base_url(self.token)
+        self.cache = BlobCache()  # Size-bounded, revalidating collection cache
+        self._blob_urls: Dict[str, str] = {}  # Resolved blob URLs, when not the derived public URL
+        self._pointers: Optional[Dict[str, str]] = None
+        self._pointers_lock = asyncio.Lock()
+        self._loading: Dict[str, asyncio.Task] = {}  # Single-flight blob loads (cold misses and revalidation)
+        self._finding: Dict[str, Tuple[int, asyncio.Task]] = {}  # Identical in-flight finds
+        self._generations: Dict[str, int] = {}  # Committed local writes per collection
+        self._compacting: Dict[str, asyncio.Task] = {}
+        self._pending: Dict[str, List[Tuple[List[Dict], asyncio.Future]]] = {}
+        self._commit_locks: Dict[str, asyncio.Lock] = {}
+        self._flushing: set = set()
+        self._manifests: Dict[str, Dict] = {}
+        self._indexes: Dict[str, List[str]] = {name: list(fields) for name, fields in BLOB_INDEXES.items()}
+        self._manifest_locks: Dict[str, asyncio.Lock] = {}
+        self._upsert_locks: Dict[str, List] = {}  # query -> [lock, users], while in use
+        self._client: Optional[httpx.AsyncClient] = None
         
         if not self.token:
             print("WARNING: BLOB_READ_WRITE_TOKEN is not set! Blob storage will not work.")
@@ -47,193 +372,852 @@ class VercelBlobDB:
             "Content-Type": "application/json"
         }
     
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the shared pooled HTTP client, creating it on first use"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=BLOB_HTTP2 and HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=BLOB_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=BLOB_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=BLOB_HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(BLOB_HTTP_TIMEOUT, connect=BLOB_HTTP_CONNECT_TIMEOUT),
+            )
+        return self._client
+    
+    async def close(self):
+        """Close the shared HTTP client (called on application shutdown)"""
+        # Let queued group commits finish before the client goes away
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+        # Compaction is safe to interrupt: the deltas stay until a snapshot replaces them
+        for task in [*self._loading.values(), *self._compacting.values()]:
+            task.cancel()
+        self._loading.clear()
+        self._compacting.clear()
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+    
     def _generate_id(self):
-        """Generate a unique ID similar to MongoDB ObjectId"""
-        import random
-        import string
-        timestamp = hex(int(datetime.now(timezone.utc).timestamp()))[2:]
-        random_part = ''.join(random.choices(string.hexdigits.lower(), k=16))
-        return f"{timestamp}{random_part}"
-    
-    async def _get_blob(self, collection: str) -> List[Dict]:
-        """Get collection data from Vercel Blob"""
-        if collection in self.cache:
-            return self.cache[collection]
+        """Generate a unique, time-ordered ID in MongoDB ObjectId format"""
+        return generate_id()
+    
+    def _documents(self, collection: str, docs: List[Dict]) -> DocumentSet:
+        """Wrap loaded documents with the collection's declared indexes"""
+        return DocumentSet(docs, self._indexes.get(collection, ()))
+    
+    async def create_index(self, collection: str, field: str):
+        """Declare a secondary equality index; cached blobs of the collection are indexed right away"""
+        fields = self._indexes.setdefault(collection, [])
+        if field not in fields:
+            fields.append(field)
+        for entry in self.cache.entries():
+            if entry.collection == collection and isinstance(entry.data, DocumentSet):
+                entry.data.add_index(field)
+    
+    async def ensure_indexes(self, specs: Dict[str, List[Dict]] = None) -> Dict[str, Dict]:
+        """Register the equality fields of the index spec as hash indexes (idempotent)"""
+        specs = INDEX_SPECS if specs is None else specs
+        for collection, fields in _hash_index_fields(specs).items():
+            for field in fields:
+                await self.create_index(collection, field)
+        return await self.index_report(specs)
+    
+    async def index_report(self, specs: Dict[str, List[Dict]] = None) -> Dict[str, Dict]:
+        """Hash-indexed fields per collection, in the same shape as the MongoDB report"""
+        specs = INDEX_SPECS if specs is None else specs
+        report = {}
+        for collection, fields in self._indexes.items():
+            declared = _hash_index_fields(specs).get(collection, [])
+            report[collection] = {
+                "indexes": list(fields),
+                "missing": [field for field in declared if field not in fields],
+                "undeclared": [field for field in fields if field not in declared],
+                "unused": [],
+            }
+        return report
+    
+    async def _get_blob(self, collection: str, filename: str = None) -> DocumentSet:
+        """Get collection (or segment) data from Vercel Blob, served from cache while fresh"""
+        filename = filename or f"db/{collection}.json"
+        entry = self.cache.get(filename)
+        if entry is not None:
+            freshness = self.cache.freshness(entry)
+            if freshness == FRESH:
+                return entry.data
+            if freshness == STALE:
+                # Serve the cached copy now and re-check it in the background
+                self._schedule_revalidation(collection, filename)
+                return entry.data
         
         try:
-            filename = f"db/{collection}.json"
-            async with httpx.AsyncClient() as client:
-                # List blobs to find our collection
-                list_response = await client.get(
-                    f"{self.base_url}",
-                    headers={
-                        "Authorization": f"Bearer {self.token}",
-                        "x-api-version": "4",
-                    },
-                    params={"prefix": filename}
-                )
-                
-                if list_response.status_code == 200:
-                    data = list_response.json()
-                    blobs = data.get('blobs', [])
-
-                    if blobs:
-                        blobs.sort(key=lambda b: b.get('uploadedAt', ''), reverse=True)
-                        # Get the blob content using the url from the list
-                        blob_url = blobs[0].get('url')
-                        if blob_url:
-                            content_response = await client.get(blob_url)
-                            if content_response.status_code == 200:
-                                try:
-                                    self.cache[collection] = content_response.json()
-                                    return self.cache[collection]
-                                except:
-                                    # If it's not JSON, try to parse as text
-                                    text = content_response.text
-                                    self.cache[collection] = json.loads(text) if text else []
-                                    return self.cache[collection]
-                
-                # Return empty list if collection doesn't exist
-                self.cache[collection] = []
-                return []
+            # Shielded: one caller giving up must not cancel the load others are waiting for
+            entry = await asyncio.shield(self._load_shared(collection, filename))
+            return entry.data
         except Exception as e:
             print(f"Error getting blob {collection}: {e}")
             import traceback
             traceback.print_exc()
-            return []
+            # Prefer an expired copy over nothing when Blob storage is unreachable
+            return entry.data if entry is not None else DocumentSet()
+    
+    async def _refresh(self, collection: str, filename: str, entry: Optional[CacheEntry],
+                       verify: bool = False) -> CacheEntry:
+        """Reload or revalidate one collection/segment blob"""
+        if collection in BLOB_APPEND_ONLY_COLLECTIONS:
+            return await self._load_log(collection, filename, entry)
+        return await self._load_blob(collection, filename, entry, verify)
+    
+    async def _list_blobs(self, prefix: str) -> List[Dict]:
+        """List blobs whose pathname starts with prefix"""
+        client = self._get_client()
+        list_response = await client.get(
+            f"{self.base_url}",
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "x-api-version": "4",
+            },
+            params={"prefix": prefix, "limit": 1000}
+        )
+        if list_response.status_code != 200:
+            raise Exception(f"Listing {prefix} failed with status {list_response.status_code}")
+        return list_response.json().get('blobs', [])
+    
+    async def _download(self, url: str) -> bytes:
+        """Download blob content, decompressed"""
+        response = await self._get_client().get(url)
+        if response.status_code != 200:
+            raise Exception(f"Downloading {url} failed with status {response.status_code}")
+        return decompress(response.content)
+    
+    # ---------- Blob URLs ----------
+    
+    def _blob_url(self, filename: str) -> Optional[str]:
+        """URL a blob can be downloaded from without listing, if known"""
+        url = self._blob_urls.get(filename)
+        if url is None and self.public_url:
+            url = f"{self.public_url}/{filename}"
+        return url
+    
+    def _remember_url(self, filename: str, url: Optional[str]):
+        """Record where a blob lives; with BLOB_POINTERS, URLs that cannot be derived are persisted"""
+        if not url or self._blob_url(filename) == url:
+            return
+        self._blob_urls[filename] = url
+        if BLOB_POINTERS and filename != BLOB_POINTER_PATH:
+            task = asyncio.get_running_loop().create_task(self._save_pointer(filename, url))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+    
+    async def _load_pointers(self):
+        """Load the pointer blob once; a missing or unreadable one just means more list calls"""
+        if self._pointers is not None:
+            return
+        async with self._pointers_lock:
+            if self._pointers is not None:
+                return
+            try:
+                pointers = (await self._load_blob('_pointers', BLOB_POINTER_PATH, None)).data
+            except Exception as e:
+                print(f"Error loading blob pointers: {e}")
+                pointers = None
+            self._pointers = dict(pointers) if isinstance(pointers, dict) else {}
+            for filename, url in self._pointers.items():
+                self._blob_urls.setdefault(filename, url)
+    
+    async def _save_pointer(self, filename: str, url: str):
+        await self._load_pointers()
+        if self._pointers.get(filename) == url:
+            return
+        self._pointers[filename] = url
+        # Last writer wins: a lost pointer only costs a list call on the next cold read
+        await self._save_blob('_pointers', dict(self._pointers), BLOB_POINTER_PATH)
+    
+    async def _load_blob(self, collection: str, filename: str, entry: Optional[CacheEntry],
+                         verify: bool = False) -> CacheEntry:
+        """Fetch or revalidate a collection blob with a conditional GET (list API as fallback) and cache it"""
+        if BLOB_POINTERS and filename != BLOB_POINTER_PATH:
+            await self._load_pointers()
+        blob_url = None if verify else self._blob_url(filename)
+        if blob_url is not None:
+            headers = {}
+            if entry is not None and entry.etag and entry.url == blob_url:
+                headers["If-None-Match"] = entry.etag
+            content_response = await self._get_client().get(blob_url, headers=headers)
+            if content_response.status_code == 304 and entry is not None:
+                entry.touch()
+                return entry
+            if content_response.status_code == 200:
+                return self._store_blob(collection, filename, content_response.content,
+                                        content_response.headers.get('etag'), None, blob_url)
+            if content_response.status_code == 404 and entry is not None and entry.url is None:
+                # Known to be absent and still absent
+                entry.touch()
+                return entry
+            if content_response.status_code != 404:
+                raise Exception(f"Downloading {filename} failed with status {content_response.status_code}")
+            self._blob_urls.pop(filename, None)
+        return await self._load_listed(collection, filename, entry)
+    
+    async def _load_listed(self, collection: str, filename: str, entry: Optional[CacheEntry]) -> CacheEntry:
+        """Fetch or revalidate a blob through the list API (uploadedAt, then a conditional GET)"""
+        blobs = [b for b in await self._list_blobs(filename) if b.get('pathname', filename) == filename]
+        if not blobs:
+            # Collection doesn't exist yet
+            entry = CacheEntry(collection, self._documents(collection, []), 2)
+            self.cache.put(filename, entry)
+            return entry
+        
+        blobs.sort(key=lambda b: b.get('uploadedAt', ''), reverse=True)
+        uploaded_at = blobs[0].get('uploadedAt')
+        blob_url = blobs[0].get('url')
+        
+        if entry is not None and uploaded_at and entry.uploaded_at == uploaded_at:
+            entry.touch()
+            return entry
+        
+        headers = {}
+        if entry is not None and entry.etag and entry.url == blob_url:
+            headers["If-None-Match"] = entry.etag
+        content_response = await self._get_client().get(blob_url, headers=headers)
+        
+        if content_response.status_code == 304 and entry is not None:
+            entry.uploaded_at = uploaded_at
+            entry.touch()
+            return entry
+        if content_response.status_code != 200:
+            raise Exception(f"Downloading {filename} failed with status {content_response.status_code}")
+        
+        self._remember_url(filename, blob_url)
+        return self._store_blob(collection, filename, content_response.content,
+                                blobs[0].get('etag') or content_response.headers.get('etag'), uploaded_at, blob_url)
+    
+    def _store_blob(self, collection: str, filename: str, content: bytes, etag: Optional[str],
+                    uploaded_at: Optional[str], url: str) -> CacheEntry:
+        """Decode downloaded blob content (JSON or binary records, maybe compressed) into a cache entry"""
+        content = decompress(content)
+        if is_records(content):
+            payload = DocumentSet.from_records(RecordReader(content), self._indexes.get(collection, ()))
+        else:
+            payload = loads(content) if content else []
+            if isinstance(payload, dict) and 'docs' in payload:
+                # Snapshot written by the append-only log (pending deltas are not replayed here)
+                payload = payload['docs']
+            if isinstance(payload, list):
+                payload = self._documents(collection, payload)
+        entry = CacheEntry(collection, payload, len(content), etag=etag, uploaded_at=uploaded_at, url=url)
+        self.cache.put(filename, entry)
+        if (payload and isinstance(payload, DocumentSet) and not is_records(content) and self._binary(collection)
+                and collection not in BLOB_APPEND_ONLY_COLLECTIONS):
+            # Append-only snapshots switch format at their next compaction instead
+            self._schedule_upgrade(collection, filename)
+        return entry
+    
+    def _binary(self, collection: str) -> bool:
+        return RECORDS_AVAILABLE and collection in BLOB_BINARY_COLLECTIONS
+    
+    def _schedule_upgrade(self, collection: str, filename: str):
+        """Rewrite a JSON blob of a binary collection as records in the background"""
+        if filename in self._pending:
+            # A write is queued and will store the new format anyway
+            return
+        print(f"Upgrading {filename} to binary records")
+        task = asyncio.get_running_loop().create_task(self._commit(collection, filename, []))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
     
-    async def _save_blob(self, collection: str, data: List[Dict]):
-        """Save collection data to Vercel Blob"""
+    def _load_shared(self, collection: str, filename: str) -> asyncio.Task:
+        """Single-flight load of a blob: concurrent misses share one in-flight fetch"""
+        task = self._loading.get(filename)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(
+                self._refresh(collection, filename, self.cache.get(filename))
+            )
+            self._loading[filename] = task
+            
+            def done(finished: asyncio.Task):
+                if self._loading.get(filename) is finished:
+                    del self._loading[filename]
+            
+            task.add_done_callback(done)
+        return task
+    
+    def _schedule_revalidation(self, collection: str, filename: str):
+        """Revalidate a stale cache entry in the background (joins any load already in flight)"""
+        def report(finished: asyncio.Task):
+            if not finished.cancelled() and finished.exception() is not None:
+                print(f"Error revalidating blob {collection}: {finished.exception()}")
+        
+        self._load_shared(collection, filename).add_done_callback(report)
+    
+    async def _put_blob(self, collection: str, filename: str, content: Union[bytes, EncodedBody],
+                        overwrite: bool = True, if_match: str = None) -> Optional[Dict]:
+        """Upload content to a fixed pathname; returns the response data or None on failure"""
         try:
             if not self.token:
                 print(f"ERROR: BLOB_READ_WRITE_TOKEN is not set!")
-                return False
-                
-            filename = f"db/{collection}.json"
-            json_data = json.dumps(data, ensure_ascii=False, default=str)
+                return None
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                
-                print(f"Attempting to save blob: {filename}")
-                print(f"Token present: {bool(self.token)}")
-                print(f"Token prefix: {self.token[:20] if self.token else 'N/A'}...")
-                print(f"Data size: {len(json_data)} bytes")
-                
-                # Preferred Vercel Blob REST upload endpoint.
-                # Force deterministic file names to avoid random-suffix versions.
-                response = await client.put(
-                    f"{self.base_url}/{filename}",
+            client = self._get_client()
+            print(f"Attempting to save blob: {filename}")
+            print(f"Token present: {bool(self.token)}")
+            print(f"Token prefix: {self.token[:20] if self.token else 'N/A'}...")
+            if isinstance(content, bytes):
+                print(f"Data size: {len(content)} bytes")
+            
+            # Preferred Vercel Blob REST upload endpoint.
+            # Force deterministic file names to avoid random-suffix versions.
+            headers = {
+                "Authorization": f"Bearer {self.token}",
+                "x-api-version": "4",
+                "x-content-type": "application/json; charset=utf-8",
+                "x-add-random-suffix": "0",
+                "x-allow-overwrite": "1" if overwrite else "0",
+            }
+            if if_match:
+                headers["x-if-match"] = if_match
+            response = await client.put(
+                f"{self.base_url}/{filename}",
+                headers=headers,
+                content=content if isinstance(content, bytes) else content.stream()
+            )
+            
+            if response.status_code in [409, 412]:
+                print(f"Write conflict saving blob {filename}: status {response.status_code}")
+                raise BlobConflictError(filename)
+
+            # Backwards compatible fallback for older endpoint format
+            if response.status_code not in [200, 201]:
+                files = {
+                    'file': (filename, content if isinstance(content, bytes) else content.read(), 'application/json')
+                }
+                form_data = {
+                    'pathname': filename,
+                    'access': 'public'
+                }
+                response = await client.post(
+                    f"{self.base_url}",
                     headers={
                         "Authorization": f"Bearer {self.token}",
                         "x-api-version": "4",
-                        "x-content-type": "application/json; charset=utf-8",
-                        "x-add-random-suffix": "0",
-                        "x-allow-overwrite": "1",
                     },
-                    content=json_data.encode('utf-8')
+                    files=files,
+                    data=form_data
                 )
-
-                # Backwards compatible fallback for older endpoint format
-                if response.status_code not in [200, 201] and response.status_code != 409:
-                    files = {
-                        'file': (filename, json_data.encode('utf-8'), 'application/json')
-                    }
-                    form_data = {
-                        'pathname': filename,
-                        'access': 'public'
-                    }
-                    response = await client.post(
-                        f"{self.base_url}",
-                        headers={
-                            "Authorization": f"Bearer {self.token}",
-                            "x-api-version": "4",
-                        },
-                        files=files,
-                        data=form_data
-                    )
-                
-                print(f"Response status: {response.status_code}")
-                print(f"Response headers: {dict(response.headers)}")
-                
-                if response.status_code in [200, 201]:
-                    try:
-                        response_data = response.json()
-                        print(f"Blob saved successfully: {response_data}")
-                        self.cache[collection] = data
-                        return True
-                    except:
-                        # If response is not JSON, still consider it success if status is 200/201
-                        self.cache[collection] = data
-                        return True
-                else:
-                    error_text = response.text if hasattr(response, 'text') else str(response.content)
-                    print(f"ERROR saving blob {collection}:")
-                    print(f"  Status: {response.status_code}")
-                    print(f"  Response: {error_text}")
-                    # Try to get more details from response
-                    try:
-                        error_json = response.json()
-                        print(f"  Error JSON: {error_json}")
-                    except:
-                        pass
-                    return False
+            
+            print(f"Response status: {response.status_code}")
+            print(f"Response headers: {dict(response.headers)}")
+            
+            if response.status_code in [200, 201]:
+                try:
+                    response_data = response.json()
+                    print(f"Blob saved successfully: {response_data}")
+                except:
+                    # If response is not JSON, still consider it success if status is 200/201
+                    response_data = {}
+                if response.headers.get('etag') and not response_data.get('etag'):
+                    response_data['etag'] = response.headers['etag']
+                return response_data
+            else:
+                error_text = response.text if hasattr(response, 'text') else str(response.content)
+                print(f"ERROR saving blob {collection}:")
+                print(f"  Status: {response.status_code}")
+                print(f"  Response: {error_text}")
+                # Try to get more details from response
+                try:
+                    error_json = response.json()
+                    print(f"  Error JSON: {error_json}")
+                except:
+                    pass
+                return None
+        except BlobConflictError:
+            raise
         except httpx.TimeoutException as e:
             print(f"Timeout error saving blob {collection}: {e}")
-            return False
+            return None
         except httpx.RequestError as e:
             print(f"Request error saving blob {collection}: {e}")
             import traceback
             traceback.print_exc()
-            return False
+            return None
         except Exception as e:
             print(f"Unexpected error saving blob {collection}: {e}")
             import traceback
             traceback.print_exc()
+            return None
+    
+    async def _save_blob(self, collection: str, data: Any, filename: str = None,
+                         if_match: str = None, create: bool = False) -> bool:
+        """Save collection (or segment) data to Vercel Blob"""
+        filename = filename or f"db/{collection}.json"
+        if isinstance(data, list):
+            data = self._documents(collection, data)
+        binary = self._binary(collection)
+        if isinstance(data, DocumentSet):
+            payload = data.records() if binary else data.docs
+        else:
+            payload = data
+        body = EncodedBody(payload, binary=binary, index_fields=self._indexes.get(collection, ()))
+        try:
+            response_data = await self._put_blob(collection, filename, body, overwrite=not create, if_match=if_match)
+        except BlobConflictError:
+            self.cache.invalidate(filename)
+            raise
+        if response_data is None:
+            # Callers mutate the cached list in place; drop it so the next
+            # read reloads what is actually stored
+            self.cache.invalidate(filename)
             return False
+        
+        self._remember_url(filename, response_data.get('url'))
+        self.cache.put(filename, CacheEntry(
+            collection,
+            data,
+            body.raw_size,
+            etag=response_data.get('etag'),
+            uploaded_at=response_data.get('uploadedAt'),
+            url=response_data.get('url'),
+        ))
+        return True
     
-    async def find(self, collection: str, query: Dict = None) -> List[Dict]:
-        """Find documents matching query"""
-        data = await self._get_blob(collection)
-        
-        if not query:
-            return data
-        
-        results = []
-        for doc in data:
-            match = True
-            for key, value in query.items():
-                if key == '$or':
-                    # Handle $or operator
-                    or_match = False
-                    for or_query in value:
-                        if all(doc.get(k) == v for k, v in or_query.items()):
-                            or_match = True
-                            break
-                    if not or_match:
-                        match = False
-                elif doc.get(key) != value:
-                    match = False
-                    break
-            if match:
-                results.append(doc)
+    # ---------- Append-only delta log ----------
+    
+    async def _load_log(self, collection: str, filename: str, entry: Optional[CacheEntry]) -> CacheEntry:
+        """Materialize an append-only blob: base snapshot plus its delta records"""
+        stem = filename[:-len('.json')]
+        delta_prefix = f"{stem}.delta/"
+        listed = await self._list_blobs(stem)
+        bases = sorted(
+            (b for b in listed if b.get('pathname') == filename),
+            key=lambda b: b.get('uploadedAt', ''), reverse=True
+        )
+        deltas = sorted(
+            (b for b in listed if b.get('pathname', '').startswith(delta_prefix)),
+            key=lambda b: b['pathname']
+        )
+        base = bases[0] if bases else None
+        base_uploaded_at = base.get('uploadedAt') if base else None
         
-        return results
+        if entry is not None and entry.deltas is not None and entry.uploaded_at == base_uploaded_at:
+            seen = entry.deltas.keys() | entry.compacted
+            new = [d for d in deltas if d['pathname'] not in seen]
+            last_applied = max((n for n in entry.deltas if n.startswith(delta_prefix)), default='')
+            if not new:
+                entry.touch()
+                return entry
+            if new[0]['pathname'] > last_applied:
+                # Only newer deltas appeared: apply them on top of the warm copy
+                contents = await asyncio.gather(*(self._download(d['url']) for d in new))
+                for d, content in zip(new, contents):
+                    if d['pathname'] in entry.deltas:
+                        # Applied by our own append while the downloads ran
+                        continue
+                    entry.data.apply(loads(content)['ops'])
+                    entry.deltas[d['pathname']] = (d['url'], len(content))
+                    entry.size += len(content)
+                entry.touch()
+                self.cache.put(filename, entry)
+                return entry
+        
+        # Full rebuild from the snapshot
+        docs, compacted, size = [], set(), 2
+        if base is not None:
+            content = await self._download(base['url'])
+            size = len(content)
+            if is_records(content):
+                reader = RecordReader(content)
+                docs = DocumentSet.from_records(reader, self._indexes.get(collection, ()))
+                compacted = set(reader.meta.get('compacted', []))
+            else:
+                payload = loads(content) if content else []
+                if isinstance(payload, dict):
+                    docs = payload.get('docs', [])
+                    compacted = set(payload.get('compacted', []))
+                else:
+                    docs = payload
+        if not isinstance(docs, DocumentSet):
+            docs = self._documents(collection, docs)
+        pending = [d for d in deltas if d['pathname'] not in compacted]
+        contents = await asyncio.gather(*(self._download(d['url']) for d in pending))
+        applied = {}
+        for d, content in zip(pending, contents):
+            docs.apply(loads(content)['ops'])
+            applied[d['pathname']] = (d['url'], len(content))
+            size += len(content)
+        
+        entry = CacheEntry(collection, docs, size, etag=base.get('etag') if base else None,
+                           uploaded_at=base_uploaded_at, url=base.get('url') if base else None)
+        entry.deltas = applied
+        entry.compacted = compacted
+        self.cache.put(filename, entry)
+        return entry
+    
+    async def _append_delta(self, collection: str, filename: str, ops: List[Dict]) -> bool:
+        """Persist a mutation as a small delta record next to the base snapshot"""
+        stem = filename[:-len('.json')]
+        name = f"{stem}.delta/{int(time.time() * 1000):013d}-{secrets.token_hex(4)}.json"
+        content = dumps({"ops": ops})
+        response_data = await self._put_blob(collection, name, content, overwrite=False)
+        
+        entry = self.cache.get(filename)
+        if response_data is None:
+            self.cache.invalidate(filename)
+            return False
+        if entry is None or entry.deltas is None:
+            # Not materialized from the log; the next read replays this delta
+            self.cache.invalidate(filename)
+            return True
+        
+        if name in entry.deltas:
+            # A concurrent revalidation already replayed this record
+            return True
+        entry.data.apply(ops)
+        entry.deltas[name] = (response_data.get('url'), len(content))
+        entry.size += len(content)
+        self.cache.put(filename, entry)
+        
+        pending_bytes = sum(size for _, size in entry.deltas.values())
+        if len(entry.deltas) >= BLOB_DELTA_COMPACT_COUNT or pending_bytes >= BLOB_DELTA_COMPACT_BYTES:
+            self._schedule_compaction(collection, filename)
+        return True
     
-    async def find_one(self, collection: str, query: Dict) -> Optional[Dict]:
+    def _schedule_compaction(self, collection: str, filename: str):
+        """Merge the delta log of a blob into a new snapshot in the background"""
+        if filename in self._compacting:
+            return
+        
+        async def compact():
+            try:
+                await self._compact(collection, filename)
+            except Exception as e:
+                print(f"Error compacting blob {filename}: {e}")
+            finally:
+                self._compacting.pop(filename, None)
+        
+        self._compacting[filename] = asyncio.get_running_loop().create_task(compact())
+    
+    async def _compact(self, collection: str, filename: str):
+        """Write base + deltas as a new snapshot, then delete the merged deltas"""
+        entry = await self._load_log(collection, filename, self.cache.get(filename))
+        merged = dict(entry.deltas)
+        compacted = sorted(merged.keys() | entry.compacted)
+        binary = self._binary(collection)
+        docs = entry.data.records() if binary else entry.data.docs
+        body = EncodedBody({"docs": docs, "compacted": compacted},
+                           binary=binary, index_fields=self._indexes.get(collection, ()))
+        try:
+            response_data = await self._put_blob(collection, filename, body, overwrite=entry.url is not None,
+                                                 if_match=entry.etag)
+        except BlobConflictError:
+            # Another instance compacted (or rewrote) this blob first; its snapshot wins
+            self.cache.invalidate(filename)
+            return
+        if response_data is None:
+            return
+        
+        entry.etag = response_data.get('etag')
+        entry.uploaded_at = response_data.get('uploadedAt')
+        entry.url = response_data.get('url')
+        entry.compacted = set(compacted)
+        for name in merged:
+            entry.deltas.pop(name, None)
+        entry.size = body.raw_size
+        self.cache.put(filename, entry)
+        
+        urls = [url for url, _ in merged.values() if url]
+        if urls and await self._delete_blobs(urls):
+            # Names of deleted deltas no longer need to be remembered
+            entry.compacted -= merged.keys()
+        print(f"Compacted {len(merged)} deltas into {filename}")
+    
+    async def _delete_blobs(self, urls: List[str]) -> bool:
+        try:
+            response = await self._get_client().post(
+                f"{self.base_url}/delete",
+                headers={
+                    "Authorization": f"Bearer {self.token}",
+                    "x-api-version": "4",
+                },
+                json={"urls": urls}
+            )
+            return response.status_code in [200, 201]
+        except httpx.HTTPError as e:
+            print(f"Error deleting blobs: {e}")
+            return False
+    
+    # ---------- Group commit ----------
+    
+    async def _commit(self, collection: str, path: str, ops: List[Dict]) -> bool:
+        """Queue changes to one blob and wait until they are durable (group commit)"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.get(path)
+        if batch is None:
+            batch = self._pending[path] = []
+            task = loop.create_task(self._flush(collection, path))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+        batch.append((ops, future))
+        success = await future
+        # Finds started before this write must not be shared with later readers
+        self._generations[collection] = self._generations.get(collection, 0) + 1
+        return success
+    
+    async def _flush(self, collection: str, path: str):
+        """Persist one batch of queued commits: a delta record in append-only mode, else a full rewrite"""
+        await asyncio.sleep(BLOB_GROUP_COMMIT_WINDOW)
+        lock = self._commit_locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            # Commits keep joining the batch until the previous upload is done
+            batch = self._pending.pop(path, [])
+            if not batch:
+                return
+            loading = self._loading.get(path)
+            if loading is not None:
+                # Let an in-flight load land first so it cannot overwrite our write in the cache
+                await asyncio.wait([loading])
+            ops = [op for batch_ops, _ in batch for op in batch_ops]
+            try:
+                if collection in BLOB_APPEND_ONLY_COLLECTIONS:
+                    success = await self._append_delta(collection, path, ops)
+                else:
+                    success = await self._rewrite(collection, path, ops)
+            except Exception as e:
+                print(f"Error committing {len(batch)} writes to {path}: {e}")
+                success = False
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(success)
+    
+    async def _rewrite(self, collection: str, path: str, ops: List[Dict]) -> bool:
+        """Rewrite a blob with ops applied, guarded by its version token"""
+        for attempt in range(BLOB_WRITE_RETRIES + 1):
+            entry = self.cache.get(path)
+            if entry is None:
+                # Never write without knowing which version we are replacing;
+                # after a conflict ask the list API, the CDN may still serve the old copy
+                entry = await self._refresh(collection, path, None, verify=attempt > 0)
+            entry.data.apply(ops)
+            try:
+                return await self._save_blob(collection, entry.data, path, **self._version_args(entry))
+            except BlobConflictError:
+                print(f"Reloading {path} after write conflict (attempt {attempt + 1})")
+                await asyncio.sleep(random.uniform(0, 0.05 * (attempt + 1)))
+        print(f"Giving up on {path} after {BLOB_WRITE_RETRIES + 1} conflicting writes")
+        return False
+    
+    def _version_args(self, entry: CacheEntry) -> Dict:
+        """Conditional-write arguments for replacing the version held in entry"""
+        if entry.url is None:
+            return {"create": True}
+        if entry.etag:
+            return {"if_match": entry.etag}
+        return {}
+    
+    # ---------- Sharded layout ----------
+    
+    def _segment_path(self, collection: str, index: int) -> str:
+        return f"db/{collection}/seg-{index:03d}.json"
+    
+    async def _get_manifest(self, collection: str) -> Optional[Dict]:
+        """Return the shard manifest of a sharded collection, or None for single-file ones"""
+        if collection not in BLOB_SHARDED_COLLECTIONS:
+            return None
+        manifest = self._manifests.get(collection)
+        if manifest is not None:
+            return manifest
+        
+        lock = self._manifest_locks.setdefault(collection, asyncio.Lock())
+        async with lock:
+            if collection in self._manifests:
+                return self._manifests[collection]
+            
+            manifest_path = f"db/{collection}/manifest.json"
+            # Read strictly: treating a failed read as "no manifest" would re-run the migration
+            manifest = (await self._load_blob(collection, manifest_path, None)).data
+            if not manifest:
+                segments, key = BLOB_SHARDED_COLLECTIONS[collection]
+                manifest = {"layout": "hash", "key": key, "segments": segments}
+                # Also strict, and confirmed by the list API: a legacy blob that failed
+                # to load must not pass for an empty collection under a new manifest
+                legacy = (await self._refresh(collection, f"db/{collection}.json", None, verify=True)).data
+                try:
+                    if legacy:
+                        await self._migrate_to_segments(collection, legacy, segments, key)
+                    # Create-only: if another instance got here first, use its manifest
+                    if not await self._save_blob(collection, manifest, manifest_path, create=True):
+                        raise Exception(f"Failed to save shard manifest for collection: {collection}")
+                except BlobConflictError:
+                    manifest = (await self._load_blob(collection, manifest_path, None, verify=True)).data
+                    if not manifest:
+                        raise Exception(f"Shard manifest for {collection} is missing after a conflict")
+            
+            self._manifests[collection] = manifest
+            return manifest
+    
+    async def _migrate_to_segments(self, collection: str, legacy: List[Dict], segments: int, key: str):
+        """Split a legacy single-file collection into its segments"""
+        print(f"Migrating {len(legacy)} documents of {collection} to {segments} segments")
+        buckets = [[] for _ in range(segments)]
+        for doc in legacy:
+            buckets[_shard_index(_shard_value(doc, key), segments)].append(doc)
+        
+        async def save(index: int, bucket: List[Dict]) -> bool:
+            path = self._segment_path(collection, index)
+            try:
+                return await self._save_blob(collection, bucket, path, create=True)
+            except BlobConflictError:
+                if (await self._load_blob(collection, f"db/{collection}/manifest.json", None, verify=True)).data:
+                    raise
+                # Segment left over from an interrupted migration of this same data
+                return await self._save_blob(collection, bucket, path)
+        
+        saved = await asyncio.gather(*(save(i, bucket) for i, bucket in enumerate(buckets) if bucket))
+        if not all(saved):
+            raise Exception(f"Failed to migrate collection {collection} to segments")
+        # The legacy blob is left in place as a backup; drop it from memory
+        self.cache.invalidate(f"db/{collection}.json")
+    
+    async def _paths_for(self, collection: str, query: Dict = None) -> List[str]:
+        """Blob paths that can hold documents matching the query"""
+        manifest = await self._get_manifest(collection)
+        if manifest is None:
+            return [f"db/{collection}.json"]
+        segments = manifest["segments"]
+        values = _shard_values(query, manifest.get("key", "id"))
+        if values is not None:
+            indexes = sorted({_shard_index(value, segments) for value in values})
+            return [self._segment_path(collection, i) for i in indexes]
+        return [self._segment_path(collection, i) for i in range(segments)]
+    
+    async def _path_for_doc(self, collection: str, doc: Dict) -> str:
+        """Blob path a document is stored in (by its partition key)"""
+        manifest = await self._get_manifest(collection)
+        if manifest is None:
+            return f"db/{collection}.json"
+        value = _shard_value(doc, manifest.get("key", "id"))
+        return self._segment_path(collection, _shard_index(value, manifest["segments"]))
+    
+    async def _read_paths(self, collection: str, paths: List[str]) -> List[DocumentSet]:
+        """Load several segments concurrently"""
+        if len(paths) == 1:
+            return [await self._get_blob(collection, paths[0])]
+        return list(await asyncio.gather(*(self._get_blob(collection, path) for path in paths)))
+    
+    async def _write_paths(self, collection: str, ops: Dict[str, List[Dict]], action: str):
+        """Commit ops to the segments they touch, concurrently"""
+        saved = await asyncio.gather(*(
+            self._commit(collection, path, path_ops) for path, path_ops in ops.items()
+        ))
+        if not all(saved):
+            raise Exception(f"Failed to {action} blob storage for collection: {collection}")
+    
+    # ---------- Public interface ----------
+    
+    async def find(self, collection: str, query: Dict = None, sort: SortSpec = None, skip: int = 0,
+                   limit: Optional[int] = None, projection: Dict = None, batch_size: Optional[int] = None) -> List[Dict]:
+        """Find documents matching query (index-assisted for equality/$in on indexed fields)"""
+        key = json.dumps([collection, query, sort, skip, limit, projection], sort_keys=True, default=str)
+        generation = self._generations.get(collection, 0)
+        shared = self._finding.get(key)
+        if shared is None or shared[0] != generation:
+            task = asyncio.get_running_loop().create_task(
+                self._find(collection, query, sort, skip, limit, projection)
+            )
+            shared = self._finding[key] = (generation, task)
+            
+            def done(finished: asyncio.Task, key=key):
+                if self._finding.get(key, (None, None))[1] is finished:
+                    del self._finding[key]
+            
+            task.add_done_callback(done)
+        # Each caller gets its own list; the documents are shared as with any cached read
+        return list(await asyncio.shield(shared[1]))
+    
+    def _id_ordered(self, segments: List[DocumentSet], query: Dict, sort: SortSpec) -> Optional[Iterable[Dict]]:
+        """Candidates in the requested id order without sorting, or None"""
+        sort = normalize_sort(sort)
+        if len(sort) != 1 or sort[0][0] not in ('id', '_id') or not all(data.id_ordered for data in segments):
+            return None
+        descending = sort[0][1] == -1
+        streams = [data.candidates(query) for data in segments]
+        if descending:
+            streams = [reversed(stream) for stream in streams]
+        if len(streams) == 1:
+            return streams[0]
+        return heapq.merge(*streams, key=lambda doc: doc.get('id', doc.get('_id')), reverse=descending)
+    
+    async def _find(self, collection: str, query: Dict = None, sort: SortSpec = None, skip: int = 0,
+                    limit: Optional[int] = None, projection: Dict = None) -> List[Dict]:
+        segments = await self._read_paths(collection, await self._paths_for(collection, query))
+        matches = compile_query(query)
+        ordered = self._id_ordered(segments, query, sort) if sort else None
+        if ordered is not None:
+            docs = (doc for doc in ordered if matches(doc))
+            if skip or limit:
+                docs = itertools.islice(docs, skip or 0, (skip or 0) + limit if limit else None)
+        else:
+            docs = (doc for data in segments for doc in data.candidates(query) if matches(doc))
+            if sort or skip or limit:
+                docs = apply_sort(docs, sort, skip, limit)
+        if projection:
+            return [apply_projection(doc, projection) for doc in docs]
+        return list(docs)
+    
+    async def iter_find(self, collection: str, query: Dict = None, sort: SortSpec = None, skip: int = 0,
+                        limit: Optional[int] = None, projection: Dict = None,
+                        batch_size: int = 100) -> AsyncIterator[Dict]:
+        """Stream matching documents segment by segment"""
+        ordered = None
+        if sort:
+            segments = await self._read_paths(collection, await self._paths_for(collection, query))
+            ordered = self._id_ordered(segments, query, sort)
+            if ordered is None:
+                for doc in await self.find(collection, query, sort, skip, limit, projection):
+                    yield doc
+                return
+        
+        async def candidates():
+            if ordered is not None:
+                for doc in ordered:
+                    yield doc
+                return
+            for path in await self._paths_for(collection, query):
+                for doc in (await self._get_blob(collection, path)).candidates(query):
+                    yield doc
+        
+        matches = compile_query(query)
+        skipped = produced = 0
+        async for doc in candidates():
+            if not matches(doc):
+                continue
+            if skipped < (skip or 0):
+                skipped += 1
+                continue
+            yield apply_projection(doc, projection)
+            produced += 1
+            if limit and produced >= limit:
+                return
+    
+    async def find_one(self, collection: str, query: Dict, projection: Dict = None) -> Optional[Dict]:
         """Find single document matching query"""
-        results = await self.find(collection, query)
-        return results[0] if results else None
+        matches = compile_query(query)
+        for data in await self._read_paths(collection, await self._paths_for(collection, query)):
+            for doc in data.candidates(query):
+                if matches(doc):
+                    return apply_projection(doc, projection)
+        return None
     
     async def insert_one(self, collection: str, document: Dict) -> Dict:
         """Insert a single document"""
-        data = await self._get_blob(collection)
-        
         doc_id = self._generate_id()
         document['_id'] = doc_id
         document['id'] = doc_id
         
-        data.append(document)
-        success = await self._save_blob(collection, data)
+        path = await self._path_for_doc(collection, document)
+        success = await self._commit(collection, path, [{"op": "put", "id": doc_id, "doc": document}])
         
         if not success:
             raise Exception(f"Failed to save document to blob storage for collection: {collection}")
@@ -242,210 +1226,524 @@ class VercelBlobDB:
     
     async def insert_many(self, collection: str, documents: List[Dict]) -> Dict:
         """Insert multiple documents"""
-        data = await self._get_blob(collection)
-        
         inserted_ids = []
+        ops: Dict[str, List[Dict]] = {}
         for doc in documents:
             doc_id = self._generate_id()
             doc['_id'] = doc_id
             doc['id'] = doc_id
             inserted_ids.append(doc_id)
-            data.append(doc)
+            path = await self._path_for_doc(collection, doc)
+            ops.setdefault(path, []).append({"op": "put", "id": doc_id, "doc": doc})
         
-        success = await self._save_blob(collection, data)
-        if not success:
-            raise Exception(f"Failed to save documents to blob storage for collection: {collection}")
-
+        await self._write_paths(collection, ops, "save documents to")
         return {'inserted_ids': inserted_ids}
     
     async def update_one(self, collection: str, query: Dict, update: Dict, upsert: bool = False) -> Dict:
         """Update a single document"""
-        data = await self._get_blob(collection)
-        
-        matched_count = 0
-        modified_count = 0
-        
-        for i, doc in enumerate(data):
-            match = all(doc.get(k) == v for k, v in query.items())
-            if match:
-                matched_count = 1
-                if '$set' in update:
-                    for key, value in update['$set'].items():
-                        if doc.get(key) != value:
-                            modified_count = 1
-                        data[i][key] = value
-                else:
-                    for key, value in update.items():
-                        if doc.get(key) != value:
-                            modified_count = 1
-                        data[i][key] = value
-                break
-        
-        if matched_count == 0 and upsert:
-            new_doc = {**query, **(update.get('$set', update))}
-            await self.insert_one(collection, new_doc)
-            return {'matched_count': 0, 'modified_count': 0, 'upserted_id': new_doc.get('id')}
-        
-        success = await self._save_blob(collection, data)
+        written = await self._update_first(collection, query, update, upsert)
+        if written is None:
+            return {'matched_count': 0, 'modified_count': 0}
+        _, doc_id, modified_count = written
+        if modified_count is None:
+            return {'matched_count': 0, 'modified_count': 0, 'upserted_id': doc_id}
+        return {'matched_count': 1, 'modified_count': modified_count}
+    
+    async def find_one_and_update(self, collection: str, query: Dict, update: Dict, upsert: bool = False,
+                                  projection: Dict = None) -> Optional[Dict]:
+        """Update a single document and return it as it is after the update"""
+        written = await self._update_first(collection, query, update, upsert)
+        if written is None:
+            return None
+        path, doc_id, _ = written
+        # The committed op has been applied to the cached copy
+        updated = (await self._committed(collection, path)).get(doc_id)
+        return apply_projection(dict(updated), projection) if updated is not None else None
+    
+    async def _update_first(self, collection: str, query: Dict, update: Dict,
+                            upsert: bool) -> Optional[Tuple[str, str, Optional[int]]]:
+        """Update the first document matching query (or upsert); returns (path, id, modified count), or None"""
+        if not upsert:
+            return await self._match_and_update(collection, query, update)
+        new_doc = _upsert_document(query, update)
+        new_doc['_id'] = new_doc['id'] = self._generate_id()
+        path = await self._path_for_doc(collection, new_doc)
+        if await self._paths_for(collection, query) == [path]:
+            return await self._match_and_update(collection, query, update, (path, new_doc))
+        async with self._upsert_lock(collection, query):
+            return await self._match_and_update(collection, query, update, (path, new_doc))
+    
+    async def _match_and_update(self, collection: str, query: Dict, update: Dict,
+                                insert: Optional[Tuple[str, Dict]] = None) -> Optional[Tuple[str, str, Optional[int]]]:
+        """Commit an update of the first document matching query, else the upsert op for insert=(path, doc)"""
+        paths = await self._paths_for(collection, query)
+        matches = compile_query(query)
+        for path, data in zip(paths, await self._read_paths(collection, paths)):
+            for doc in data.candidates(query):
+                if not matches(doc):
+                    continue
+                # Field-level op, so a retry after a conflict merges into the other writer's copy
+                op = _update_op(doc.get('id'), update)
+                modified_count = 1 if _modifies(doc, op) else 0
+                
+                success = await self._commit(collection, path, [op])
+                if not success:
+                    raise Exception(f"Failed to update document in blob storage for collection: {collection}")
+                return path, doc.get('id'), modified_count
+        
+        if insert is None:
+            return None
+        path, new_doc = insert
+        success = await self._commit(collection, path, [_upsert_op(query, update, new_doc)])
         if not success:
-            raise Exception(f"Failed to update document in blob storage for collection: {collection}")
-
-        return {'matched_count': matched_count, 'modified_count': modified_count}
+            raise Exception(f"Failed to save document to blob storage for collection: {collection}")
+        current = await self._committed(collection, path)
+        if current.get(new_doc['id']) is not None:
+            return path, new_doc['id'], None
+        # A concurrent upsert of the same query inserted first and this one updated its document
+        for doc in current.candidates(query):
+            if matches(doc):
+                return path, doc.get('id'), 1
+        return path, new_doc['id'], None
+    
+    async def _committed(self, collection: str, path: str) -> DocumentSet:
+        """Documents of a blob including the writes this instance committed"""
+        entry = self.cache.get(path)
+        return entry.data if entry is not None else await self._get_blob(collection, path)
+    
+    @contextlib.asynccontextmanager
+    async def _upsert_lock(self, collection: str, query: Dict):
+        """Serialize upserts of one query on this instance; the lock is dropped once unused"""
+        key = json.dumps([collection, query], sort_keys=True, default=str)
+        held = self._upsert_locks.setdefault(key, [asyncio.Lock(), 0])
+        held[1] += 1
+        try:
+            async with held[0]:
+                yield
+        finally:
+            held[1] -= 1
+            if not held[1]:
+                del self._upsert_locks[key]
     
     async def delete_one(self, collection: str, query: Dict) -> Dict:
         """Delete a single document"""
-        data = await self._get_blob(collection)
+        paths = await self._paths_for(collection, query)
+        matches = compile_query(query)
+        for path, data in zip(paths, await self._read_paths(collection, paths)):
+            for doc in data.candidates(query):
+                if matches(doc):
+                    success = await self._commit(collection, path, [{"op": "delete", "id": doc.get('id')}])
+                    if not success:
+                        raise Exception(f"Failed to delete document in blob storage for collection: {collection}")
+                    return {'deleted_count': 1}
         
-        deleted_count = 0
-        for i, doc in enumerate(data):
-            match = all(doc.get(k) == v for k, v in query.items())
-            if match:
-                data.pop(i)
-                deleted_count = 1
-                break
-        
-        success = await self._save_blob(collection, data)
-        if not success:
-            raise Exception(f"Failed to delete document in blob storage for collection: {collection}")
-
-        return {'deleted_count': deleted_count}
+        return {'deleted_count': 0}
     
     async def delete_many(self, collection: str, query: Dict) -> Dict:
         """Delete multiple documents"""
-        data = await self._get_blob(collection)
-        
-        original_len = len(data)
-        data = [doc for doc in data if not all(doc.get(k) == v for k, v in query.items())]
-        deleted_count = original_len - len(data)
+        paths = await self._paths_for(collection, query)
+        matches = compile_query(query)
+        deleted_count = 0
+        ops: Dict[str, List[Dict]] = {}
+        for path, data in zip(paths, await self._read_paths(collection, paths)):
+            path_ops = [{"op": "delete", "id": doc.get('id')} for doc in data.candidates(query) if matches(doc)]
+            if path_ops:
+                deleted_count += len(path_ops)
+                ops[path] = path_ops
         
-        success = await self._save_blob(collection, data)
-        if not success:
-            raise Exception(f"Failed to delete documents in blob storage for collection: {collection}")
-
+        await self._write_paths(collection, ops, "delete documents in")
         return {'deleted_count': deleted_count}
     
+    async def update_many(self, collection: str, query: Dict, update: Dict, upsert: bool = False) -> Dict:
+        """Update every matching document, with one upload per touched blob"""
+        result = await self.bulk_write([
+            {"op": "update_many", "collection": collection, "filter": query, "update": update, "upsert": upsert}
+        ])
+        counts = result['collections'][collection]
+        response = {'matched_count': counts['matched_count'], 'modified_count': counts['modified_count']}
+        if result['upserted_ids']:
+            response['upserted_id'] = result['upserted_ids'][0]
+        return response
+    
+    async def bulk_write(self, operations: List[Dict]) -> Dict:
+        """Apply write operations across collections with one upload per touched blob"""
+        writes: Dict[Tuple[str, str], List[Dict]] = {}
+        deleted = set()
+        counts: Dict[str, Dict[str, int]] = {}
+        inserted_ids, upserted_ids = [], []
+        upserts: List[Tuple[str, str, str]] = []
+        
+        async def insert(collection: str, document: Dict) -> str:
+            doc_id = self._generate_id()
+            document['_id'] = doc_id
+            document['id'] = doc_id
+            path = await self._path_for_doc(collection, document)
+            writes.setdefault((collection, path), []).append({"op": "put", "id": doc_id, "doc": document})
+            return doc_id
+        
+        for operation in operations:
+            kind = operation['op']
+            collection = operation['collection']
+            totals = counts.setdefault(collection, {'inserted_count': 0, 'matched_count': 0, 'modified_count': 0,
+                                                    'deleted_count': 0, 'upserted_count': 0})
+            if kind == 'insert_one':
+                inserted_ids.append(await insert(collection, operation['document']))
+                totals['inserted_count'] += 1
+                continue
+            if kind not in ('update_one', 'update_many', 'delete_one', 'delete_many'):
+                raise ValueError(f"Unsupported bulk operation: {kind}")
+            
+            query = operation.get('filter') or {}
+            matches = compile_query(query)
+            single = kind.endswith('_one')
+            matched = []
+            paths = await self._paths_for(collection, query)
+            for path, data in zip(paths, await self._read_paths(collection, paths)):
+                for doc in data.candidates(query):
+                    if (collection, doc.get('id')) not in deleted and matches(doc):
+                        matched.append((path, doc))
+                        if single:
+                            break
+                if single and matched:
+                    break
+            
+            if kind.startswith('update'):
+                totals['matched_count'] += len(matched)
+                for path, doc in matched:
+                    op = _update_op(doc.get('id'), operation['update'])
+                    totals['modified_count'] += 1 if _modifies(doc, op) else 0
+                    writes.setdefault((collection, path), []).append(op)
+                if not matched and operation.get('upsert'):
+                    # Matched again when committed, like a single upsert
+                    new_doc = _upsert_document(query, operation['update'])
+                    new_doc['_id'] = new_doc['id'] = self._generate_id()
+                    path = await self._path_for_doc(collection, new_doc)
+                    writes.setdefault((collection, path), []).append(_upsert_op(query, operation['update'], new_doc))
+                    upserts.append((collection, path, new_doc['id']))
+            else:
+                totals['deleted_count'] += len(matched)
+                for path, doc in matched:
+                    deleted.add((collection, doc.get('id')))
+                    writes.setdefault((collection, path), []).append({"op": "delete", "id": doc.get('id')})
+        
+        saved = await asyncio.gather(*(
+            self._commit(collection, path, path_ops) for (collection, path), path_ops in writes.items()
+        ))
+        if not all(saved):
+            failed = sorted({collection for (collection, _), ok in zip(writes, saved) if not ok})
+            raise Exception(f"Failed to apply bulk write to blob storage for collections: {', '.join(failed)}")
+        for collection, path, doc_id in upserts:
+            if (await self._committed(collection, path)).get(doc_id) is not None:
+                upserted_ids.append(doc_id)
+                counts[collection]['upserted_count'] += 1
+            else:
+                # Another upsert of the same filter inserted first; this one updated its document
+                counts[collection]['matched_count'] += 1
+                counts[collection]['modified_count'] += 1
+        
+        result = {key: sum(totals[key] for totals in counts.values())
+                  for key in ('inserted_count', 'matched_count', 'modified_count', 'deleted_count', 'upserted_count')}
+        result.update({'inserted_ids': inserted_ids, 'upserted_ids': upserted_ids, 'collections': counts})
+        return result
+    
+    async def multi_find(self, requests: List[Dict]) -> List[Any]:
+        """Run several reads in one await, downloading each blob behind them once"""
+        async def targets(request: Dict) -> List[Tuple[str, str]]:
+            query = request.get('query')
+            if request.get('op') == 'aggregate':
+                query, _ = split_match(request['pipeline'])
+            collection = request['collection']
+            return [(collection, path) for path in await self._paths_for(collection, query)]
+        
+        blobs = {target for found in await asyncio.gather(*(targets(r) for r in requests)) for target in found}
+        await asyncio.gather(*(self._get_blob(collection, path) for collection, path in blobs))
+        return await _run_reads(self, requests)
+    
     async def count_documents(self, collection: str, query: Dict = None) -> int:
         """Count documents matching query"""
         if query:
-            results = await self.find(collection, query)
-            return len(results)
-        data = await self._get_blob(collection)
-        return len(data)
+            matches = compile_query(query)
+            segments = await self._read_paths(collection, await self._paths_for(collection, query))
+            return sum(1 for data in segments for doc in data.candidates(query) if matches(doc))
+        segments = await self._read_paths(collection, await self._paths_for(collection))
+        return sum(len(data) for data in segments)
     
     async def aggregate(self, collection: str, pipeline: List[Dict]) -> List[Dict]:
-        """Simple aggregation support"""
-        data = await self._get_blob(collection)
-        
-        for stage in pipeline:
-            if '$match' in stage:
-                data = [doc for doc in data if all(doc.get(k) == v for k, v in stage['$match'].items())]
-            elif '$group' in stage:
-                group = stage['$group']
-                if group.get('_id') is None:
-                    result = {'_id': None}
-                    for key, op in group.items():
-                        if key == '_id':
-                            continue
-                        if isinstance(op, dict) and '$sum' in op:
-                            field = op['$sum'].replace('$', '')
-                            result[key] = sum(doc.get(field, 0) for doc in data)
-                    return [result]
-        
-        return data
+        """Run an aggregation pipeline in one streaming pass"""
+        query, rest = split_match(pipeline)
+        segments = await self._read_paths(collection, await self._paths_for(collection, query))
+        matches = compile_query(query)
+        docs = (doc for data in segments for doc in data.candidates(query) if matches(doc))
+        return run_pipeline(docs, rest)
 
 
 class MongoDBWrapper:
-    """Wrapper to make pymongo sync calls work with our async interface"""
+    """Async interface over pymongo, whose calls run on a bounded thread pool"""
     
-    def __init__(self, db):
-        self.db = db
+    def __init__(self, db=None, mongo_url: str = MONGO_URL, db_name: str = DB_NAME):
+        self._db = db
+        self.mongo_url = mongo_url
+        self.db_name = db_name
+        self._client_lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
     
-    async def find(self, collection: str, query: Dict = None) -> List[Dict]:
-        cursor = self.db[collection].find(query or {})
-        results = []
-        for doc in cursor:
-            doc['id'] = str(doc.pop('_id'))
-            results.append(doc)
-        return results
+    @property
+    def db(self):
+        """pymongo Database, connecting lazily on first access"""
+        if self._db is None:
+            with self._client_lock:
+                if self._db is None:
+                    from pymongo import MongoClient
+                    client = MongoClient(
+                        self.mongo_url,
+                        maxPoolSize=MONGO_MAX_POOL_SIZE,
+                        minPoolSize=MONGO_MIN_POOL_SIZE,
+                        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                    )
+                    self._db = client[self.db_name]
+        return self._db
     
-    async def find_one(self, collection: str, query: Dict) -> Optional[Dict]:
-        # Handle both string ID and ObjectId
-        if ObjectId is None:
-            # pymongo not available, skip ObjectId conversion
-            pass
-        else:
-            if 'id' in query:
-                try:
-                    query['_id'] = ObjectId(query.pop('id'))
-                except:
-                    pass
-            if '_id' in query and isinstance(query['_id'], str):
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking pymongo call on the worker pool"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=MONGO_EXECUTOR_WORKERS, thread_name_prefix='mongo')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    async def close(self):
+        """Close the underlying MongoClient (called on application shutdown)"""
+        if self._db is not None:
+            self._db.client.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+    
+    async def ensure_indexes(self, specs: Dict[str, List[Dict]] = None) -> Dict[str, Dict]:
+        """Create the declared indexes (idempotent) and log the ones still missing"""
+        specs = INDEX_SPECS if specs is None else specs
+        
+        def run():
+            from pymongo.errors import OperationFailure
+            for collection, indexes in specs.items():
+                for spec in indexes:
+                    options = {key: value for key, value in spec.items() if key != 'keys'}
+                    try:
+                        self.db[collection].create_index(spec['keys'], **options)
+                    except OperationFailure as e:
+                        # Duplicate data for a unique index, or an existing index with other options
+                        print(f"WARNING: could not create index {spec['keys']} on {collection}: {e}")
+        
+        await self._run(run)
+        report = await self.index_report(specs)
+        for collection, entry in report.items():
+            if entry["missing"] or entry["undeclared"]:
+                print(f"Index report for {collection}: missing={entry['missing']} undeclared={entry['undeclared']}")
+        return report
+    
+    async def index_report(self, specs: Dict[str, List[Dict]] = None) -> Dict[str, Dict]:
+        """Compare existing indexes with the spec; unused ones come from $indexStats counters"""
+        specs = INDEX_SPECS if specs is None else specs
+        
+        def run():
+            report = {}
+            for collection, indexes in specs.items():
+                declared = {spec.get('name') or _index_name(spec['keys']) for spec in indexes}
+                existing = set(self.db[collection].index_information()) - {'_id_'}
+                unused = []
                 try:
-                    query['_id'] = ObjectId(query['_id'])
-                except:
-                    pass
-                
-        doc = self.db[collection].find_one(query)
-        if doc:
+                    for stats in self.db[collection].aggregate([{"$indexStats": {}}]):
+                        if stats['name'] != '_id_' and stats.get('accesses', {}).get('ops', 0) == 0:
+                            unused.append(stats['name'])
+                except Exception as e:
+                    # $indexStats needs extra privileges on some hosted clusters
+                    print(f"Index usage stats unavailable for {collection}: {e}")
+                report[collection] = {
+                    "indexes": sorted(existing),
+                    "missing": sorted(declared - existing),
+                    "undeclared": sorted(existing - declared),
+                    "unused": sorted(unused),
+                }
+            return report
+        
+        return await self._run(run)
+    
+    def _cursor(self, collection: str, query: Dict = None, sort: SortSpec = None, skip: int = 0,
+                limit: Optional[int] = None, projection: Dict = None, batch_size: Optional[int] = None):
+        """Build a pymongo cursor with sort/skip/limit/projection pushed down (no I/O until iterated)"""
+        cursor = self.db[collection].find(_mongo_id_query(query) if query else {}, projection)
+        if sort:
+            cursor = cursor.sort([('_id' if field == 'id' else field, direction) for field, direction in normalize_sort(sort)])
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+    
+    async def find(self, collection: str, query: Dict = None, sort: SortSpec = None, skip: int = 0,
+                   limit: Optional[int] = None, projection: Dict = None, batch_size: Optional[int] = None) -> List[Dict]:
+        def run():
+            results = []
+            for doc in self._cursor(collection, query, sort, skip, limit, projection, batch_size):
+                if '_id' in doc:
+                    doc['id'] = str(doc.pop('_id'))
+                results.append(doc)
+            return results
+        return await self._run(run)
+    
+    async def iter_find(self, collection: str, query: Dict = None, sort: SortSpec = None, skip: int = 0,
+                        limit: Optional[int] = None, projection: Dict = None,
+                        batch_size: int = 100) -> AsyncIterator[Dict]:
+        """Stream matching documents, fetching one cursor batch at a time on the worker pool"""
+        cursor = await self._run(self._cursor, collection, query, sort, skip, limit, projection, batch_size)
+        try:
+            while True:
+                batch = await self._run(lambda: list(itertools.islice(cursor, batch_size)))
+                if not batch:
+                    break
+                for doc in batch:
+                    if '_id' in doc:
+                        doc['id'] = str(doc.pop('_id'))
+                    yield doc
+        finally:
+            # close() may talk to the server (killCursors), so it runs on the pool too
+            await self._run(cursor.close)
+    
+    async def find_one(self, collection: str, query: Dict, projection: Dict = None) -> Optional[Dict]:
+        query = _mongo_id_query(query)
+        doc = await self._run(lambda: self.db[collection].find_one(query, projection))
+        if doc and '_id' in doc:
             doc['id'] = str(doc.pop('_id'))
         return doc
     
     async def insert_one(self, collection: str, document: Dict) -> Dict:
-        result = self.db[collection].insert_one(document)
+        if ObjectId is not None and '_id' not in document:
+            # Same time-ordered ids as the Blob backend
+            document['_id'] = ObjectId(generate_id())
+        result = await self._run(lambda: self.db[collection].insert_one(document))
         return {'inserted_id': str(result.inserted_id)}
     
     async def insert_many(self, collection: str, documents: List[Dict]) -> Dict:
-        result = self.db[collection].insert_many(documents)
+        if ObjectId is not None:
+            for document in documents:
+                if '_id' not in document:
+                    document['_id'] = ObjectId(generate_id())
+        result = await self._run(lambda: self.db[collection].insert_many(documents))
         return {'inserted_ids': [str(id) for id in result.inserted_ids]}
     
     async def update_one(self, collection: str, query: Dict, update: Dict, upsert: bool = False) -> Dict:
-        # Handle ID conversion
-        if ObjectId is not None:
-            if 'id' in query:
-                try:
-                    query['_id'] = ObjectId(query.pop('id'))
-                except:
-                    pass
-            if '_id' in query and isinstance(query['_id'], str):
-                try:
-                    query['_id'] = ObjectId(query['_id'])
-                except:
-                    pass
-                
-        result = self.db[collection].update_one(query, update, upsert=upsert)
+        query = _mongo_id_query(query)
+        if upsert:
+            update = _mongo_upsert(query, update)
+        result = await self._run(lambda: self.db[collection].update_one(query, update, upsert=upsert))
         return {
             'matched_count': result.matched_count,
             'modified_count': result.modified_count,
             'upserted_id': str(result.upserted_id) if result.upserted_id else None
         }
     
+    async def find_one_and_update(self, collection: str, query: Dict, update: Dict, upsert: bool = False,
+                                  projection: Dict = None) -> Optional[Dict]:
+        from pymongo import ReturnDocument
+        query = _mongo_id_query(query)
+        if upsert:
+            update = _mongo_upsert(query, update)
+        doc = await self._run(lambda: self.db[collection].find_one_and_update(
+            query, update, projection=projection, upsert=upsert, return_document=ReturnDocument.AFTER
+        ))
+        if doc and '_id' in doc:
+            doc['id'] = str(doc.pop('_id'))
+        return doc
+    
     async def delete_one(self, collection: str, query: Dict) -> Dict:
-        if ObjectId is not None:
-            if 'id' in query:
-                try:
-                    query['_id'] = ObjectId(query.pop('id'))
-                except:
-                    pass
-            if '_id' in query and isinstance(query['_id'], str):
-                try:
-                    query['_id'] = ObjectId(query['_id'])
-                except:
-                    pass
-                
-        result = self.db[collection].delete_one(query)
+        query = _mongo_id_query(query)
+        result = await self._run(lambda: self.db[collection].delete_one(query))
         return {'deleted_count': result.deleted_count}
     
     async def delete_many(self, collection: str, query: Dict) -> Dict:
-        result = self.db[collection].delete_many(query)
+        query = _mongo_id_query(query)
+        result = await self._run(lambda: self.db[collection].delete_many(query))
         return {'deleted_count': result.deleted_count}
     
+    async def update_many(self, collection: str, query: Dict, update: Dict, upsert: bool = False) -> Dict:
+        query = _mongo_id_query(query)
+        if upsert:
+            update = _mongo_upsert(query, update)
+        result = await self._run(lambda: self.db[collection].update_many(query, update, upsert=upsert))
+        return {
+            'matched_count': result.matched_count,
+            'modified_count': result.modified_count,
+            'upserted_id': str(result.upserted_id) if result.upserted_id else None
+        }
+    
+    async def bulk_write(self, operations: List[Dict]) -> Dict:
+        """Apply write operations (same format as VercelBlobDB.bulk_write) in one worker call"""
+        from pymongo import InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+        
+        def to_request(operation: Dict):
+            kind = operation['op']
+            if kind == 'insert_one':
+                document = operation['document']
+                if ObjectId is not None and '_id' not in document:
+                    document['_id'] = ObjectId(generate_id())
+                return InsertOne(document)
+            query = _mongo_id_query(operation.get('filter') or {})
+            if kind in ('update_one', 'update_many'):
+                upsert = operation.get('upsert', False)
+                update = _mongo_upsert(query, operation['update']) if upsert else operation['update']
+                if kind == 'update_one':
+                    return UpdateOne(query, update, upsert=upsert)
+                return UpdateMany(query, update, upsert=upsert)
+            if kind == 'delete_one':
+                return DeleteOne(query)
+            if kind == 'delete_many':
+                return DeleteMany(query)
+            raise ValueError(f"Unsupported bulk operation: {kind}")
+        
+        runs = []
+        for operation in operations:
+            if runs and runs[-1][0] == operation['collection']:
+                runs[-1][1].append(operation)
+            else:
+                runs.append((operation['collection'], [operation]))
+        
+        def run():
+            counts: Dict[str, Dict[str, int]] = {}
+            inserted_ids, upserted_ids = [], []
+            for collection, run_ops in runs:
+                requests = [to_request(operation) for operation in run_ops]
+                result = self.db[collection].bulk_write(requests, ordered=True)
+                totals = counts.setdefault(collection, {'inserted_count': 0, 'matched_count': 0, 'modified_count': 0,
+                                                        'deleted_count': 0, 'upserted_count': 0})
+                totals['inserted_count'] += result.inserted_count
+                totals['matched_count'] += result.matched_count
+                totals['modified_count'] += result.modified_count
+                totals['deleted_count'] += result.deleted_count
+                totals['upserted_count'] += result.upserted_count
+                inserted_ids += [str(operation['document']['_id']) for operation in run_ops if operation['op'] == 'insert_one']
+                upserted_ids += [str(upserted_id) for upserted_id in result.upserted_ids.values()]
+            return counts, inserted_ids, upserted_ids
+        
+        counts, inserted_ids, upserted_ids = await self._run(run)
+        result = {key: sum(totals[key] for totals in counts.values())
+                  for key in ('inserted_count', 'matched_count', 'modified_count', 'deleted_count', 'upserted_count')}
+        result.update({'inserted_ids': inserted_ids, 'upserted_ids': upserted_ids, 'collections': counts})
+        return result
+    
     async def count_documents(self, collection: str, query: Dict = None) -> int:
-        return self.db[collection].count_documents(query or {})
+        return await self._run(lambda: self.db[collection].count_documents(query or {}))
+    
+    async def multi_find(self, requests: List[Dict]) -> List[Any]:
+        """Run several reads concurrently on the worker pool (same format as VercelBlobDB.multi_find)"""
+        return await _run_reads(self, requests)
     
     async def aggregate(self, collection: str, pipeline: List[Dict]) -> List[Dict]:
-        results = list(self.db[collection].aggregate(pipeline))
+        results = await self._run(lambda: list(self.db[collection].aggregate(pipeline)))
         for doc in results:
-            if '_id' in doc and doc['_id'] is not None:
+            # Only document ids are renamed; $group keys stay under _id like in the blob adapter
+            if ObjectId is not None and isinstance(doc.get('_id'), ObjectId):
                 doc['id'] = str(doc.pop('_id'))
         return results
 
@@ -457,8 +1755,5 @@ def get_database():
         return VercelBlobDB()
     else:
         print("Using MongoDB for database")
-        from pymongo import MongoClient
-        MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
-        DB_NAME = os.environ.get("DB_NAME", "autoparts_ecommerce")
-        client = MongoClient(MONGO_URL)
-        return MongoDBWrapper(client[DB_NAME])
+        # The MongoClient is created on first query, not at import time
+        return MongoDBWrapper(mongo_url=MONGO_URL, db_name=DB_NAME)
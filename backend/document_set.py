@@ -0,0 +1,389 @@
+"""
+In-memory document container for the Vercel Blob adapter
+Keeps the documents of one blob in order plus secondary hash indexes
+"""
+import json
+import bisect
+import operator
+from typing import Optional, List, Dict, Any, Iterable, Iterator
+
+from query_engine import compile_query
+
+
+def _index_key(value: Any) -> Any:
+    """Hashable key for an indexed value (lists/dicts are keyed by their JSON)"""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ('__json__', json.dumps(value, sort_keys=True, default=str))
+
+
+def _index_keys(value: Any) -> List[Any]:
+    """Index keys for a value; arrays are also indexed by each element (multikey)"""
+    if isinstance(value, list):
+        return list(dict.fromkeys([_index_key(value)] + [_index_key(item) for item in value]))
+    return [_index_key(value)]
+
+
+def _primary_key(doc: Dict) -> Any:
+    return doc.get('id', doc.get('_id'))
+
+
+def _after(key: Any, previous: Any) -> bool:
+    try:
+        return key > previous
+    except TypeError:
+        return False
+
+
+_RANGE_OPS = {'$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt, '$lte': operator.le}
+
+
+def _id_bounds(query: Dict) -> Optional[Dict[str, Any]]:
+    """The id range condition of a query ({"$lt": ..., ...}), or None"""
+    for key in ('id', '_id'):
+        value = query.get(key)
+        if isinstance(value, dict) and value and set(value) <= set(_RANGE_OPS):
+            return value
+    return None
+
+
+def _in_range(key: Any, bounds: Dict[str, Any]) -> bool:
+    try:
+        return all(_RANGE_OPS[op](key, bound) for op, bound in bounds.items())
+    except TypeError:
+        return False
+
+
+class _KeyRange:
+    """Documents for keys[start:end], decoded as they are iterated, in either direction"""
+
+    def __init__(self, docs: 'DocumentSet', keys: List[Any], start: int = 0, end: int = None):
+        self.docs = docs
+        self.keys = keys
+        self.start = start
+        self.end = len(keys) if end is None else end
+
+    def __iter__(self) -> Iterator[Dict]:
+        return self._docs(range(self.start, self.end))
+
+    def __reversed__(self) -> Iterator[Dict]:
+        return self._docs(reversed(range(self.start, self.end)))
+
+    def _docs(self, positions: Iterable[int]) -> Iterator[Dict]:
+        for i in positions:
+            # Skips documents deleted while the range is being read
+            if self.keys[i] in self.docs._by_id:
+                yield self.docs._doc(self.keys[i])
+
+
+class DocumentSet:
+    """Ordered documents keyed by id, with hash indexes on declared equality fields.
+
+    Documents live in an insertion-ordered id -> document dict, so access by
+    id, replacement and deletion are O(1) while iteration keeps document
+    order. Every mutation goes through put/update/delete so the indexes stay
+    in sync; index buckets hold primary keys and are returned in document
+    order using a per-document sequence number.
+
+    A set built from binary records (from_records) holds each document as
+    its record position until it is first accessed, then decodes it once.
+
+    id_ordered is True while document order is id order (k-sortable ids).
+    A document inserted with an id older than the last one is placed at its
+    id position, so the order survives concurrent writers and is persisted.
+    While it holds, the keys are also kept as a sorted list for id ranges;
+    it is replaced rather than changed in place (except for appends), so
+    ranges already handed out stay valid.
+    """
+
+    def __init__(self, docs: Iterable[Dict] = None, indexed_fields: Iterable[str] = ()):
+        self._by_id: Dict[Any, Any] = {}
+        self.indexes: Dict[str, Dict[Any, Dict[Any, Any]]] = {field: {} for field in indexed_fields}
+        self._seq: Dict[Any, int] = {}
+        self._next_seq = 0
+        self._records = None
+        self._undecoded = 0
+        self.id_ordered = True
+        self._keys: Optional[List[Any]] = []
+        for doc in docs or []:
+            self.put(doc)
+
+    @classmethod
+    def from_records(cls, reader, indexed_fields: Iterable[str] = ()) -> 'DocumentSet':
+        """Documents of a binary record blob (blob_codec.RecordReader), decoded on first access.
+
+        Ids and indexed field values come from the blob's footer, so a lookup
+        by id or indexed field decodes only the documents it returns.
+        """
+        docs = cls(indexed_fields=indexed_fields)
+        for position, key in enumerate(reader.ids):
+            if key is None:
+                key = ('__seq__', docs._next_seq)
+            if key not in docs._by_id:
+                docs._seq[key] = docs._next_seq
+                docs._next_seq += 1
+            docs._by_id[key] = position
+        docs._records = reader
+        docs._undecoded = len(docs._by_id)
+        positions = list(docs._by_id.items())
+        docs.id_ordered = all(_after(key, previous[0]) for previous, (key, _) in zip(positions, positions[1:]))
+        docs._keys = list(docs._by_id) if docs.id_ordered else None
+        for field, index in docs.indexes.items():
+            column = reader.columns.get(field)
+            for key, position in positions:
+                # Fields indexed after the blob was written are not in its footer
+                value = column[position] if column is not None else docs._doc(key).get(field)
+                for value_key in _index_keys(value):
+                    index.setdefault(value_key, {})[key] = position
+        return docs
+
+    def _doc(self, key: Any) -> Dict:
+        """The document stored under key, decoding it on first access"""
+        doc = self._by_id[key]
+        if type(doc) is int:
+            doc = self._by_id[key] = self._records.decode(doc)
+            self._undecoded -= 1
+            if not self._undecoded:
+                # Everything is decoded: the record buffer is no longer needed
+                self._records = None
+        return doc
+
+    def __iter__(self) -> Iterator[Dict]:
+        if self._records is None:
+            return iter(self._by_id.values())
+        return (self._doc(key) for key in self._by_id)
+
+    def __reversed__(self) -> Iterator[Dict]:
+        if self._records is None:
+            return reversed(self._by_id.values())
+        return (self._doc(key) for key in reversed(self._by_id))
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __bool__(self) -> bool:
+        return bool(self._by_id)
+
+    @property
+    def docs(self) -> List[Dict]:
+        """Documents in order, as a new list"""
+        return list(self)
+
+    def records(self) -> List[Any]:
+        """Documents in order for a binary blob, the undecoded ones as their raw record (blob_codec.RawRecord)"""
+        if self._records is None:
+            return list(self._by_id.values())
+        return [self._records.raw(doc) if type(doc) is int else doc for doc in self._by_id.values()]
+
+    def _track(self, key: Any, doc: Dict, seq: int = None):
+        if seq is None:
+            seq = self._next_seq
+            self._next_seq += 1
+        self._seq[key] = seq
+        for field, index in self.indexes.items():
+            for value_key in _index_keys(doc.get(field)):
+                index.setdefault(value_key, {})[key] = doc
+
+    def _untrack(self, key: Any, doc: Dict, fields: Iterable[str] = None):
+        for field in self.indexes if fields is None else fields:
+            for value_key in _index_keys(doc.get(field)):
+                bucket = self.indexes[field].get(value_key)
+                if bucket is not None:
+                    bucket.pop(key, None)
+                    if not bucket:
+                        del self.indexes[field][value_key]
+
+    def add_index(self, field: str):
+        """Build an index on field over the current documents"""
+        if field in self.indexes:
+            return
+        index = self.indexes[field] = {}
+        for key in self._by_id:
+            doc = self._doc(key)
+            for value_key in _index_keys(doc.get(field)):
+                index.setdefault(value_key, {})[key] = doc
+
+    def get(self, doc_id: Any) -> Optional[Dict]:
+        return self._doc(doc_id) if doc_id in self._by_id else None
+
+    def put(self, doc: Dict):
+        """Insert a document, or replace the one with the same id in place"""
+        key = _primary_key(doc)
+        if key is None:
+            # Legacy document without an id: keep it under a private key
+            key = ('__seq__', self._next_seq)
+        current = self._doc(key) if key in self._by_id else None
+        if current is None:
+            if self.id_ordered and self._by_id and not _after(key, next(reversed(self._by_id))):
+                # An older id (another instance's write, or an id generated before a wait)
+                self._place(key, doc)
+                return
+            self._by_id[key] = doc
+            if self.id_ordered:
+                self._keys.append(key)
+            self._track(key, doc)
+        elif current is not doc:
+            self._untrack(key, current)
+            self._by_id[key] = doc
+            self._track(key, doc, self._seq[key])
+
+    def _place(self, key: Any, doc: Dict):
+        """Insert a new document at its id position, so documents stay in id order"""
+        try:
+            position = bisect.bisect_left(self._keys, key)
+        except TypeError:
+            # Ids that do not compare (e.g. a legacy document without one): order is lost
+            self.id_ordered = False
+            self._keys = None
+            self._by_id[key] = doc
+            self._track(key, doc)
+            return
+        keys = self._keys = self._keys[:position] + [key] + self._keys[position:]
+        by_id = self._by_id
+        by_id[key] = doc
+        # New dicts rather than in-place moves: iterations already running keep their view
+        self._by_id = {k: by_id[k] for k in keys}
+        self._seq = {k: seq for seq, k in enumerate(keys)}
+        self._next_seq = len(keys)
+        self._track(key, doc, position)
+
+    def update(self, doc_id: Any, changes: Dict, inc: Dict = None, push: Dict = None):
+        """Set fields on a document, re-indexing only the indexed fields that change.
+
+        inc adds to numeric fields and push appends to array fields ({"$each": [...]}
+        appends several); both are resolved against the document's current values.
+        """
+        doc = self.get(doc_id)
+        if doc is None:
+            return
+        if inc or push:
+            changes = dict(changes)
+            for field, amount in (inc or {}).items():
+                changes[field] = (changes.get(field, doc.get(field)) or 0) + amount
+            for field, value in (push or {}).items():
+                current = changes.get(field, doc.get(field))
+                items = value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+                changes[field] = (list(current) if isinstance(current, list) else []) + list(items)
+        fields = [field for field in self.indexes if field in changes and doc.get(field) != changes[field]]
+        self._untrack(doc_id, doc, fields)
+        doc.update(changes)
+        for field in fields:
+            for value_key in _index_keys(doc.get(field)):
+                self.indexes[field].setdefault(value_key, {})[doc_id] = doc
+
+    def upsert(self, query: Dict, doc: Dict, changes: Dict, inc: Dict = None, push: Dict = None):
+        """Update the first document matching query, else insert doc"""
+        matches = compile_query(query)
+        for current in self.candidates(query):
+            if matches(current):
+                self.update(_primary_key(current), changes, inc, push)
+                return
+        # A copy: the op is applied again, to a reloaded copy, after a write conflict
+        self.put(dict(doc))
+
+    def delete(self, doc_id: Any):
+        # Decoded first: its indexed values are needed to untrack it
+        doc = self.get(doc_id)
+        self._by_id.pop(doc_id, None)
+        if doc is not None:
+            self._untrack(doc_id, doc)
+            self._seq.pop(doc_id, None)
+            if self.id_ordered:
+                position = bisect.bisect_left(self._keys, doc_id)
+                self._keys = self._keys[:position] + self._keys[position + 1:]
+
+    def apply(self, ops: List[Dict]):
+        """Replay write ops (delta records).
+
+        Puts carry the whole document; updates carry the fields they set plus
+        relative inc/push changes, which is why delta records are tracked by
+        name and replayed exactly once. Upserts are matched when applied, so
+        concurrent upserts of one query leave a single document; which of them
+        inserted it follows the order deltas are replayed in.
+        """
+        for op in ops:
+            if op['op'] == 'put':
+                self.put(op['doc'])
+            elif op['op'] == 'update':
+                self.update(op['id'], op.get('set', {}), op.get('inc'), op.get('push'))
+            elif op['op'] == 'upsert':
+                self.upsert(op['filter'], op['doc'], op.get('set', {}), op.get('inc'), op.get('push'))
+            elif op['op'] == 'delete':
+                self.delete(op['id'])
+
+    def candidates(self, query: Optional[Dict]) -> Iterable[Dict]:
+        """Documents that may match query: the documents for the ids, the
+        smallest matching index buckets, else all of them.
+
+        Only plain equality, $eq and $in conditions are used for planning,
+        plus an id range ($gt/$gte/$lt/$lte, e.g. a page cursor), which is
+        checked on the keys so skipped documents are never decoded.
+        Callers still check every candidate against the full query.
+        """
+        if not query:
+            return self
+        for key in ('id', '_id'):
+            doc_ids = _equality_values(query.get(key))
+            if doc_ids is not None and all(isinstance(doc_id, str) for doc_id in doc_ids):
+                docs = {doc_id: self._by_id[doc_id] for doc_id in doc_ids if doc_id in self._by_id}
+                return self._in_order(docs)
+        best = None
+        for field, value in query.items():
+            index = self.indexes.get(field)
+            values = _equality_values(value) if index is not None else None
+            if values is None:
+                continue
+            if len(values) == 1:
+                bucket = index.get(_index_key(values[0]), {})
+            else:
+                bucket = {}
+                for item in values:
+                    bucket.update(index.get(_index_key(item), {}))
+            if not bucket:
+                return []
+            if best is None or len(bucket) < len(best):
+                best = bucket
+        bounds = _id_bounds(query)
+        if best is None:
+            return self if bounds is None else self._id_range(bounds)
+        if bounds is not None:
+            best = {key: doc for key, doc in best.items() if _in_range(key, bounds)}
+        return self._in_order(best)
+
+    def _id_range(self, bounds: Dict[str, Any]) -> Iterable[Dict]:
+        """Documents with an id within bounds; found by bisection when documents are in id order"""
+        if self.id_ordered:
+            keys = self._keys
+            start, end = 0, len(keys)
+            try:
+                for op, bound in bounds.items():
+                    if op == '$gt':
+                        start = max(start, bisect.bisect_right(keys, bound))
+                    elif op == '$gte':
+                        start = max(start, bisect.bisect_left(keys, bound))
+                    elif op == '$lt':
+                        end = min(end, bisect.bisect_left(keys, bound))
+                    else:
+                        end = min(end, bisect.bisect_right(keys, bound))
+                return _KeyRange(self, keys, start, max(start, end))
+            except TypeError:
+                pass
+        return _KeyRange(self, [key for key in self._by_id if _in_range(key, bounds)])
+
+    def _in_order(self, docs: Dict[Any, Any]) -> List[Dict]:
+        if len(docs) <= 1:
+            return [self._doc(key) for key in docs]
+        return [self._doc(key) for key in sorted(docs, key=self._seq.__getitem__)]
+
+
+def _equality_values(value: Any) -> Optional[List[Any]]:
+    """Values a condition is restricted to (plain equality, $eq or $in), or None"""
+    if not isinstance(value, dict) or not any(str(k).startswith('$') for k in value):
+        return None if isinstance(value, list) else [value]
+    if set(value) == {'$eq'}:
+        return None if isinstance(value['$eq'], list) else [value['$eq']]
+    if set(value) == {'$in'} and not any(isinstance(item, (list, dict)) for item in value['$in']):
+        return list(value['$in'])
+    return None
@@ -0,0 +1,262 @@
+"""
+Opt-in fast response path
+Typed documents serialized by precompiled pydantic-core serializers instead of
+jsonable_encoder + json, and negotiated gzip/brotli compression of large bodies
+"""
+import os
+import json
+import zlib
+from typing import Optional, List, Dict, Any, Iterable, Tuple
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import TypeAdapter
+from typing_extensions import TypedDict
+
+import blob_codec
+from blob_codec import dumps
+
+# Brotli needs the optional "brotli" package; gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# FAST_JSON=1 serves products, orders and cart items through the typed serializers
+FAST_JSON = os.environ.get('FAST_JSON', '0') == '1'
+# Content codings offered to clients, in order of preference: e.g. "br,gzip" (default: none)
+RESPONSE_COMPRESSION = [
+    coding.strip() for coding in os.environ.get('RESPONSE_COMPRESSION', 'none').lower().split(',')
+    if coding.strip() in ('br', 'gzip') and (coding.strip() != 'br' or brotli is not None)
+]
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.environ.get('RESPONSE_COMPRESSION_MIN_SIZE', '1024'))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+# Documents per typed-serialized chunk of a streamed list
+STREAM_BATCH = 100
+
+# Endpoints returning plain dicts still go through jsonable_encoder; orjson renders the result faster
+DEFAULT_RESPONSE_CLASS = ORJSONResponse if FAST_JSON and blob_codec.orjson is not None else JSONResponse
+
+# ---------- Response documents ----------
+#
+# The fields the API writes; serialization keeps declared fields only, so an
+# internal field added to a stored document does not leak into responses.
+
+
+class ProductDoc(TypedDict, total=False):
+    id: str
+    name: str
+    description: str
+    price: float
+    price_wholesale: Optional[float]
+    image_url: str
+    category: str
+    inventory: int
+    featured: bool
+    sale_type: str
+    min_wholesale_qty: int
+    created_at: Any
+    updated_at: Any
+
+
+class CartItemDoc(TypedDict, total=False):
+    id: str
+    session_id: str
+    product_id: str
+    product_name: str
+    product_image: str
+    product_price: float
+    quantity: int
+    sale_type: str
+    created_at: Any
+    updated_at: Any
+
+
+class OrderItemDoc(TypedDict, total=False):
+    product_id: str
+    product_name: str
+    quantity: int
+    price: float
+    sale_type: str
+
+
+class ShippingAddressDoc(TypedDict, total=False):
+    street: str
+    city: str
+    state: str
+    zip: str
+    country: str
+    phone: str
+
+
+class OrderDoc(TypedDict, total=False):
+    id: str
+    order_id: str
+    customer_name: str
+    customer_email: str
+    customer_phone: str
+    items: List[OrderItemDoc]
+    total: float
+    shipping_address: Optional[ShippingAddressDoc]
+    payment_method: str
+    source: str
+    platform: str
+    external_order_id: str
+    notes: str
+    status: str
+    payment_status: str
+    created_at: Any
+    updated_at: Any
+
+
+# Built once: the schema is compiled into a serializer at import
+ADAPTERS: Dict[str, TypeAdapter] = {
+    "products": TypeAdapter(List[ProductDoc]),
+    "items": TypeAdapter(List[CartItemDoc]),
+    "orders": TypeAdapter(List[OrderDoc]),
+}
+
+
+def encode_documents(key: str, docs: List[Dict]) -> bytes:
+    """A JSON array of documents through the typed serializer for key"""
+    # Stored values of an unexpected type are written as they are instead of warning
+    return ADAPTERS[key].dump_json(docs, warnings=False)
+
+
+def encode_list(key: str, docs: List[Dict], **fields: Any) -> bytes:
+    """{"success": true, "<key>": [...], **fields} with the documents typed-serialized"""
+    rest = b''.join(b',' + dumps(name) + b':' + dumps(value) for name, value in fields.items())
+    return b'{"success":true,' + dumps(key) + b':' + encode_documents(key, docs) + rest + b'}'
+
+
+def encode_payload(key: str, payload: Dict) -> bytes:
+    """A {"success": true, "<key>": [...], ...} payload: typed with FAST_JSON, plain otherwise"""
+    if not FAST_JSON:
+        return dumps(payload)
+    return encode_list(key, payload[key], **{name: value for name, value in payload.items()
+                                             if name not in ("success", key)})
+
+
+def encode_items(key: str, docs: List[Dict]) -> bytes:
+    """Comma separated documents for a streamed list: typed with FAST_JSON, plain otherwise"""
+    if FAST_JSON:
+        return encode_documents(key, docs)[1:-1]
+    return b",".join(json.dumps(doc, default=str, ensure_ascii=False).encode() for doc in docs)
+
+
+# ---------- Compression ----------
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """The preferred configured coding the client accepts (Accept-Encoding), if any"""
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip()] = quality
+    for coding in RESPONSE_COMPRESSION:
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+class _Compressor:
+    def __init__(self, coding: str):
+        if coding == 'br':
+            self._brotli = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._zlib = None
+        else:
+            self._brotli = None
+            self._zlib = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._brotli.process(data) if self._brotli else self._zlib.compress(data)
+
+    def flush(self) -> bytes:
+        return self._brotli.finish() if self._brotli else self._zlib.flush()
+
+
+def compress(data: bytes, coding: str) -> bytes:
+    """data encoded with a content coding ("br" or "gzip")"""
+    compressor = _Compressor(coding)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing response bodies of RESPONSE_COMPRESSION_MIN_SIZE bytes or
+    more with the best coding the client accepts; streamed responses are compressed as they
+    are sent. A strong ETag becomes weak, as the encoded bytes differ from what it names."""
+
+    def __init__(self, app, minimum_size: int = RESPONSE_COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RESPONSE_COMPRESSION:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        coding = negotiate_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Dict] = None
+        compressor: Optional[_Compressor] = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                response_headers = {name.lower(): value for name, value in message.get("headers", [])}
+                passthrough = b"content-encoding" in response_headers or message["status"] in (204, 304)
+                if passthrough:
+                    await send(message)
+                else:
+                    start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if compressor is None:
+                if not more and len(body) < self.minimum_size:
+                    # Small: not worth it, sent as it is
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = _Compressor(coding)
+                await send({**start, "headers": _compressed_headers(start.get("headers", []), coding)})
+            data = compressor.compress(body)
+            if not more:
+                data += compressor.flush()
+            if data or not more:
+                await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def _compressed_headers(headers: Iterable[Tuple[bytes, bytes]], coding: str) -> List[Tuple[bytes, bytes]]:
+    result = []
+    vary = None
+    for name, value in headers:
+        lowered = name.lower()
+        if lowered == b"content-length":
+            continue
+        if lowered == b"etag" and not value.startswith(b"W/"):
+            value = b"W/" + value
+        if lowered == b"vary":
+            vary = value
+            continue
+        result.append((name, value))
+    result.append((b"content-encoding", coding.encode()))
+    result.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+    return result
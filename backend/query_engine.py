@@ -0,0 +1,227 @@
+"""
+Query engine for the Vercel Blob adapter
+Compiles Mongo-style filters into cached predicates and applies sort/skip/limit/projection
+"""
+import re
+import heapq
+import itertools
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Callable, Iterable, Tuple, Union
+
+Predicate = Callable[[Dict], bool]
+SortSpec = Union[None, str, List[Tuple[str, int]], Dict[str, int]]
+
+MISSING = object()
+_COMPILED: 'OrderedDict[Any, Predicate]' = OrderedDict()
+_COMPILED_MAX = 512
+
+
+def get_field(doc: Dict, path: str) -> Any:
+    """Resolve a dotted path ("shipping_address.city"); missing fields give MISSING"""
+    if '.' not in path:
+        return doc.get(path, MISSING)
+    value: Any = doc
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def _candidates(value: Any) -> List[Any]:
+    """Values a condition is tested against: an array matches if any element does"""
+    if value is MISSING:
+        return [None]
+    if isinstance(value, list):
+        return [value, *value]
+    return [value]
+
+
+def _compare(op: Callable[[Any, Any], bool], expected: Any) -> Callable[[Any], bool]:
+    def test(value: Any) -> bool:
+        for candidate in _candidates(value):
+            try:
+                if candidate is not None and op(candidate, expected):
+                    return True
+            except TypeError:
+                # Mongo only compares values of the same type
+                continue
+        return False
+    return test
+
+
+def _compile_operators(spec: Dict) -> Callable[[Any], bool]:
+    """Compile {"$gte": 1, "$lt": 5, ...} for one field"""
+    tests = []
+    for op, expected in spec.items():
+        if op == '$eq':
+            tests.append(lambda v, e=expected: e in _candidates(v))
+        elif op == '$ne':
+            tests.append(lambda v, e=expected: e not in _candidates(v))
+        elif op == '$in':
+            options = list(expected)
+            tests.append(lambda v, o=options: any(c in o for c in _candidates(v)))
+        elif op == '$nin':
+            options = list(expected)
+            tests.append(lambda v, o=options: not any(c in o for c in _candidates(v)))
+        elif op == '$gt':
+            tests.append(_compare(lambda a, b: a > b, expected))
+        elif op == '$gte':
+            tests.append(_compare(lambda a, b: a >= b, expected))
+        elif op == '$lt':
+            tests.append(_compare(lambda a, b: a < b, expected))
+        elif op == '$lte':
+            tests.append(_compare(lambda a, b: a <= b, expected))
+        elif op == '$exists':
+            tests.append(lambda v, e=bool(expected): (v is not MISSING) == e)
+        elif op == '$regex':
+            flags = 0
+            for letter in spec.get('$options', ''):
+                flags |= {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}.get(letter, 0)
+            pattern = expected if isinstance(expected, re.Pattern) else re.compile(expected, flags)
+            tests.append(lambda v, p=pattern: any(isinstance(c, str) and p.search(c) for c in _candidates(v)))
+        elif op == '$options':
+            continue
+        elif op == '$not':
+            inner = _compile_operators(expected)
+            tests.append(lambda v, t=inner: not t(v))
+        else:
+            raise ValueError(f"Unsupported query operator: {op}")
+    return lambda value: all(test(value) for test in tests)
+
+
+def _is_operator_spec(value: Any) -> bool:
+    return isinstance(value, dict) and bool(value) and all(str(k).startswith('$') for k in value)
+
+
+def _build(query: Dict) -> Predicate:
+    tests: List[Predicate] = []
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            parts = [_build(part) for part in value]
+            if key == '$and':
+                tests.append(lambda doc, p=parts: all(t(doc) for t in p))
+            elif key == '$or':
+                tests.append(lambda doc, p=parts: any(t(doc) for t in p))
+            else:
+                tests.append(lambda doc, p=parts: not any(t(doc) for t in p))
+        elif _is_operator_spec(value):
+            field_test = _compile_operators(value)
+            tests.append(lambda doc, k=key, t=field_test: t(get_field(doc, k)))
+        elif '.' not in key and not isinstance(value, list):
+            # Fast path for the common flat equality filter
+            tests.append(lambda doc, k=key, v=value: doc.get(k) == v or (isinstance(doc.get(k), list) and v in doc[k]))
+        else:
+            tests.append(lambda doc, k=key, v=value: v in _candidates(get_field(doc, k)))
+    if not tests:
+        return lambda doc: True
+    if len(tests) == 1:
+        return tests[0]
+    return lambda doc: all(test(doc) for test in tests)
+
+
+def _freeze(value: Any) -> Any:
+    """Hashable cache key for a query"""
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return ('__list__',) + tuple(_freeze(v) for v in value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ('__repr__', repr(value))
+
+
+def compile_query(query: Optional[Dict]) -> Predicate:
+    """Compile a Mongo-style filter into a predicate, reusing recently compiled ones.
+
+    Supports equality, $eq/$ne, $in/$nin, $gt/$gte/$lt/$lte, $exists,
+    $regex (+$options), $not and $and/$or/$nor, with dotted paths and
+    array fields matching if any element matches.
+    """
+    if not query:
+        return lambda doc: True
+    key = _freeze(query)
+    predicate = _COMPILED.get(key)
+    if predicate is None:
+        predicate = _build(query)
+        _COMPILED[key] = predicate
+        if len(_COMPILED) > _COMPILED_MAX:
+            _COMPILED.popitem(last=False)
+    else:
+        _COMPILED.move_to_end(key)
+    return predicate
+
+
+# ---------- Sort / skip / limit / projection ----------
+
+def normalize_sort(sort: SortSpec) -> List[Tuple[str, int]]:
+    """Accept "field", [("field", -1), ...] or {"field": -1}"""
+    if not sort:
+        return []
+    if isinstance(sort, str):
+        return [(sort, 1)]
+    if isinstance(sort, dict):
+        return list(sort.items())
+    return [(field, direction) for field, direction in sort]
+
+
+_TYPE_RANK = {type(None): 0, int: 1, float: 1, bool: 1, str: 2, dict: 3, list: 4}
+
+
+def _sort_value(value: Any) -> Tuple:
+    """Order values like Mongo does: missing/null < numbers < strings < objects < arrays"""
+    if value is MISSING or value is None:
+        return (0, 0)
+    rank = _TYPE_RANK.get(type(value), 5)
+    if rank >= 3:
+        return (rank, str(value))
+    return (rank, value)
+
+
+def sort_key(sort: List[Tuple[str, int]]) -> Callable[[Dict], Tuple]:
+    fields = [field for field, _ in sort]
+    return lambda doc: tuple(_sort_value(get_field(doc, field)) for field in fields)
+
+
+def apply_sort(docs: Iterable[Dict], sort: SortSpec, skip: int = 0, limit: Optional[int] = None) -> List[Dict]:
+    """Sort (stable) and then skip/limit, keeping only skip+limit documents in memory when possible"""
+    sort = normalize_sort(sort)
+    skip = skip or 0
+    if not sort:
+        end = skip + limit if limit else None
+        return list(itertools.islice(docs, skip, end))
+
+    directions = {direction for _, direction in sort}
+    if limit and len(directions) == 1:
+        # Single pass with a bounded heap instead of sorting everything
+        key = sort_key(sort)
+        pick = heapq.nlargest if directions == {-1} else heapq.nsmallest
+        return pick(skip + limit, docs, key=key)[skip:]
+
+    ordered = list(docs)
+    for field, direction in reversed(sort):
+        ordered.sort(key=sort_key([(field, direction)]), reverse=direction == -1)
+    end = skip + limit if limit else None
+    return ordered[skip:end]
+
+
+def apply_projection(doc: Dict, projection: Optional[Dict]) -> Dict:
+    """Return a projected copy: {"field": 1} keeps fields (plus id), {"field": 0} drops them"""
+    if not projection:
+        return doc
+    include = {k for k, v in projection.items() if v and k not in ('_id',)}
+    if include:
+        result = {k: doc[k] for k in include if k in doc}
+        if projection.get('_id', 1):
+            for key in ('id', '_id'):
+                if key in doc:
+                    result[key] = doc[key]
+        return result
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
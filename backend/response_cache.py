@@ -0,0 +1,100 @@
+"""
+Response cache for hot read endpoints
+Keeps responses as pre-encoded JSON bytes with a strong ETag, answers
+If-None-Match with 304 and drops exactly the entries a document write affects
+"""
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Callable, Awaitable, Tuple
+
+from fastapi import Request, Response
+
+from blob_codec import dumps
+from query_engine import compile_query
+
+# Seconds a cached response is served without asking the database; writes made
+# by this process invalidate right away, this bounds staleness from other instances
+CATALOG_CACHE_TTL = float(os.environ.get('CATALOG_CACHE_TTL', '60'))
+CATALOG_CACHE_ENTRIES = int(os.environ.get('CATALOG_CACHE_ENTRIES', '256'))
+
+
+class CachedResponse:
+    """An encoded response, the ids of the documents in it and the query it lists"""
+
+    __slots__ = ('body', 'etag', 'ids', 'matches', 'expires')
+
+    def __init__(self, body: bytes, ids: List[str], query: Optional[Dict], lists: bool, ttl: float):
+        self.body = body
+        # Content hash: unchanged content keeps its ETag across rebuilds and instances
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.ids = frozenset(ids)
+        # A listing is also affected by a document that starts matching its query
+        self.matches = compile_query(query) if lists else None
+        self.expires = time.monotonic() + ttl
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match check (weak comparison, as the header requires)"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in header.split(','))
+
+
+class ResponseCache:
+    """LRU of encoded responses keyed by endpoint and normalized parameters.
+
+    load() returns (payload, ids of the documents in it). A write calls
+    invalidate(doc_id, doc) and drops only the entries holding that document
+    or listing a query its new version matches; a load that raced with a
+    write is not stored.
+    """
+
+    def __init__(self, ttl: float = CATALOG_CACHE_TTL, max_entries: int = CATALOG_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[Any, CachedResponse]' = OrderedDict()
+        self._version = 0
+
+    def _get(self, key: Any) -> Optional[CachedResponse]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    async def respond(self, request: Request, key: Any, load: Callable[[], Awaitable[Tuple[Dict, List[str]]]],
+                      query: Optional[Dict] = None, lists: bool = False,
+                      encode: Callable[[Dict], bytes] = dumps) -> Response:
+        """The cached response for key (304 when the client has it), loading it on a miss.
+
+        query is what a listing selects (with lists=True), used to invalidate
+        it when a matching document is written; encode turns the payload into
+        the response body.
+        """
+        entry = self._get(key)
+        if entry is None:
+            version = self._version
+            payload, ids = await load()
+            entry = CachedResponse(encode(payload), ids, query, lists, self.ttl)
+            if version == self._version:
+                self.entries[key] = entry
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+        if _etag_matches(request.headers.get("if-none-match"), entry.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+
+    def invalidate(self, doc_id: str, doc: Optional[Dict] = None):
+        """Drop the entries a write to doc_id affects (doc is its new version, None if deleted)"""
+        self._version += 1
+        for key, entry in list(self.entries.items()):
+            if doc_id in entry.ids or (doc is not None and entry.matches is not None and entry.matches(doc)):
+                del self.entries[key]
@@ -0,0 +1,345 @@
+"""
+Full-text product search
+In-process inverted index over product name, description and category with
+Spanish accent folding, light stemming, prefix matching for type-ahead and
+relevance ranking; kept up to date document by document
+"""
+import os
+import re
+import math
+import time
+import asyncio
+import bisect
+import heapq
+import unicodedata
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Iterable, Tuple, Callable, Awaitable
+
+# Field weights: a match in the name counts most
+SEARCH_FIELDS = {"name": 3.0, "category": 2.0, "description": 1.0}
+# Shortest query word that is also matched as a prefix, and how many index terms it may expand to
+SEARCH_MIN_PREFIX = 2
+SEARCH_MAX_EXPANSIONS = 20
+# A prefix match scores less than the whole word
+PREFIX_WEIGHT = 0.6
+# Queries whose rarest word matches at most this many products score every match directly;
+# otherwise matching runs on bitmaps of the terms, of which this many are cached
+SEARCH_SCAN_LIMIT = 2000
+SEARCH_BITMAP_CACHE = 1024
+# Seconds before the index is rebuilt from the database (picks up writes made by other instances)
+SEARCH_INDEX_TTL = int(os.environ.get('SEARCH_INDEX_TTL', '300'))
+
+_WORD = re.compile(r"[a-z0-9]+")
+# Words too common to search for (accents already folded)
+STOPWORDS = frozenset([
+    "a", "al", "con", "de", "del", "el", "en", "la", "las", "lo", "los", "o", "para", "por", "se",
+    "sin", "su", "sus", "u", "un", "una", "unas", "unos", "y",
+])
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents ("Bujía" -> "bujia", "ñ" -> "n")"""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def stem(word: str) -> str:
+    """Light Spanish stemmer: drops plural endings, then a final gender vowel.
+
+    "bujías", "bujia" -> "buji"; "filtros", "filtro" -> "filtr";
+    "luces" -> "luz"; "motores" -> "motor". Short words and numbers are kept.
+    """
+    if len(word) <= 3 or word.isdigit():
+        return word
+    if word.endswith("ces"):
+        word = word[:-3] + "z"
+    elif word.endswith("es") and len(word) > 4 and word[-3] not in "aeiou":
+        word = word[:-2]
+    elif word.endswith("s"):
+        word = word[:-1]
+    if len(word) > 3 and word[-1] in "aoe":
+        word = word[:-1]
+    return word
+
+
+def tokenize(text: Any) -> List[str]:
+    """Stemmed search terms of a text, without stopwords"""
+    if not text:
+        return []
+    return [stem(word) for word in _WORD.findall(fold(str(text))) if word not in STOPWORDS]
+
+
+def _to_bitmap(numbers: Iterable[int], size: int) -> int:
+    """Int with bit n set for every number n"""
+    buffer = bytearray((size >> 3) + 1)
+    for number in numbers:
+        buffer[number >> 3] |= 1 << (number & 7)
+    return int.from_bytes(buffer, "little")
+
+
+class SearchIndex:
+    """Inverted index over the searchable fields of the products.
+
+    Every indexed product gets a number, increasing with each add. A
+    product's weight for a term is the sum of the weights of the fields the
+    term appears in, so a term's postings split into a few groups by
+    weight: term -> {weight: {number: None}}. Queries match every word
+    (AND); the last word also matches as a prefix of longer terms unless
+    the query ends with a space. A product scores the sum over query words
+    of weight x idf; equal scores rank the most recently indexed first.
+
+    Queries with a rare word score that word's products directly. When
+    every word is common, matching and counting are AND/OR/popcount on
+    bitmaps (Python ints, bit n = product number n) built per term on first
+    use and cached, and ranking walks combinations of one weight group per
+    word from the best score down until the page is full. add/remove only
+    touch the postings (and cached bitmaps) of one product's terms.
+    """
+
+    def __init__(self, products: Iterable[Dict] = None):
+        self.postings: Dict[str, Dict[float, Dict[int, None]]] = {}
+        self.df: Dict[str, int] = {}
+        self.terms: List[str] = []  # sorted, for prefix lookups
+        self.docs: Dict[int, Dict] = {}
+        self._numbers: Dict[str, int] = {}
+        self._doc_terms: Dict[int, Dict[str, float]] = {}
+        self._next_number = 0
+        self._bitmaps: 'OrderedDict[Tuple[str, Optional[float]], int]' = OrderedDict()
+        # Oldest first, so ties favour newer products (ids are time-ordered)
+        self._bulk = True
+        for product in sorted(products or [], key=lambda product: str(product.get("id"))):
+            self.add(product)
+        self._bulk = False
+        self.terms = sorted(self.postings)
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def add(self, product: Dict):
+        """Index a product, replacing its previous version"""
+        doc_id = product.get("id")
+        if doc_id is None:
+            return
+        doc_id = str(doc_id)
+        weights: Dict[str, float] = {}
+        for field, weight in SEARCH_FIELDS.items():
+            for term in set(tokenize(product.get(field))):
+                weights[term] = weights.get(term, 0.0) + weight
+        self.remove(doc_id)
+        number = self._next_number
+        self._next_number += 1
+        for term, weight in weights.items():
+            groups = self.postings.get(term)
+            if groups is None:
+                groups = self.postings[term] = {}
+                self.df[term] = 0
+                if not self._bulk:
+                    bisect.insort(self.terms, term)
+            groups.setdefault(weight, {})[number] = None
+            self.df[term] += 1
+            self._invalidate(term, weight)
+        self._numbers[doc_id] = number
+        self._doc_terms[number] = weights
+        self.docs[number] = product
+
+    def remove(self, doc_id: str):
+        """Drop a product from the index"""
+        number = self._numbers.pop(str(doc_id), None)
+        if number is None:
+            return
+        del self.docs[number]
+        for term, weight in self._doc_terms.pop(number).items():
+            groups = self.postings[term]
+            del groups[weight][number]
+            if not groups[weight]:
+                del groups[weight]
+            self.df[term] -= 1
+            self._invalidate(term, weight)
+            if not self.df[term]:
+                del self.postings[term], self.df[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+
+    def _invalidate(self, term: str, weight: float):
+        if self._bitmaps:
+            self._bitmaps.pop((term, weight), None)
+            self._bitmaps.pop((term, None), None)
+
+    def _bitmap(self, term: str, weight: Optional[float] = None) -> int:
+        """Bitmap of the products with term (in the given weight group), cached"""
+        key = (term, weight)
+        bitmap = self._bitmaps.get(key)
+        if bitmap is not None:
+            self._bitmaps.move_to_end(key)
+            return bitmap
+        if weight is None:
+            bitmap = 0
+            for group_weight in self.postings[term]:
+                bitmap |= self._bitmap(term, group_weight)
+        else:
+            bitmap = _to_bitmap(self.postings[term][weight], self._next_number)
+        self._bitmaps[key] = bitmap
+        if len(self._bitmaps) > SEARCH_BITMAP_CACHE:
+            self._bitmaps.popitem(last=False)
+        return bitmap
+
+    def _expand(self, prefix: str) -> List[str]:
+        """Index terms starting with prefix (the most frequent ones if there are too many)"""
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\uffff", start)
+        if end - start > SEARCH_MAX_EXPANSIONS:
+            return heapq.nlargest(SEARCH_MAX_EXPANSIONS, self.terms[start:end], key=self.df.__getitem__)
+        return self.terms[start:end]
+
+    def _groups(self, term: str, prefix: bool) -> List[Tuple[float, Dict[int, None], str, float]]:
+        """(score, products, index term, weight) groups a query word matches, best first"""
+        terms = [(term, 1.0)] if term in self.postings else []
+        if prefix and len(term) >= SEARCH_MIN_PREFIX:
+            terms += [(other, PREFIX_WEIGHT) for other in self._expand(term) if other != term]
+        total = len(self.docs)
+        groups = []
+        for other, multiplier in terms:
+            idf = math.log(1 + total / self.df[other]) * multiplier
+            groups.extend((weight * idf, docs, other, weight) for weight, docs in self.postings[other].items())
+        groups.sort(key=lambda group: -group[0])
+        return groups
+
+    def _top(self, words: List[List[Tuple[float, Dict[int, None], str, float]]], limit: int) -> List[int]:
+        """The best limit products matching every word: combinations of one group per word
+        are visited from the best score down, each intersected as bitmaps"""
+        found: List[int] = []
+        seen = 0
+        start = (0,) * len(words)
+        heap = [(-sum(groups[0][0] for groups in words), start)]
+        visited = {start}
+        while heap and len(found) < limit:
+            negative_score, combination = heapq.heappop(heap)
+            bits = ~seen
+            for i, g in enumerate(combination):
+                _, _, term, weight = words[i][g]
+                bits &= self._bitmap(term, weight)
+            while bits and len(found) < limit:
+                # Highest number first: the most recently indexed product
+                number = bits.bit_length() - 1
+                bits ^= 1 << number
+                seen |= 1 << number
+                found.append(number)
+            for i, g in enumerate(combination):
+                if g + 1 < len(words[i]):
+                    following = combination[:i] + (g + 1,) + combination[i + 1:]
+                    if following not in visited:
+                        visited.add(following)
+                        score = -negative_score - words[i][g][0] + words[i][g + 1][0]
+                        heapq.heappush(heap, (-score, following))
+        return found
+
+    def search(self, query: str, limit: Optional[int] = 20) -> Tuple[List[Dict], int]:
+        """Best matching products for a query, best first, and the number of matches"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        prefix = bool(terms) and not query[-1:].isspace()
+        if prefix and len(terms[-1]) < SEARCH_MIN_PREFIX and len(terms) > 1:
+            # A word still being typed that is too short to expand is left out
+            terms.pop()
+            prefix = False
+        if not terms:
+            return [], 0
+        words = [self._groups(term, prefix and i == len(terms) - 1) for i, term in enumerate(terms)]
+        if not all(words):
+            return [], 0
+        # Rarest word first: its products bound the work
+        words.sort(key=lambda groups: sum(len(docs) for _, docs, _, _ in groups))
+        if len(words) == 1 and len({term for _, _, term, _ in words[0]}) == 1:
+            # A single term: its groups are disjoint, best first, newest first within each
+            total = self.df[words[0][0][2]]
+            found = []
+            for _, docs, _, _ in words[0]:
+                for number in reversed(docs):
+                    if len(found) == (limit or total):
+                        break
+                    found.append(number)
+            return [self.docs[number] for number in found], total
+        if sum(len(docs) for _, docs, _, _ in words[0]) > SEARCH_SCAN_LIMIT:
+            matches = -1
+            for groups in words:
+                word_bits = 0
+                for term in {term for _, _, term, _ in groups}:
+                    word_bits |= self._bitmap(term)
+                matches &= word_bits
+            total = matches.bit_count()
+            found = self._top(words, min(limit or total, total))
+            return [self.docs[number] for number in found], total
+        scores = {}
+        for number in {number for _, docs, _, _ in words[0] for number in docs}:
+            score = 0.0
+            for groups in words:
+                # Groups are sorted best first: the first one holding the product is its score
+                best = next((group_score for group_score, docs, _, _ in groups if number in docs), None)
+                if best is None:
+                    break
+                score += best
+            else:
+                scores[number] = score
+        ranked = heapq.nlargest(limit or len(scores), scores.items(), key=lambda item: (item[1], item[0]))
+        return [self.docs[number] for number, _ in ranked], len(scores)
+
+
+class ProductSearch:
+    """The live search index of the catalog.
+
+    Built from load() on the first search, then kept current by apply()
+    for every product write of this process. After SEARCH_INDEX_TTL
+    seconds it is rebuilt in the background while searches keep using the
+    current index; writes applied during a rebuild are replayed on the new one.
+    """
+
+    def __init__(self, load: Callable[[], Awaitable[List[Dict]]], ttl: int = SEARCH_INDEX_TTL):
+        self.load = load
+        self.ttl = ttl
+        self.index: Optional[SearchIndex] = None
+        self._built_at = 0.0
+        self._building: Optional[asyncio.Task] = None
+        self._changes: Optional[List[Tuple[str, Optional[Dict]]]] = None
+
+    async def _build(self) -> SearchIndex:
+        self._changes = []
+        try:
+            products = await self.load()
+            # Tokenizing the catalog is CPU work: keep it off the event loop
+            index = await asyncio.get_running_loop().run_in_executor(None, SearchIndex, products)
+            for product_id, product in self._changes:
+                _apply(index, product_id, product)
+            self.index = index
+            self._built_at = time.monotonic()
+            print(f"Search index built: {len(index)} products, {len(index.terms)} terms")
+            return index
+        finally:
+            self._changes = None
+
+    def _built(self, task: asyncio.Task):
+        self._building = None
+        if not task.cancelled() and task.exception() is not None:
+            print(f"WARNING: Search index build failed: {task.exception()}")
+
+    async def get(self) -> SearchIndex:
+        """The index, building it if there is none yet"""
+        if self.index is not None and time.monotonic() - self._built_at < self.ttl:
+            return self.index
+        if self._building is None:
+            self._building = asyncio.get_running_loop().create_task(self._build())
+            self._building.add_done_callback(self._built)
+        if self.index is not None:
+            return self.index
+        return await asyncio.shield(self._building)
+
+    def apply(self, product_id: str, product: Optional[Dict]):
+        """Apply a product write (product None when it was deleted)"""
+        if self._changes is not None:
+            self._changes.append((product_id, product))
+        if self.index is not None:
+            _apply(self.index, product_id, product)
+
+
+def _apply(index: SearchIndex, product_id: str, product: Optional[Dict]):
+    if product is None:
+        index.remove(product_id)
+    else:
+        index.add(product)
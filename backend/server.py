@@ -1,15 +1,16 @@
 import os
 from datetime import datetime, timezone, timedelta
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 from io import BytesIO
 import json
+import base64
 import re
 import random
 import string
 
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel, Field, EmailStr
 from passlib.context import CryptContext
 from jose import jwt, JWTError
@@ -20,20 +21,29 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 
 from db_adapter import get_database, IS_VERCEL
+from search_index import ProductSearch
+from response_cache import ResponseCache
+from fast_json import FAST_JSON, STREAM_BATCH, DEFAULT_RESPONSE_CLASS, CompressionMiddleware, encode_list, encode_payload, encode_items
 
 # Environment variables
 JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "autoparts_secret_key_2024")
 JWT_ALGORITHM = os.environ.get("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", "1440"))
+# Largest page the list endpoints return for ?limit=
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "200"))
 
 # Database
 db = get_database()
 
+# Product full-text search and encoded catalog responses, kept current by the product endpoints
+product_search = ProductSearch(lambda: db.find('products'))
+catalog_cache = ResponseCache()
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # FastAPI app
-app = FastAPI(title="AutoParts E-commerce API", version="1.0.0")
+app = FastAPI(title="AutoParts E-commerce API", version="1.0.0", default_response_class=DEFAULT_RESPONSE_CLASS)
 
 # CORS
 app.add_middleware(
@@ -44,6 +54,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# gzip/brotli for large responses, when RESPONSE_COMPRESSION is set
+app.add_middleware(CompressionMiddleware)
+
 # ============== PYDANTIC MODELS ==============
 
 class UserRegister(BaseModel):
@@ -193,6 +206,91 @@ def get_now():
 def generate_order_id(prefix: str = "ORD"):
     return f"{prefix}-{datetime.now().strftime('%Y%m%d')}-{''.join(random.choices(string.ascii_uppercase + string.digits, k=6))}"
 
+def encode_cursor(doc: Dict) -> str:
+    """Opaque cursor for the page after doc"""
+    return base64.urlsafe_b64encode(json.dumps({"id": doc["id"]}).encode()).decode().rstrip("=")
+
+def page_query(query: Dict, cursor: Optional[str]) -> Optional[Dict]:
+    """List query restricted to the documents after cursor (lists are sorted by id, newest first)"""
+    if cursor:
+        try:
+            last_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["id"]
+        except Exception:
+            raise HTTPException(status_code=400, detail="Cursor inválido")
+        query = {**(query or {}), "id": {"$lt": last_id}}
+    return query or None
+
+async def find_page(collection: str, query: Dict, limit: Optional[int], cursor: Optional[str]) -> Tuple[List[Dict], Optional[str]]:
+    """One page of a list endpoint and the cursor of the next one (None on the last page).
+
+    One document more than the page is fetched to tell whether another page follows.
+    """
+    docs = await db.find(collection, page_query(query, cursor), sort=[("id", -1)], limit=limit + 1 if limit else None)
+    if limit and len(docs) > limit:
+        del docs[limit:]
+        return docs, encode_cursor(docs[-1])
+    return docs, None
+
+def product_written(product_id: str, product: Optional[Dict]):
+    """Update the search index and the catalog cache after a product write (product None when deleted)"""
+    product_search.apply(product_id, product)
+    catalog_cache.invalidate(product_id, product)
+
+async def prefetch(docs):
+    """Fetch the first document of an async iterator before a response starts, so a database error still answers 500.
+
+    Returns an async iterator over every document, the prefetched one first.
+    """
+    try:
+        first = await docs.__anext__()
+    except StopAsyncIteration:
+        return docs
+    
+    async def chained():
+        try:
+            yield first
+            async for doc in docs:
+                yield doc
+        finally:
+            await docs.aclose()
+    return chained()
+
+async def stream_list_response(key: str, docs, limit: Optional[int] = None):
+    """Stream {"<key>": [...], "next_cursor": ..., "success": true} from an async iterator, as it is iterated.
+
+    With a limit, docs must yield up to limit + 1 documents; the extra one only signals a next page.
+    The status line is already sent when a later database error happens, so the body then ends with
+    "success": false and a "detail" instead of being cut off; "success" goes last for that reason.
+    """
+    yield f'{{"{key}": ['.encode()
+    # The typed serializer works on batches; the plain path streams document by document
+    batch_size = STREAM_BATCH if FAST_JSON else 1
+    batch = []
+    count = 0
+    more = False
+    try:
+        async for doc in docs:
+            if limit and count == limit:
+                more = True
+                break
+            batch.append(doc)
+            last = doc
+            count += 1
+            if len(batch) == batch_size:
+                yield (b"," if count > len(batch) else b"") + encode_items(key, batch)
+                batch = []
+        if batch:
+            yield (b"," if count > len(batch) else b"") + encode_items(key, batch)
+        if more:
+            # Release the database cursor behind the extra document
+            await docs.aclose()
+    except Exception as e:
+        print(f"Error streaming {key}: {e}")
+        yield f'], "next_cursor": null, "success": false, "detail": "La lista está incompleta por un error de la base de datos"}}'.encode()
+        return
+    next_cursor = encode_cursor(last) if more else None
+    yield f'], "next_cursor": {json.dumps(next_cursor)}, "success": true}}'.encode()
+
 # ============== SEED DATA ==============
 
 async def seed_initial_data():
@@ -407,8 +505,14 @@ async def seed_initial_data():
 # Startup event
 @app.on_event("startup")
 async def startup_event():
+    await db.ensure_indexes()
     await seed_initial_data()
 
+# Shutdown event
+@app.on_event("shutdown")
+async def shutdown_event():
+    await db.close()
+
 # ============== AUTH ENDPOINTS ==============
 
 @app.post("/api/auth/register", response_model=TokenResponse)
@@ -474,33 +578,47 @@ async def login(credentials: UserLogin):
 
 @app.get("/api/products")
 async def get_products(
+    request: Request,
     category: Optional[str] = None,
     sale_type: Optional[str] = None,
-    featured: Optional[bool] = None
+    featured: Optional[bool] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
 ):
     query = {}
     if category and category != "all":
         query["category"] = category
     if featured is not None:
         query["featured"] = featured
-    
-    products = await db.find('products', query if query else None)
-    
-    # Filter by sale_type
     if sale_type and sale_type != "all":
-        products = [p for p in products if p.get('sale_type') == sale_type or p.get('sale_type') == 'both']
+        query["sale_type"] = {"$in": [sale_type, "both"]}
     
-    # Sort by created_at desc
-    products.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+    async def load():
+        products, next_cursor = await find_page('products', query, limit, cursor)
+        return {"success": True, "products": products, "next_cursor": next_cursor}, [p["id"] for p in products]
     
-    return {"success": True, "products": products}
+    key = ("products", json.dumps(query, sort_keys=True), limit, cursor)
+    return await catalog_cache.respond(request, key, load, page_query(query, cursor), lists=True,
+                                       encode=lambda payload: encode_payload("products", payload))
+
+@app.get("/api/products/search")
+async def search_products(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE)
+):
+    index = await product_search.get()
+    products, total = index.search(q, limit)
+    return {"success": True, "products": products, "total": total}
 
 @app.get("/api/products/{product_id}")
-async def get_product(product_id: str):
-    product = await db.find_one('products', {"id": product_id})
-    if not product:
-        raise HTTPException(status_code=404, detail="Producto no encontrado")
-    return {"success": True, "product": product}
+async def get_product(request: Request, product_id: str):
+    async def load():
+        product = await db.find_one('products', {"id": product_id})
+        if not product:
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        return {"success": True, "product": product}, [product_id]
+    
+    return await catalog_cache.respond(request, ("product", product_id), load)
 
 @app.post("/api/products")
 async def create_product(product: ProductCreate):
@@ -509,65 +627,72 @@ async def create_product(product: ProductCreate):
     product_doc["updated_at"] = get_now()
     
     result = await db.insert_one('products', product_doc)
-    product_doc["id"] = result['inserted_id']
+    # A copy: the inserted dict can be the stored document itself (blob cache),
+    # and pymongo adds the ObjectId to it
+    product = {**product_doc, "id": result['inserted_id']}
+    product.pop("_id", None)
+    product_written(product["id"], product)
     
-    return {"success": True, "product": product_doc}
+    return {"success": True, "product": product}
 
 @app.put("/api/products/{product_id}")
 async def update_product(product_id: str, product: ProductUpdate):
     update_data = {k: v for k, v in product.model_dump().items() if v is not None}
     update_data["updated_at"] = get_now()
     
-    result = await db.update_one('products', {"id": product_id}, {"$set": update_data})
-    if result['matched_count'] == 0:
+    updated = await db.find_one_and_update('products', {"id": product_id}, {"$set": update_data})
+    if not updated:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
+    product_written(product_id, updated)
     
-    updated = await db.find_one('products', {"id": product_id})
     return {"success": True, "product": updated}
 
 @app.delete("/api/products/{product_id}")
 async def delete_product(product_id: str):
-    await db.delete_many('cart_items', {"product_id": product_id})
-    result = await db.delete_one('products', {"id": product_id})
-    if result['deleted_count'] == 0:
+    # Cascade to cart lines in the same batch: one upload per touched collection/segment
+    result = await db.bulk_write([
+        {"op": "delete_many", "collection": "cart_items", "filter": {"product_id": product_id}},
+        {"op": "delete_one", "collection": "products", "filter": {"id": product_id}},
+    ])
+    if result['collections']['products']['deleted_count'] == 0:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
+    product_written(product_id, None)
     return {"success": True, "message": "Producto eliminado correctamente"}
 
 # ============== CART ENDPOINTS ==============
 
 @app.get("/api/cart")
-async def get_cart(session_id: str = Query(...)):
-    items = await db.find('cart_items', {"session_id": session_id})
-    items.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    return {"success": True, "items": items}
+async def get_cart(
+    session_id: str = Query(...),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    items, next_cursor = await find_page('cart_items', {"session_id": session_id}, limit, cursor)
+    if FAST_JSON:
+        return Response(encode_list("items", items, next_cursor=next_cursor), media_type="application/json")
+    return {"success": True, "items": items, "next_cursor": next_cursor}
 
 @app.post("/api/cart")
 async def add_to_cart(item: CartItemCreate):
-    items = await db.find('cart_items', {
-        "session_id": item.session_id,
-        "product_id": item.product_id,
-        "sale_type": item.sale_type
-    })
-    existing = items[0] if items else None
-    
-    if existing:
-        new_qty = existing["quantity"] + item.quantity
-        await db.update_one(
-            'cart_items',
-            {"id": existing["id"]},
-            {"$set": {"quantity": new_qty, "updated_at": get_now()}}
-        )
-        updated = await db.find_one('cart_items', {"id": existing["id"]})
-        return {"success": True, "item": updated}
-    
-    item_doc = item.model_dump()
+    # Increment the existing line or create it, in one atomic operation
+    item_doc = item.model_dump(exclude={"quantity"})
     item_doc["created_at"] = get_now()
-    item_doc["updated_at"] = get_now()
     
-    result = await db.insert_one('cart_items', item_doc)
-    item_doc["id"] = result['inserted_id']
-    
-    return {"success": True, "item": item_doc}
+    updated = await db.find_one_and_update(
+        'cart_items',
+        {
+            "session_id": item.session_id,
+            "product_id": item.product_id,
+            "sale_type": item.sale_type
+        },
+        {
+            "$inc": {"quantity": item.quantity},
+            "$set": {"updated_at": get_now()},
+            "$setOnInsert": item_doc
+        },
+        upsert=True
+    )
+    return {"success": True, "item": updated}
 
 @app.put("/api/cart/{item_id}")
 async def update_cart_item(item_id: str, update: CartItemUpdate):
@@ -575,16 +700,15 @@ async def update_cart_item(item_id: str, update: CartItemUpdate):
         await db.delete_one('cart_items', {"id": item_id})
         return {"success": True, "message": "Item eliminado del carrito"}
     
-    result = await db.update_one(
+    updated = await db.find_one_and_update(
         'cart_items',
         {"id": item_id},
         {"$set": {"quantity": update.quantity, "updated_at": get_now()}}
     )
     
-    if result['matched_count'] == 0:
+    if not updated:
         raise HTTPException(status_code=404, detail="Item no encontrado")
     
-    updated = await db.find_one('cart_items', {"id": item_id})
     return {"success": True, "item": updated}
 
 @app.delete("/api/cart/{item_id}")
@@ -605,7 +729,9 @@ async def clear_cart(session_id: str):
 async def get_orders(
     status: Optional[str] = None,
     payment_status: Optional[str] = None,
-    source: Optional[str] = None
+    source: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
 ):
     query = {}
     if status:
@@ -615,9 +741,10 @@ async def get_orders(
     if source:
         query["source"] = source
     
-    orders = await db.find('orders', query if query else None)
-    orders.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    return {"success": True, "orders": orders}
+    # Streamed so large order lists are never held in memory as a whole
+    orders = db.iter_find('orders', page_query(query, cursor), sort=[("id", -1)], limit=limit + 1 if limit else None)
+    orders = await prefetch(orders)
+    return StreamingResponse(stream_list_response("orders", orders, limit), media_type="application/json")
 
 @app.get("/api/orders/{order_id}")
 async def get_order(order_id: str):
@@ -692,24 +819,27 @@ async def update_order(order_id: str, update: OrderUpdate):
     update_data = {k: v for k, v in update.model_dump().items() if v is not None}
     update_data["updated_at"] = get_now()
     
-    await db.update_one('orders', {"id": order["id"]}, {"$set": update_data})
-    
-    updated = await db.find_one('orders', {"id": order["id"]})
+    updated = await db.find_one_and_update('orders', {"id": order["id"]}, {"$set": update_data})
     return {"success": True, "order": updated}
 
 # ============== PDF GENERATION ==============
 
 @app.get("/api/orders/{order_id}/pdf")
 async def generate_order_pdf(order_id: str, doc_type: str = "ticket"):
-    order = await db.find_one('orders', {"order_id": order_id})
-    if not order:
-        order = await db.find_one('orders', {"id": order_id})
+    # Order and both config documents in one concurrent batch
+    order_by_number, order_by_id, company, bank = await db.multi_find([
+        {"op": "find_one", "collection": "orders", "query": {"order_id": order_id}},
+        {"op": "find_one", "collection": "orders", "query": {"id": order_id}},
+        {"op": "find_one", "collection": "config", "query": {"type": "company"}},
+        {"op": "find_one", "collection": "config", "query": {"type": "bank"}},
+    ])
+    order = order_by_number or order_by_id
     
     if not order:
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
     
-    company = await db.find_one('config', {"type": "company"}) or {}
-    bank = await db.find_one('config', {"type": "bank"}) or {}
+    company = company or {}
+    bank = bank or {}
     
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter, topMargin=0.5*inch, bottomMargin=0.5*inch)
@@ -842,9 +972,7 @@ async def update_bank_config(config: BankConfigUpdate):
     update_data["updated_at"] = get_now()
     update_data["type"] = "bank"
     
-    await db.update_one('config', {"type": "bank"}, {"$set": update_data}, upsert=True)
-    
-    updated = await db.find_one('config', {"type": "bank"})
+    updated = await db.find_one_and_update('config', {"type": "bank"}, {"$set": update_data}, upsert=True)
     return {"success": True, "config": updated}
 
 @app.get("/api/config/company")
@@ -858,18 +986,18 @@ async def update_company_config(config: CompanyConfigUpdate):
     update_data["updated_at"] = get_now()
     update_data["type"] = "company"
     
-    await db.update_one('config', {"type": "company"}, {"$set": update_data}, upsert=True)
-    
-    updated = await db.find_one('config', {"type": "company"})
+    updated = await db.find_one_and_update('config', {"type": "company"}, {"$set": update_data}, upsert=True)
     return {"success": True, "config": updated}
 
 # ============== CHATBOT ENDPOINTS ==============
 
 @app.get("/api/chatbot/responses")
-async def get_chatbot_responses():
-    responses = await db.find('chatbot_responses')
-    responses.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    return {"success": True, "responses": responses}
+async def get_chatbot_responses(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    responses, next_cursor = await find_page('chatbot_responses', None, limit, cursor)
+    return {"success": True, "responses": responses, "next_cursor": next_cursor}
 
 @app.post("/api/chatbot/responses")
 async def create_chatbot_response(response: ChatbotResponseCreate):
@@ -886,11 +1014,10 @@ async def update_chatbot_response(response_id: str, response: ChatbotResponseCre
     update_data = response.model_dump()
     update_data["updated_at"] = get_now()
     
-    result = await db.update_one('chatbot_responses', {"id": response_id}, {"$set": update_data})
-    if result['matched_count'] == 0:
+    updated = await db.find_one_and_update('chatbot_responses', {"id": response_id}, {"$set": update_data})
+    if not updated:
         raise HTTPException(status_code=404, detail="Respuesta no encontrada")
     
-    updated = await db.find_one('chatbot_responses', {"id": response_id})
     return {"success": True, "response": updated}
 
 @app.delete("/api/chatbot/responses/{response_id}")
@@ -929,10 +1056,12 @@ async def query_chatbot(message: dict):
 # ============== SUBSCRIBERS ENDPOINTS ==============
 
 @app.get("/api/subscribers")
-async def get_subscribers():
-    subscribers = await db.find('subscribers')
-    subscribers.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    return {"success": True, "subscribers": subscribers}
+async def get_subscribers(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    subscribers, next_cursor = await find_page('subscribers', None, limit, cursor)
+    return {"success": True, "subscribers": subscribers, "next_cursor": next_cursor}
 
 @app.post("/api/subscribers")
 async def create_subscriber(subscriber: SubscriberCreate):
@@ -953,23 +1082,29 @@ async def create_subscriber(subscriber: SubscriberCreate):
 
 @app.get("/api/stats")
 async def get_stats():
-    total_products = await db.count_documents('products')
-    total_orders = await db.count_documents('orders')
-    total_subscribers = await db.count_documents('subscribers', {"is_active": True})
-    
-    # Calculate revenue
-    paid_orders = await db.find('orders', {"payment_status": "paid"})
-    total_revenue = sum(o.get('total', 0) for o in paid_orders)
-    
-    # Orders by status
-    orders_by_status = {}
-    for status in ["pending", "paid", "shipped", "delivered", "cancelled"]:
-        orders_by_status[status] = await db.count_documents('orders', {"status": status})
-    
-    # Orders by source
-    orders_by_source = {}
-    for source in ["web", "mercadolibre", "marketplace"]:
-        orders_by_source[source] = await db.count_documents('orders', {"source": source})
+    statuses = ["pending", "paid", "shipped", "delivered", "cancelled"]
+    sources = ["web", "mercadolibre", "marketplace"]
+    # All queries in one concurrent batch; the latency is that of the slowest one.
+    # Per-value counts rather than one $group: they are index-only on Mongo and use the hash index buckets on blob
+    results = await db.multi_find([
+        {"op": "count", "collection": "products"},
+        {"op": "count", "collection": "orders"},
+        {"op": "count", "collection": "subscribers", "query": {"is_active": True}},
+        # Revenue
+        {"op": "aggregate", "collection": "orders", "pipeline": [
+            {"$match": {"payment_status": "paid"}},
+            {"$group": {"_id": None, "total": {"$sum": "$total"}}}
+        ]},
+    ] + [
+        {"op": "count", "collection": "orders", "query": {"status": status}} for status in statuses
+    ] + [
+        {"op": "count", "collection": "orders", "query": {"source": source}} for source in sources
+    ])
+    total_products, total_orders, total_subscribers, revenue = results[:4]
+    total_revenue = revenue[0]["total"] if revenue else 0
+    
+    orders_by_status = dict(zip(statuses, results[4:4 + len(statuses)]))
+    orders_by_source = dict(zip(sources, results[4 + len(statuses):]))
     
     return {
         "success": True,
@@ -983,6 +1118,11 @@ async def get_stats():
         }
     }
 
+@app.get("/api/stats/indexes")
+async def get_index_report():
+    report = await db.index_report()
+    return {"success": True, "indexes": report}
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "timestamp": get_now(), "database": "vercel_blob" if IS_VERCEL else "mongodb"}
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+AutoParts E-commerce Storage Benchmark
+Compares the JSON and binary record blob formats of the Vercel Blob adapter
+(parse time and memory for a cold lookup, a full scan and encoding),
+measures product search latency and the cost of each response encoding
+stage (JSON encoding and compression)
+"""
+
+import os
+import sys
+import time
+import random
+import json
+import argparse
+import tracemalloc
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, List, Callable, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import blob_codec  # noqa: E402
+from blob_codec import EncodedBody, RecordReader, loads  # noqa: E402
+from document_set import DocumentSet  # noqa: E402
+from search_index import SearchIndex  # noqa: E402
+import fast_json  # noqa: E402
+from fast_json import encode_list, compress  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+
+INDEXED_FIELDS = ['status', 'payment_status', 'source']
+
+PART_WORDS = ["bujía", "filtro", "aceite", "pastillas", "freno", "disco", "amortiguador", "correa", "tiempo", "bomba",
+              "agua", "gasolina", "radiador", "embrague", "kit", "sensor", "oxígeno", "bobina", "encendido", "rodamiento",
+              "rueda", "manguera", "termostato", "alternador", "arranque", "motor", "empacadura", "culata", "bases",
+              "soporte", "rótula", "terminal", "dirección", "muñón", "tripoide", "inyector", "relé", "bombillo", "faro",
+              "espejo", "retrovisor", "parachoques", "guardafango", "limpiaparabrisas", "batería", "cable", "bujías",
+              "filtros", "pistón", "anillos", "válvula", "árbol", "levas", "cigüeñal", "cojinete", "biela", "carter"]
+MODEL_WORDS = ["toyota", "corolla", "hilux", "yaris", "chevrolet", "aveo", "optra", "spark", "ford", "fiesta", "ka",
+               "explorer", "hyundai", "getz", "accent", "tucson", "kia", "rio", "picanto", "mitsubishi", "lancer",
+               "nissan", "sentra", "tiida", "renault", "logan", "twingo", "fiat", "palio", "siena", "mazda", "chery"]
+DETAIL_WORDS = ["delantero", "trasero", "izquierdo", "derecho", "superior", "inferior", "original", "reforzado",
+                "juego", "sincronizado", "estándar", "cerámica", "iridium", "platino", "sintético", "mineral"]
+SEARCH_QUERIES = ["bujia", "bujías iridium", "filtro aceite corolla", "pastillas freno delanteras", "amortiguador",
+                  "amortiguador trasero aveo", "bomba de agua", "kit tiempo", "buj", "fil", "amort", "rotula aveo",
+                  "sensor oxigeno toyota", "disco freno ", "valvula"]
+
+
+class BlobFormatBenchmark:
+    def __init__(self, sizes: List[int], seed: int = 42):
+        self.sizes = sizes
+        self.random = random.Random(seed)
+        self.results = []
+
+    def make_orders(self, count: int) -> List[Dict[str, Any]]:
+        """Synthetic orders shaped like the ones the API stores"""
+        start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        orders = []
+        for i in range(count):
+            items = [
+                {
+                    "product_id": f"prod-{self.random.randint(1, 500)}",
+                    "name": f"Repuesto {self.random.randint(1, 500)}",
+                    "price": round(self.random.uniform(5, 300), 2),
+                    "quantity": self.random.randint(1, 5),
+                    "sale_type": self.random.choice(["retail", "wholesale"]),
+                }
+                for _ in range(self.random.randint(1, 4))
+            ]
+            orders.append({
+                "id": f"{i:024x}",
+                "order_id": f"ORD-{i:08d}",
+                "customer_name": f"Cliente {i}",
+                "customer_email": f"cliente{i}@example.com",
+                "customer_phone": f"+58 412 {i % 10000000:07d}",
+                "shipping_address": {"city": "Caracas", "state": "Distrito Capital", "line1": f"Calle {i % 200}"},
+                "items": items,
+                "total": round(sum(item["price"] * item["quantity"] for item in items), 2),
+                "status": self.random.choice(["pending", "confirmed", "shipped", "delivered", "cancelled"]),
+                "payment_status": self.random.choice(["pending", "paid"]),
+                "source": self.random.choice(["web", "whatsapp", "instagram"]),
+                "created_at": (start + timedelta(minutes=i)).isoformat(),
+            })
+        return orders
+
+    def measure(self, func: Callable[[], Any]) -> Tuple[Any, float, float, float]:
+        """Run func twice: timed, then traced (tracing slows it down); returns (result, seconds, peak MB, retained MB)"""
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        tracemalloc.start()
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return result, elapsed, peak / 1024 / 1024, current / 1024 / 1024
+
+    def log_result(self, size: int, fmt: str, operation: str, seconds: float, peak_mb: float = None,
+                   retained_mb: float = None, detail: str = ""):
+        """Log one measurement"""
+        memory = f" peak {peak_mb:8.1f} MB  retained {retained_mb:8.1f} MB" if peak_mb is not None else ""
+        print(f"  {fmt:<8} {operation:<14} {seconds * 1000:10.1f} ms{memory}  {detail}")
+        self.results.append({
+            "documents": size,
+            "format": fmt,
+            "operation": operation,
+            "ms": round(seconds * 1000, 2),
+            "peak_mb": peak_mb,
+            "retained_mb": retained_mb,
+        })
+
+    def bench_format(self, size: int, fmt: str, orders: List[Dict], lookup_id: str):
+        binary = fmt == "records"
+        body = EncodedBody(orders, compression=None, binary=binary, index_fields=INDEXED_FIELDS)
+        content, seconds, peak, _ = self.measure(body.read)
+        self.log_result(size, fmt, "encode", seconds, peak, len(content) / 1024 / 1024, f"{len(content):,} bytes")
+
+        def open_set() -> DocumentSet:
+            if binary:
+                return DocumentSet.from_records(RecordReader(content), INDEXED_FIELDS)
+            return DocumentSet(loads(content), INDEXED_FIELDS)
+
+        # The loaded set is returned so "retained" is what the blob cache would hold
+        def lookup():
+            docs = open_set()
+            return docs, docs.get(lookup_id)
+
+        def indexed():
+            docs = open_set()
+            return docs, len(docs.candidates({"status": "cancelled", "source": "web"}))
+
+        (_, found), seconds, peak, retained = self.measure(lookup)
+        self.log_result(size, fmt, "cold find_one", seconds, peak, retained, "ok" if found else "NOT FOUND")
+
+        (_, matches), seconds, peak, retained = self.measure(indexed)
+        self.log_result(size, fmt, "cold indexed", seconds, peak, retained, f"{matches:,} candidates")
+
+        _, seconds, peak, retained = self.measure(lambda: sum(doc["total"] for doc in open_set()))
+        self.log_result(size, fmt, "full scan", seconds, peak, retained)
+
+    def run_all(self) -> int:
+        print("🚀 Blob format benchmark")
+        print(f"orjson: {'yes' if blob_codec.orjson is not None else 'no'}, "
+              f"msgpack: {'yes' if blob_codec.RECORDS_AVAILABLE else 'no'}")
+        formats = ["json"] + (["records"] if blob_codec.RECORDS_AVAILABLE else [])
+        for size in self.sizes:
+            print("\n" + "=" * 50)
+            print(f"📦 {size:,} documents")
+            orders = self.make_orders(size)
+            lookup_id = orders[size // 2]["id"]
+            for fmt in formats:
+                self.bench_format(size, fmt, orders, lookup_id)
+            del orders
+
+        if "records" not in formats:
+            print("\n❌ msgpack is not installed, only the JSON format was measured")
+            return 1
+        print("\n🎉 Benchmark complete")
+        return 0
+
+
+class SearchBenchmark:
+    def __init__(self, products: int, runs: int = 200, seed: int = 42):
+        self.products = products
+        self.runs = runs
+        self.random = random.Random(seed)
+
+    def make_products(self) -> List[Dict[str, Any]]:
+        """Synthetic catalog: part names from a skewed vocabulary, like a real one"""
+        rnd = self.random
+        part_weights = [1 / (i + 1) for i in range(len(PART_WORDS))]
+        products = []
+        for i in range(self.products):
+            parts = rnd.choices(PART_WORDS, part_weights, k=2)
+            model = rnd.choice(MODEL_WORDS)
+            detail = rnd.choice(DETAIL_WORDS)
+            products.append({
+                "id": f"{i:024x}",
+                "name": f"{' '.join(parts).capitalize()} {detail} {model.capitalize()} {rnd.randint(100, 99999)}",
+                "description": f"Repuesto {detail} para {model} {' '.join(rnd.sample(PART_WORDS, 6))}",
+                "category": rnd.choice(["motor", "frenos", "suspension", "electrico", "filtros", "enfriamiento"]),
+            })
+        return products
+
+    def run_all(self) -> int:
+        print("\n" + "=" * 50)
+        print(f"🔎 Product search, {self.products:,} products")
+        products = self.make_products()
+        started = time.perf_counter()
+        index = SearchIndex(products)
+        print(f"  build          {(time.perf_counter() - started) * 1000:10.1f} ms  {len(index.terms):,} terms")
+
+        started = time.perf_counter()
+        for product in products[:1000]:
+            index.add({**product, "name": product["name"] + " actualizado"})
+        print(f"  update         {(time.perf_counter() - started):10.3f} ms per product")
+
+        slow = 0
+        for query in SEARCH_QUERIES:
+            timings = []
+            for _ in range(self.runs):
+                started = time.perf_counter()
+                results, total = index.search(query)
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            mean = sum(timings) / len(timings) * 1000
+            p95 = timings[int(len(timings) * 0.95)] * 1000
+            slow += p95 >= 1
+            print(f"  {query!r:30} mean {mean:7.3f} ms  p95 {p95:7.3f} ms  {total:,} matches"
+                  f"{'  ⚠️' if p95 >= 1 else ''}")
+
+        if slow:
+            print(f"\n⚠️ {slow} queries over 1 ms (p95)")
+        return 0
+
+
+class ResponseBenchmark:
+    def __init__(self, orders: int, runs: int = 20, seed: int = 42):
+        self.orders = orders
+        self.runs = runs
+        self.random = random.Random(seed)
+
+    def make_orders(self) -> List[Dict[str, Any]]:
+        """Synthetic orders with the fields the API writes"""
+        rnd = self.random
+        start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        orders = []
+        for i in range(self.orders):
+            items = [
+                {
+                    "product_id": f"{rnd.randint(1, 5000):024x}",
+                    "product_name": f"{rnd.choice(PART_WORDS).capitalize()} {rnd.choice(MODEL_WORDS).capitalize()}",
+                    "quantity": rnd.randint(1, 5),
+                    "price": round(rnd.uniform(5, 300), 2),
+                    "sale_type": rnd.choice(["detal", "mayor"]),
+                }
+                for _ in range(rnd.randint(1, 4))
+            ]
+            created = (start + timedelta(minutes=i)).isoformat()
+            orders.append({
+                "id": f"{i:024x}",
+                "order_id": f"ORD-{i:08d}",
+                "customer_name": f"Cliente {i}",
+                "customer_email": f"cliente{i}@example.com",
+                "customer_phone": f"+58 412 {i % 10000000:07d}",
+                "items": items,
+                "total": round(sum(item["price"] * item["quantity"] for item in items), 2),
+                "shipping_address": {"street": f"Calle {i % 200}", "city": "Caracas", "state": "Distrito Capital",
+                                     "zip": "1010", "country": "Venezuela", "phone": ""},
+                "payment_method": "bank_transfer",
+                "source": rnd.choice(["web", "whatsapp", "instagram"]),
+                "notes": "",
+                "status": rnd.choice(["pending", "confirmed", "shipped", "delivered", "cancelled"]),
+                "payment_status": rnd.choice(["pending", "paid"]),
+                "created_at": created,
+                "updated_at": created,
+            })
+        return orders
+
+    def measure(self, func: Callable[[], Any]) -> Tuple[Any, float]:
+        """Mean seconds of func over the runs, with its last result"""
+        started = time.perf_counter()
+        for _ in range(self.runs):
+            result = func()
+        return result, (time.perf_counter() - started) / self.runs
+
+    def run_all(self) -> int:
+        print("\n" + "=" * 50)
+        print(f"📤 Response encoding, {self.orders:,} orders")
+        orders = self.make_orders()
+        payload = {"success": True, "orders": orders, "next_cursor": None}
+        stages = [
+            # FastAPI's default for a returned dict: jsonable_encoder, then json
+            ("default", lambda: json.dumps(jsonable_encoder(payload), ensure_ascii=False).encode()),
+            ("stream", lambda: b",".join(json.dumps(order, default=str, ensure_ascii=False).encode()
+                                         for order in orders)),
+            ("typed", lambda: encode_list("orders", orders, next_cursor=None)),
+        ]
+        if blob_codec.orjson is not None:
+            stages.insert(1, ("orjson", lambda: blob_codec.orjson.dumps(jsonable_encoder(payload))))
+        body = None
+        for name, func in stages:
+            body, seconds = self.measure(func)
+            print(f"  {name:<14} {seconds * 1000:10.1f} ms  {len(body):,} bytes")
+
+        codings = ["gzip"] + (["br"] if fast_json.brotli is not None else [])
+        for coding in codings:
+            compressed, seconds = self.measure(lambda: compress(body, coding))
+            print(f"  {coding:<14} {seconds * 1000:10.1f} ms  {len(compressed):,} bytes "
+                  f"({len(compressed) / len(body):.0%})")
+        if fast_json.brotli is None:
+            print("\n⚠️ brotli is not installed, only gzip was measured")
+        return 0
+
+
+def main():
+    """Main benchmark runner"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--suite", choices=["formats", "search", "responses", "all"], default="all",
+                        help="what to measure (default: all)")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated document counts for the format benchmark (default: 10000,100000,1000000)")
+    parser.add_argument("--products", type=int, default=100000,
+                        help="catalog size for the search benchmark (default: 100000)")
+    parser.add_argument("--orders", type=int, default=10000,
+                        help="orders in the response encoding benchmark (default: 10000)")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    status = 0
+    if args.suite in ("formats", "all"):
+        status |= BlobFormatBenchmark(sizes).run_all()
+    if args.suite in ("search", "all"):
+        status |= SearchBenchmark(args.products).run_all()
+    if args.suite in ("responses", "all"):
+        status |= ResponseBenchmark(args.orders).run_all()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
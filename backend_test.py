@@ -156,6 +156,32 @@ class AutoPartsAPITester:
         self.log_test("Products Filter by Featured", success, 
                      f"Featured products: {len(featured_products)}")
 
+    def test_products_search(self):
+        """Test product search"""
+        success, data = self.make_request('GET', 'products')
+        products = data.get('products', []) if success else []
+        
+        if not products:
+            self.log_test("Products Search", False, "No products available for search testing")
+            return
+        
+        test_product = products[0]
+        query = test_product['name'].split()[0]
+        success, data = self.make_request('GET', 'products/search', {'q': query})
+        found = [product['id'] for product in data.get('products', [])] if success else []
+        self.log_test("Products Search", success and data.get('total', 0) >= 1 and len(found) <= 20,
+                     f"'{query}': {data.get('total')} matches")
+        
+        # Prefix of the word, as while typing
+        success, data = self.make_request('GET', 'products/search', {'q': query[:3], 'limit': 100})
+        found = [product['id'] for product in data.get('products', [])] if success else []
+        self.log_test("Products Search Prefix", success and test_product['id'] in found,
+                     f"'{query[:3]}': {data.get('total')} matches")
+        
+        # The query is required
+        success, data = self.make_request('GET', 'products/search', expected_status=422)
+        self.log_test("Products Search Without Query", success, f"Response: {data}")
+
     def test_cart_operations(self):
         """Test cart operations"""
         # Get products first
@@ -258,6 +284,30 @@ class AutoPartsAPITester:
                                             {'status': 'paid', 'payment_status': 'paid'})
             self.log_test("Update Order Status", success, "Order marked as paid")
 
+    def test_pagination(self):
+        """Test cursor pagination of the list endpoints"""
+        for endpoint, key in [('products', 'products'), ('orders', 'orders'), ('subscribers', 'subscribers')]:
+            success, data = self.make_request('GET', endpoint)
+            full = [item['id'] for item in data.get(key, [])] if success else []
+            
+            paged, cursor, pages = [], None, 0
+            while success:
+                params = {'limit': 2, **({'cursor': cursor} if cursor else {})}
+                success, data = self.make_request('GET', endpoint, params)
+                if not success or len(data.get(key, [])) > 2:
+                    success = False
+                    break
+                paged += [item['id'] for item in data[key]]
+                pages += 1
+                cursor = data.get('next_cursor')
+                if not cursor:
+                    break
+            self.log_test(f"Paginate {endpoint.capitalize()}", success and paged == full,
+                         f"{pages} pages, {len(paged)} of {len(full)} items")
+            
+            success, data = self.make_request('GET', endpoint, {'cursor': 'invalid!'}, expected_status=400)
+            self.log_test(f"Invalid Cursor {endpoint.capitalize()}", success, f"Response: {data}")
+
     def test_external_orders(self):
         """Test external order creation"""
         external_order = {
@@ -381,6 +431,7 @@ class AutoPartsAPITester:
         # Product tests
         self.test_products_list()
         self.test_products_filtering()
+        self.test_products_search()
         
         # Cart tests
         self.test_cart_operations()
@@ -389,6 +440,9 @@ class AutoPartsAPITester:
         self.test_orders_operations()
         self.test_external_orders()
         
+        # Pagination tests
+        self.test_pagination()
+        
         # Configuration tests
         self.test_config_operations()
         
@@ -50,6 +50,12 @@ export const api = {
       const data = await handleResponse(response);
       return data.products || [];
     },
+    async search(q, params = {}) {
+      const queryString = new URLSearchParams({ ...params, q }).toString();
+      const response = await fetch(`${getBaseUrl()}/api/products/search?${queryString}`);
+      const data = await handleResponse(response);
+      return data.products || [];
+    },
     async get(id) {
       const response = await fetch(`${getBaseUrl()}/api/products/${id}`);
       const data = await handleResponse(response);
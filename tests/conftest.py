@@ -0,0 +1,126 @@
+"""
+Shared fixtures: backend modules on the path and an in-memory Vercel Blob store
+"""
+import os
+import sys
+import json
+import hashlib
+import collections
+from typing import Dict, List, Tuple
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import db_adapter  # noqa: E402
+
+BLOB_TOKEN = 'vercel_blob_rw_STOREID_secret'
+API_URL = 'https://blob.vercel-storage.com'
+PUBLIC_URL = 'https://storeid.public.blob.vercel-storage.com'
+
+
+class FakeBlobStore:
+    """Vercel Blob API in memory: list, conditional GET/PUT and delete.
+
+    fail(path) makes the next downloads of path answer with an error status,
+    to simulate a transient storage failure.
+    """
+
+    def __init__(self):
+        self.files: Dict[str, Tuple[bytes, str, str]] = {}  # pathname -> (content, etag, uploadedAt)
+        self.calls = collections.Counter()
+        self.downloads: List[str] = []
+        self.failures: Dict[str, list] = {}
+        self._tick = 0
+
+    def client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+
+    def fail(self, path: str, status: int = 503, times: int = 1):
+        self.failures.setdefault(path, []).extend([status] * times)
+
+    def put(self, path: str, content: bytes):
+        self._tick += 1
+        etag = '"' + hashlib.md5(content + str(self._tick).encode()).hexdigest() + '"'
+        uploaded_at = f"2026-01-01T00:00:{self._tick:06d}Z"
+        self.files[path] = (content, etag, uploaded_at)
+        return etag, uploaded_at
+
+    def read(self, path: str):
+        return json.loads(self.files[path][0])
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        path = request.url.path.lstrip('/')
+        if url.startswith(PUBLIC_URL):
+            self.calls['get'] += 1
+            self.downloads.append(path)
+            if self.failures.get(path):
+                return httpx.Response(self.failures[path].pop(0))
+            stored = self.files.get(path)
+            if stored is None:
+                return httpx.Response(404)
+            if request.headers.get('if-none-match') == stored[1]:
+                return httpx.Response(304, headers={'etag': stored[1]})
+            return httpx.Response(200, content=stored[0], headers={'etag': stored[1]})
+        if request.method == 'GET' and not path:
+            self.calls['list'] += 1
+            prefix = request.url.params.get('prefix', '')
+            blobs = [
+                {'url': f"{PUBLIC_URL}/{name}", 'pathname': name, 'uploadedAt': uploaded_at, 'etag': etag}
+                for name, (_, etag, uploaded_at) in sorted(self.files.items()) if name.startswith(prefix)
+            ]
+            return httpx.Response(200, json={'blobs': blobs, 'hasMore': False})
+        if request.method == 'PUT':
+            self.calls['put'] += 1
+            stored = self.files.get(path)
+            if_match = request.headers.get('x-if-match')
+            if if_match is not None and (stored is None or stored[1] != if_match):
+                self.calls['conflict'] += 1
+                return httpx.Response(412)
+            if stored is not None and if_match is None and request.headers.get('x-allow-overwrite') != '1':
+                self.calls['conflict'] += 1
+                return httpx.Response(409)
+            etag, uploaded_at = self.put(path, request.read())
+            return httpx.Response(200, json={'url': f"{PUBLIC_URL}/{path}", 'pathname': path,
+                                             'uploadedAt': uploaded_at, 'etag': etag})
+        if request.method == 'POST' and path == 'delete':
+            self.calls['delete'] += 1
+            for blob_url in json.loads(request.read())['urls']:
+                self.files.pop(blob_url[len(PUBLIC_URL) + 1:], None)
+            return httpx.Response(200, json={})
+        return httpx.Response(400)
+
+
+@pytest.fixture
+def blob_store() -> FakeBlobStore:
+    return FakeBlobStore()
+
+
+@pytest.fixture
+def new_blob_db(monkeypatch, blob_store):
+    """Factory of VercelBlobDB instances sharing blob_store, like separate serverless instances"""
+    monkeypatch.setenv('BLOB_READ_WRITE_TOKEN', BLOB_TOKEN)
+    monkeypatch.setattr(db_adapter, 'BLOB_HTTP2', False)
+
+    def new():
+        db = db_adapter.VercelBlobDB()
+        db._client = blob_store.client()
+        return db
+    return new
+
+
+@pytest.fixture
+def server(monkeypatch, new_blob_db):
+    """The API module serving from a fresh VercelBlobDB on the fake store, with empty caches"""
+    import server
+    db = new_blob_db()
+    monkeypatch.setattr(server, 'db', db)
+    monkeypatch.setattr(server, 'catalog_cache', server.ResponseCache())
+    monkeypatch.setattr(server, 'product_search', server.ProductSearch(lambda: db.find('products')))
+    return server
+
+
+def api_client(server) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url='http://test')
@@ -0,0 +1,148 @@
+"""
+Aggregation pipelines: accumulators, $unwind, top-k sorts, computed projections and /api/stats
+"""
+import asyncio
+
+import pytest
+
+from aggregation import run_pipeline, _fuse, evaluate
+from conftest import api_client
+
+ORDERS = [
+    {"id": "o1", "status": "paid", "source": "web", "total": 100, "items": [{"sku": "a", "qty": 1}, {"sku": "b", "qty": 2}]},
+    {"id": "o2", "status": "paid", "source": "mercadolibre", "total": 50.5, "items": [{"sku": "a", "qty": 3}]},
+    {"id": "o3", "status": "pending", "source": "web", "total": 20, "items": []},
+    {"id": "o4", "status": "cancelled", "source": "web", "items": None},
+    {"id": "o5", "status": "paid", "source": "web", "total": "n/a", "items": [{"sku": "c", "qty": 1}]},
+]
+
+
+def test_group_accumulators():
+    [row] = run_pipeline(ORDERS, [{"$group": {
+        "_id": None,
+        "sum": {"$sum": "$total"},
+        "avg": {"$avg": "$total"},
+        "min": {"$min": "$total"},
+        "max": {"$max": "$total"},
+        "count": {"$count": {}},
+        "ones": {"$sum": 1},
+        "statuses": {"$addToSet": "$status"},
+        "ids": {"$push": "$id"},
+        "first": {"$first": "$id"},
+        "last": {"$last": "$id"},
+    }}])
+    # Non-numeric and missing totals are skipped by $sum/$avg; $min/$max skip only missing ones
+    assert row["sum"] == 170.5 and row["avg"] == pytest.approx(170.5 / 3)
+    assert row["min"] == 20 and row["max"] == 100
+    assert row["count"] == 5 and row["ones"] == 5
+    assert row["statuses"] == ["paid", "pending", "cancelled"]
+    assert row["ids"] == ["o1", "o2", "o3", "o4", "o5"]
+    assert row["first"] == "o1" and row["last"] == "o5"
+
+
+def test_group_by_compound_key():
+    rows = run_pipeline(ORDERS, [{"$group": {"_id": {"status": "$status", "source": "$source"}, "n": {"$sum": 1}}}])
+    assert rows == [
+        {"_id": {"status": "paid", "source": "web"}, "n": 2},
+        {"_id": {"status": "paid", "source": "mercadolibre"}, "n": 1},
+        {"_id": {"status": "pending", "source": "web"}, "n": 1},
+        {"_id": {"status": "cancelled", "source": "web"}, "n": 1},
+    ]
+
+
+def test_unknown_accumulator_and_stage_are_rejected():
+    with pytest.raises(ValueError):
+        run_pipeline(ORDERS, [{"$group": {"_id": None, "x": {"$median": "$total"}}}])
+    with pytest.raises(ValueError):
+        run_pipeline(ORDERS, [{"$lookup": {}}])
+
+
+def test_unwind():
+    rows = run_pipeline(ORDERS, [{"$unwind": "$items"}, {"$project": {"id": 1, "items": 1}}])
+    assert [(row["id"], row["items"]["sku"]) for row in rows] == [("o1", "a"), ("o1", "b"), ("o2", "a"), ("o5", "c")]
+    # The source documents are not modified
+    assert ORDERS[0]["items"][1] == {"sku": "b", "qty": 2}
+
+    kept = run_pipeline(ORDERS, [{"$unwind": {"path": "$items", "preserveNullAndEmptyArrays": True,
+                                              "includeArrayIndex": "position"}}])
+    assert [(row["id"], row["position"]) for row in kept] == [
+        ("o1", 0), ("o1", 1), ("o2", 0), ("o3", None), ("o4", None), ("o5", 0)]
+    assert "items" not in kept[3] and kept[4]["items"] is None
+
+
+def test_unwind_then_group_per_sku():
+    rows = run_pipeline(ORDERS, [
+        {"$unwind": "$items"},
+        {"$group": {"_id": "$items.sku", "qty": {"$sum": "$items.qty"}}},
+        {"$sort": {"qty": -1, "_id": 1}},
+    ])
+    assert rows == [{"_id": "a", "qty": 4}, {"_id": "b", "qty": 2}, {"_id": "c", "qty": 1}]
+
+
+def test_sort_skip_limit_fuse_into_top_k():
+    pipeline = [{"$sort": {"n": -1}}, {"$skip": 2}, {"$limit": 5}, {"$limit": 3}]
+    assert _fuse(pipeline) == [("$topk", ({"n": -1}, 2, 3))]
+    # A $skip after the limit cannot be folded into it
+    assert _fuse([{"$sort": {"n": 1}}, {"$limit": 3}, {"$skip": 1}]) == [
+        ("$topk", ({"n": 1}, 0, 3)), ("$skip", 1)]
+
+    def docs():
+        for n in range(1000):
+            yield {"n": n % 97, "i": n}
+
+    rows = run_pipeline(docs(), pipeline)
+    expected = sorted(({"n": n % 97, "i": n} for n in range(1000)), key=lambda doc: -doc["n"])[2:5]
+    assert [row["n"] for row in rows] == [row["n"] for row in expected]
+    assert run_pipeline([{"n": 3}, {"n": 1}, {"n": 2}], [{"$sort": {"n": 1}}, {"$limit": 2}, {"$skip": 1}]) == [{"n": 2}]
+
+
+def test_computed_project():
+    rows = run_pipeline(ORDERS[:2], [{"$project": {
+        "status": 1,
+        "_id": 0,
+        "with_tax": {"$multiply": ["$total", 1.21]},
+        "units": {"$add": [{"$ifNull": ["$missing", 0]}, 1]},
+        "label": {"$literal": "$status"},
+        "nested": {"source": "$source", "nope": "$missing"},
+    }}])
+    assert rows[0] == {"status": "paid", "with_tax": pytest.approx(121.0), "units": 1,
+                       "label": "$status", "nested": {"source": "web"}}
+    assert "id" not in rows[1] and rows[1]["with_tax"] == pytest.approx(50.5 * 1.21)
+    # Computed fields keep the ids unless _id is excluded
+    assert run_pipeline(ORDERS[:1], [{"$project": {"half": {"$divide": ["$total", 2]}}}]) == [{"id": "o1", "half": 50}]
+    assert evaluate({"$divide": ["$total", 0]}, ORDERS[0]) is None
+    assert evaluate({"$subtract": ["$total", "$missing"]}, ORDERS[0]) is None
+
+
+def test_adjacent_matches_are_merged():
+    pipeline = [{"$match": {"status": "paid"}}, {"$match": {"source": "web"}}, {"$count": "n"}]
+    assert _fuse(pipeline)[0] == ("$match", {"$and": [{"status": "paid"}, {"source": "web"}]})
+    assert run_pipeline(ORDERS, pipeline) == [{"n": 2}]
+    # A $match after another stage is applied to that stage's output
+    assert run_pipeline(ORDERS, [
+        {"$group": {"_id": "$status", "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gte": 2}}},
+    ]) == [{"_id": "paid", "n": 3}]
+
+
+def test_stats_endpoint_on_blob_backend(server):
+    async def run():
+        for order in ORDERS:
+            await server.db.insert_one("orders", {**order, "payment_status": order["status"]})
+        await server.db.insert_one("orders", {"status": "shipped", "source": "marketplace",
+                                              "payment_status": "paid", "total": 30})
+        for active in (True, True, False):
+            await server.db.insert_one("subscribers", {"email": f"{active}@x.com", "is_active": active})
+        await server.db.insert_one("products", {"name": "Filtro", "price": 10.0})
+        async with api_client(server) as client:
+            return (await client.get("/api/stats")).json()
+    body = asyncio.run(run())
+    assert body["success"] is True
+    assert body["stats"] == {
+        "total_products": 1,
+        "total_orders": 6,
+        "total_subscribers": 2,
+        "total_revenue": 180.5,
+        "orders_by_status": {"pending": 1, "paid": 3, "shipped": 1, "delivered": 0, "cancelled": 1},
+        "orders_by_source": {"web": 4, "mercadolibre": 1, "marketplace": 1},
+    }
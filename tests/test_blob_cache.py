@@ -0,0 +1,115 @@
+"""
+Blob cache: LRU byte budget, per-collection TTLs, stale-while-revalidate and oversized blobs
+"""
+import asyncio
+
+import httpx
+import pytest
+
+import blob_cache
+from blob_cache import BlobCache, CacheEntry, FRESH, STALE, EXPIRED
+from conftest import PUBLIC_URL
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(blob_cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_lru_evicts_by_bytes():
+    cache = BlobCache(max_bytes=100, ttls={})
+    cache.put('a', CacheEntry('a', ['a'], 40))
+    cache.put('b', CacheEntry('b', ['b'], 40))
+    cache.get('a')
+    cache.put('c', CacheEntry('c', ['c'], 40))
+    # b was the least recently used
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert cache.total_bytes == 80
+    # Replacing an entry accounts for its new size only
+    cache.put('a', CacheEntry('a', ['a2'], 70))
+    assert 'c' not in cache and cache.total_bytes == 70
+    cache.invalidate('a')
+    assert len(cache) == 0 and cache.total_bytes == 0
+
+
+def test_per_collection_ttl_and_stale_window(clock):
+    cache = BlobCache(default_ttl=10, stale_ttl=30, ttls={'orders': 2})
+    orders = CacheEntry('orders', [], 1)
+    users = CacheEntry('users', [], 1)
+    clock[0] += 1.5
+    assert cache.freshness(orders) == FRESH and cache.freshness(users) == FRESH
+    clock[0] += 1
+    assert cache.freshness(orders) == STALE and cache.freshness(users) == FRESH
+    clock[0] += 10
+    assert cache.freshness(users) == STALE
+    clock[0] += 20
+    assert cache.freshness(orders) == EXPIRED and cache.freshness(users) == STALE
+    users.touch()
+    assert cache.freshness(users) == FRESH
+
+
+def test_oversized_entry_is_kept_outside_the_budget():
+    cache = BlobCache(max_bytes=100, ttls={})
+    cache.put('small', CacheEntry('small', [], 10))
+    big = CacheEntry('big', [], 500)
+    assert cache.put('big', big) is False
+    assert cache.get('big') is big and 'small' in cache and cache.total_bytes == 10
+    # Only the last one is kept
+    other = CacheEntry('other', [], 300)
+    cache.put('other', other)
+    assert 'big' not in cache and cache.get('other') is other
+    assert cache.entries() == [cache.get('small'), other]
+    cache.invalidate('other')
+    assert 'other' not in cache and len(cache) == 1
+
+
+def test_stale_entry_is_served_and_revalidated_in_background(blob_store, new_blob_db):
+    async def run():
+        await new_blob_db().insert_one('orders', {"n": 1})
+        db = new_blob_db()
+        assert len(await db.find('orders')) == 1
+        await new_blob_db().insert_one('orders', {"n": 2})
+        downloads = len(blob_store.downloads)
+        # Fresh: no request at all
+        assert len(await db.find('orders')) == 1
+        assert len(blob_store.downloads) == downloads
+        # Stale: the cached copy is served while it is re-checked
+        db.cache.get('db/orders.json').checked_at -= db.cache.ttl_for('orders') + 1
+        assert len(await db.find('orders')) == 1
+        await asyncio.gather(*db._loading.values())
+        assert len(blob_store.downloads) == downloads + 1
+        assert len(await db.find('orders')) == 2
+    asyncio.run(run())
+
+
+def test_oversized_blob_is_not_downloaded_again_and_writes_see_themselves(monkeypatch, blob_store, new_blob_db):
+    # A 10-byte budget for the caches of new instances
+    monkeypatch.setattr(BlobCache.__init__, '__defaults__', (10,) + BlobCache.__init__.__defaults__[1:])
+    stale = {}
+    handler = blob_store.handler
+
+    def cdn(request: httpx.Request) -> httpx.Response:
+        # A CDN edge that still serves the version it first saw
+        path = request.url.path.lstrip('/')
+        if str(request.url).startswith(PUBLIC_URL) and path in stale:
+            blob_store.downloads.append(path)
+            return httpx.Response(200, content=stale[path][0], headers={'etag': stale[path][1]})
+        return handler(request)
+    blob_store.handler = cdn
+
+    async def run():
+        doc_id = (await new_blob_db().insert_one('products', {"name": "Filtro", "stock": 5}))['inserted_id']
+        stale['db/products.json'] = blob_store.files['db/products.json'][:2]
+        blob_store.downloads.clear()
+        db = new_blob_db()
+        assert db.cache.max_bytes == 10
+        await db.find('products')
+        await db.find('products')
+        assert blob_store.downloads == ['db/products.json']
+        updated = await db.find_one_and_update('products', {"id": doc_id}, {"$inc": {"stock": -2}})
+        assert updated['stock'] == 3
+        assert (await db.find_one('products', {"id": doc_id}))['stock'] == 3
+        assert blob_store.downloads == ['db/products.json']
+    asyncio.run(run())
@@ -0,0 +1,92 @@
+"""
+Blob formats: JSON and binary records round-trip, and records decode lazily
+"""
+import asyncio
+
+import pytest
+
+import blob_codec
+from blob_codec import EncodedBody, RecordReader, loads
+from document_set import DocumentSet
+
+DOCS = [
+    {"id": f"{i:04d}", "status": "paid" if i % 3 else "pending", "total": i * 1.5, "items": [{"sku": "A", "qty": i}],
+     "notes": "Entrega rápida"}
+    for i in range(50)
+]
+DOCS[7]["big"] = 2 ** 70
+
+
+@pytest.mark.parametrize("binary", [False, True])
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_round_trip(binary, compression):
+    if binary and not blob_codec.RECORDS_AVAILABLE:
+        pytest.skip("msgpack is not installed")
+    assert loads(EncodedBody(DOCS, compression=compression, binary=binary).read()) == DOCS
+    payload = {"docs": DOCS, "compacted": ["db/orders.delta/1.json"]}
+    assert loads(EncodedBody(payload, compression=compression, binary=binary).read()) == payload
+
+
+def test_records_decode_only_what_is_read():
+    if not blob_codec.RECORDS_AVAILABLE:
+        pytest.skip("msgpack is not installed")
+    content = EncodedBody(DOCS, compression=None, binary=True, index_fields=["status"]).read()
+    docs = DocumentSet.from_records(RecordReader(content), ["status"])
+    assert docs.get("0007") == DOCS[7]
+    assert [doc["id"] for doc in docs.candidates({"status": "pending"})] == [doc["id"] for doc in DOCS[::3]]
+    assert docs._undecoded == len(DOCS) - 1 - len(DOCS[::3])
+    # A full scan decodes the rest and releases the record buffer
+    assert docs.docs == DOCS
+    assert docs._records is None
+
+
+def test_truncated_records_are_rejected():
+    if not blob_codec.RECORDS_AVAILABLE:
+        pytest.skip("msgpack is not installed")
+    content = EncodedBody(DOCS, compression=None, binary=True).read()
+    with pytest.raises(Exception):
+        RecordReader(content[:-3])
+
+
+def test_reencoding_copies_undecoded_records():
+    if not blob_codec.RECORDS_AVAILABLE:
+        pytest.skip("msgpack is not installed")
+    content = EncodedBody(DOCS, compression=None, binary=True, index_fields=["status"]).read()
+    docs = DocumentSet.from_records(RecordReader(content), ["status"])
+    docs.update("0003", {"status": "paid"})
+    docs.put({"id": "0050", "status": "pending", "total": 0})
+    expected = [{**doc, "status": "paid"} if doc["id"] == "0003" else doc for doc in DOCS]
+    expected.append({"id": "0050", "status": "pending", "total": 0})
+    records = docs.records()
+    assert sum(type(record) is blob_codec.RawRecord for record in records) == len(DOCS) - 1
+    # "total" is not in the old footer: its column is filled from the copied records
+    reencoded = EncodedBody(records, compression=None, binary=True, index_fields=["status", "total"]).read()
+    assert docs._undecoded == len(DOCS) - 1
+    reader = RecordReader(reencoded)
+    assert list(reader) == expected
+    assert reader.ids == [doc["id"] for doc in expected]
+    assert reader.columns == {"status": [doc["status"] for doc in expected],
+                              "total": [doc["total"] for doc in expected]}
+
+
+def test_binary_collection_write_decodes_only_the_written_document(monkeypatch, new_blob_db):
+    if not blob_codec.RECORDS_AVAILABLE:
+        pytest.skip("msgpack is not installed")
+    import db_adapter
+    monkeypatch.setattr(db_adapter, 'BLOB_BINARY_COLLECTIONS', {'orders'})
+    decoded = []
+    decode = RecordReader.decode
+    monkeypatch.setattr(RecordReader, 'decode', lambda self, position: decoded.append(position) or decode(self, position))
+
+    async def run():
+        ids = (await new_blob_db().insert_many('orders', [dict(doc) for doc in DOCS]))['inserted_ids']
+        decoded.clear()
+        await new_blob_db().update_one('orders', {"id": ids[3]}, {"$set": {"status": "paid"}})
+        written = list(decoded)
+        return written, await new_blob_db().find('orders', projection={"id": 0, "_id": 0})
+    written, stored = asyncio.run(run())
+    # The rewrite copies the other 49 records without decoding them
+    assert written == [3]
+    expected = [{k: v for k, v in doc.items() if k != "id"} for doc in DOCS]
+    expected[3]["status"] = "paid"
+    assert stored == expected
@@ -0,0 +1,77 @@
+"""
+Versioned writes: instances that write the same blob concurrently reload, merge and retry
+"""
+import asyncio
+
+
+def test_concurrent_updates_from_two_instances_are_merged(blob_store, new_blob_db):
+    first, second = new_blob_db(), new_blob_db()
+
+    async def run():
+        product_id = (await first.insert_one('products', {"stock": 0, "name": "Filtro"}))['inserted_id']
+        # Both instances hold the same version of the blob
+        await second.find_one('products', {"id": product_id})
+        await asyncio.gather(
+            first.update_one('products', {"id": product_id}, {"$inc": {"stock": 1}}),
+            second.update_one('products', {"id": product_id}, {"$inc": {"stock": 2}, "$set": {"name": "Filtro 2"}}),
+        )
+        return product_id
+    product_id = asyncio.run(run())
+    assert blob_store.calls['conflict'] >= 1
+    product = asyncio.run(new_blob_db().find_one('products', {"id": product_id}))
+    assert product['stock'] == 3
+    assert product['name'] == "Filtro 2"
+
+
+def test_concurrent_creation_of_a_collection_keeps_both_documents(blob_store, new_blob_db):
+    first, second = new_blob_db(), new_blob_db()
+
+    async def run():
+        # Both instances know the blob as absent, so both try to create it
+        assert await first.find('subscribers') == await second.find('subscribers') == []
+        await asyncio.gather(
+            first.insert_one('subscribers', {"email": "a@example.com"}),
+            second.insert_one('subscribers', {"email": "b@example.com"}),
+        )
+    asyncio.run(run())
+    assert blob_store.calls['conflict'] >= 1
+    subscribers = asyncio.run(new_blob_db().find('subscribers'))
+    assert sorted(doc['email'] for doc in subscribers) == ["a@example.com", "b@example.com"]
+
+
+def test_group_commit_uploads_concurrent_writes_once(blob_store, new_blob_db):
+    db = new_blob_db()
+
+    async def run():
+        await db.insert_one('chatbot_responses', {"keyword": "hola"})
+        puts = blob_store.calls['put']
+        await asyncio.gather(*(db.insert_one('chatbot_responses', {"keyword": str(i)}) for i in range(10)))
+        return blob_store.calls['put'] - puts
+    assert asyncio.run(run()) == 1
+    assert asyncio.run(new_blob_db().count_documents('chatbot_responses')) == 11
+
+
+def test_an_older_id_written_late_keeps_documents_in_id_order(monkeypatch, blob_store, new_blob_db):
+    first, second = new_blob_db(), new_blob_db()
+
+    async def run():
+        await first.insert_one('orders', {"n": 0})
+        await second.find('orders')
+        # second generated its id first but commits last, after a conflict with first's write
+        older = second._generate_id()
+        await first.insert_one('orders', {"n": 2})
+        monkeypatch.setattr(second, '_generate_id', lambda: older)
+        await second.insert_one('orders', {"n": 1})
+        await first.insert_one('orders', {"n": 3})
+
+        reader = new_blob_db()
+        data = await reader._get_blob('orders', 'db/orders.json')
+        newest = await reader.find('orders', sort=[("id", -1)])
+        page = await reader.find('orders', {"id": {"$lt": newest[1]['id']}}, sort=[("id", -1)])
+        return data, newest, page
+    data, newest, page = asyncio.run(run())
+    assert blob_store.calls['conflict'] >= 1
+    assert data.id_ordered
+    assert [doc['n'] for doc in data] == [0, 1, 2, 3]
+    assert [doc['n'] for doc in newest] == [3, 2, 1, 0]
+    assert [doc['n'] for doc in page] == [1, 0]
@@ -0,0 +1,92 @@
+"""
+Append-only delta log: replay, compaction and exactly-once application of deltas
+"""
+import asyncio
+
+import pytest
+
+import db_adapter
+
+PATH = 'db/orders.json'
+
+
+@pytest.fixture(autouse=True)
+def append_only_orders(monkeypatch):
+    monkeypatch.setattr(db_adapter, 'BLOB_APPEND_ONLY_COLLECTIONS', {'orders'})
+    monkeypatch.setattr(db_adapter, 'BLOB_DELTA_COMPACT_COUNT', 4)
+
+
+def deltas(blob_store):
+    return sorted(path for path in blob_store.files if path.startswith('db/orders.delta/'))
+
+
+async def increment(db, order_id: str, times: int):
+    for _ in range(times):
+        await db.update_one('orders', {"id": order_id}, {"$inc": {"views": 1}})
+    await asyncio.gather(*db._compacting.values())
+
+
+async def views(db, order_id: str) -> int:
+    return (await db.find_one('orders', {"id": order_id}))['views']
+
+
+def test_writes_are_delta_records_replayed_by_other_instances(blob_store, new_blob_db):
+    async def run():
+        writer = new_blob_db()
+        order_id = (await writer.insert_one('orders', {"views": 0}))['inserted_id']
+        await writer.update_one('orders', {"id": order_id}, {"$inc": {"views": 1}})
+        return order_id
+    order_id = asyncio.run(run())
+    assert PATH not in blob_store.files
+    assert len(deltas(blob_store)) == 2
+    assert asyncio.run(views(new_blob_db(), order_id)) == 1
+
+
+def test_compaction_merges_and_deletes_deltas(blob_store, new_blob_db):
+    async def run():
+        writer = new_blob_db()
+        order_id = (await writer.insert_one('orders', {"views": 0}))['inserted_id']
+        await increment(writer, order_id, 5)
+        return order_id, await views(writer, order_id)
+    order_id, seen = asyncio.run(run())
+    assert seen == 5
+    assert PATH in blob_store.files
+    assert len(deltas(blob_store)) < 6
+    assert asyncio.run(views(new_blob_db(), order_id)) == 5
+
+
+def test_deltas_left_by_a_failed_delete_are_not_replayed_twice(monkeypatch, blob_store, new_blob_db):
+    async def keep(urls):
+        return False
+    writer = new_blob_db()
+    monkeypatch.setattr(writer, '_delete_blobs', keep)
+
+    async def run():
+        order_id = (await writer.insert_one('orders', {"views": 0}))['inserted_id']
+        await increment(writer, order_id, 5)
+        return order_id
+    order_id = asyncio.run(run())
+    snapshot = blob_store.read(PATH)
+    assert snapshot['compacted'] and set(snapshot['compacted']) <= set(deltas(blob_store))
+    assert len(deltas(blob_store)) == 6
+
+    assert asyncio.run(views(new_blob_db(), order_id)) == 5
+    # A later write and a compaction by another instance keep the count exact
+    other = new_blob_db()
+    asyncio.run(increment(other, order_id, 4))
+    assert asyncio.run(views(new_blob_db(), order_id)) == 9
+
+
+def test_warm_copy_applies_only_new_deltas(blob_store, new_blob_db):
+    reader, writer = new_blob_db(), new_blob_db()
+
+    async def run():
+        order_id = (await writer.insert_one('orders', {"views": 0}))['inserted_id']
+        assert await views(reader, order_id) == 0
+        await writer.update_one('orders', {"id": order_id}, {"$inc": {"views": 2}})
+        entry = await reader._load_log('orders', PATH, reader.cache.get(PATH))
+        assert entry.data.get(order_id)['views'] == 2
+        # Nothing new: the same entry is kept and nothing is applied again
+        assert await reader._load_log('orders', PATH, entry) is entry
+        assert entry.data.get(order_id)['views'] == 2
+    asyncio.run(run())
@@ -0,0 +1,73 @@
+"""
+Sharded blob layout: migration of a legacy single-file collection and routing by partition key
+"""
+import json
+import asyncio
+
+import pytest
+
+import db_adapter
+
+
+@pytest.fixture(autouse=True)
+def sharded_orders(monkeypatch):
+    monkeypatch.setattr(db_adapter, 'BLOB_SHARDED_COLLECTIONS', {'orders': (4, 'id')})
+
+
+def legacy_orders(blob_store, count: int = 3):
+    blob_store.put('db/orders.json', json.dumps([{"id": f"order-{i}", "n": i} for i in range(count)]).encode())
+
+
+def segments_read(blob_store):
+    return {path.split('/seg-')[1][:3] for path in blob_store.downloads if '/seg-' in path}
+
+
+def test_migration_moves_legacy_documents(blob_store, new_blob_db):
+    legacy_orders(blob_store)
+    assert asyncio.run(new_blob_db().count_documents('orders')) == 3
+    assert blob_store.read('db/orders/manifest.json')['segments'] == 4
+    assert asyncio.run(new_blob_db().count_documents('orders')) == 3
+
+
+def test_failed_legacy_read_writes_no_manifest(blob_store, new_blob_db):
+    legacy_orders(blob_store)
+    blob_store.fail('db/orders.json')
+    db = new_blob_db()
+    with pytest.raises(Exception):
+        asyncio.run(db.count_documents('orders'))
+    assert 'db/orders/manifest.json' not in blob_store.files
+
+    # The next access migrates, on this instance and on a fresh one
+    assert asyncio.run(db.count_documents('orders')) == 3
+    assert asyncio.run(new_blob_db().count_documents('orders')) == 3
+
+
+def test_empty_manifest_only_when_no_legacy_blob(blob_store, new_blob_db):
+    assert asyncio.run(new_blob_db().count_documents('orders')) == 0
+    assert blob_store.read('db/orders/manifest.json')['segments'] == 4
+
+
+def test_parse_shards():
+    assert db_adapter._parse_shards('') == {}
+    assert db_adapter._parse_shards('orders:16, cart_items:8:session_id') == {
+        'orders': (16, 'id'), 'cart_items': (8, 'session_id')}
+
+
+def test_partition_key_routes_a_session_to_one_segment(monkeypatch, blob_store, new_blob_db):
+    monkeypatch.setattr(db_adapter, 'BLOB_SHARDED_COLLECTIONS', {'cart_items': (8, 'session_id')})
+
+    async def fill():
+        db = new_blob_db()
+        for session in ('s1', 's2', 's3', 's4'):
+            for product in ('a', 'b'):
+                await db.insert_one('cart_items', {"session_id": session, "product_id": product})
+    asyncio.run(fill())
+    blob_store.downloads.clear()
+
+    db = new_blob_db()
+    items = asyncio.run(db.find('cart_items', {"session_id": "s2"}))
+    assert sorted(item['product_id'] for item in items) == ['a', 'b']
+    assert len(segments_read(blob_store)) == 1
+    # Without the partition key every segment that exists is read
+    assert asyncio.run(db.count_documents('cart_items')) == 8
+    assert len(segments_read(blob_store)) > 1
@@ -0,0 +1,94 @@
+"""
+Upserts are matched when committed: concurrent upserts of one query leave a single document
+"""
+import asyncio
+
+import pytest
+
+import db_adapter
+from conftest import api_client
+
+CART_QUERY = {"session_id": "s1", "product_id": "p1", "sale_type": "detal"}
+
+
+def add_one(db):
+    return db.find_one_and_update('cart_items', CART_QUERY, {
+        "$inc": {"quantity": 1}, "$set": {"updated_at": "now"}, "$setOnInsert": {"product_name": "Filtro"},
+    }, upsert=True)
+
+
+async def cart_lines(db):
+    return await db.find('cart_items', {"session_id": "s1"})
+
+
+@pytest.mark.parametrize("layout", ["single", "append_only", "by_session", "by_id"])
+def test_concurrent_cart_upserts_make_one_line(monkeypatch, new_blob_db, layout):
+    if layout == "append_only":
+        monkeypatch.setattr(db_adapter, 'BLOB_APPEND_ONLY_COLLECTIONS', {'cart_items'})
+    elif layout == "by_session":
+        monkeypatch.setattr(db_adapter, 'BLOB_SHARDED_COLLECTIONS', {'cart_items': (8, 'session_id')})
+    elif layout == "by_id":
+        # The query spans every segment: serialized per query on the instance
+        monkeypatch.setattr(db_adapter, 'BLOB_SHARDED_COLLECTIONS', {'cart_items': (4, 'id')})
+
+    async def run():
+        db = new_blob_db()
+        results = await asyncio.gather(*(add_one(db) for _ in range(5)))
+        return results, await cart_lines(db), await cart_lines(new_blob_db())
+    results, lines, persisted = asyncio.run(run())
+    assert len(lines) == 1 and lines[0]['quantity'] == 5 and lines[0]['product_name'] == "Filtro"
+    assert persisted == lines
+    assert {result['id'] for result in results} == {lines[0]['id']}
+
+
+def test_concurrent_config_upserts_make_one_document(new_blob_db):
+    async def run():
+        db = new_blob_db()
+        results = await asyncio.gather(*(
+            db.update_one('config', {"type": "bank"}, {"$set": {"type": "bank", "account": str(i)}}, upsert=True)
+            for i in range(3)
+        ))
+        return results, await new_blob_db().find('config', {"type": "bank"})
+    results, docs = asyncio.run(run())
+    assert len(docs) == 1 and docs[0]['account'] == "2"
+    assert [result['upserted_id'] for result in results if 'upserted_id' in result] == [docs[0]['id']]
+    assert sum(result['matched_count'] for result in results) == 2
+
+
+def test_upsert_from_a_stale_instance_updates_after_the_conflict(blob_store, new_blob_db):
+    first, second = new_blob_db(), new_blob_db()
+
+    async def run():
+        await cart_lines(first)
+        await cart_lines(second)
+        await add_one(first)
+        # second still holds the empty copy: its write conflicts and is matched on the reloaded one
+        return await add_one(second), await cart_lines(new_blob_db())
+    updated, lines = asyncio.run(run())
+    assert blob_store.calls['conflict'] >= 1
+    assert len(lines) == 1 and lines[0]['quantity'] == 2 and updated['quantity'] == 2
+
+
+def test_bulk_upserts_of_one_filter_make_one_document(new_blob_db):
+    db = new_blob_db()
+    operation = {"op": "update_one", "collection": "config", "filter": {"type": "company"},
+                 "update": {"$inc": {"edits": 1}}, "upsert": True}
+
+    async def run():
+        return await db.bulk_write([operation, dict(operation)]), await db.find('config')
+    result, docs = asyncio.run(run())
+    assert len(docs) == 1 and docs[0]['edits'] == 2
+    assert result['upserted_count'] == 1 and result['matched_count'] == 1
+    assert result['upserted_ids'] == [docs[0]['id']]
+
+
+def test_concurrent_add_to_cart_requests(server):
+    item = {"product_id": "p1", "product_name": "Filtro", "product_price": 3.5, "session_id": "s1"}
+
+    async def run():
+        async with api_client(server) as client:
+            responses = await asyncio.gather(*(client.post('/api/cart', json=item) for _ in range(5)))
+            return responses, (await client.get('/api/cart?session_id=s1')).json()['items']
+    responses, items = asyncio.run(run())
+    assert all(response.status_code == 200 for response in responses)
+    assert len(items) == 1 and items[0]['quantity'] == 5
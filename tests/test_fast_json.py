@@ -0,0 +1,111 @@
+"""
+FAST_JSON typed serializers, content-coding negotiation and the compression middleware
+"""
+import json
+import gzip
+import asyncio
+
+import pytest
+
+import fast_json
+from fast_json import encode_documents, encode_list, encode_items, negotiate_encoding
+from conftest import api_client
+
+
+@pytest.fixture
+def fast(monkeypatch, server):
+    monkeypatch.setattr(fast_json, 'FAST_JSON', True)
+    monkeypatch.setattr(server, 'FAST_JSON', True)
+    return server
+
+
+@pytest.fixture
+def compressing(monkeypatch, server):
+    monkeypatch.setattr(fast_json, 'RESPONSE_COMPRESSION', ['br', 'gzip'] if fast_json.brotli else ['gzip'])
+    return server
+
+
+def test_typed_serializers_keep_declared_fields_and_float_types():
+    product = {"id": "p1", "_id": "p1", "name": "Filtro", "price": 10, "price_wholesale": None, "cost": 4}
+    assert json.loads(encode_documents("products", [product])) == [
+        {"id": "p1", "name": "Filtro", "price": 10.0, "price_wholesale": None}]
+    assert b'"price":10.0' in encode_documents("products", [product])
+    order = {"id": "o1", "total": 5, "items": [{"product_id": "p1", "price": 2, "internal": True}],
+             "shipping_address": {"city": "Caracas", "geo": [1, 2]}}
+    assert json.loads(encode_documents("orders", [order])) == [
+        {"id": "o1", "total": 5.0, "items": [{"product_id": "p1", "price": 2.0}], "shipping_address": {"city": "Caracas"}}]
+
+
+def test_list_envelopes():
+    body = encode_list("items", [{"id": "c1", "quantity": 2, "_id": "c1"}], next_cursor=None)
+    assert json.loads(body) == {"success": True, "items": [{"id": "c1", "quantity": 2}], "next_cursor": None}
+    assert json.loads(b"[" + encode_items("orders", [{"id": "a"}, {"id": "b", "_id": "b"}]) + b"]") == [
+        {"id": "a"}, {"id": "b", "_id": "b"}]
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, br", "br"),
+    ("gzip", "gzip"),
+    ("br;q=0, gzip;q=0.5", "gzip"),
+    ("*", "br"),
+    ("identity", None),
+    ("br;q=zz, gzip", "gzip"),
+    ("", None),
+])
+def test_negotiate_encoding(monkeypatch, header, expected):
+    monkeypatch.setattr(fast_json, 'RESPONSE_COMPRESSION', ['br', 'gzip'])
+    assert negotiate_encoding(header) == expected
+
+
+def test_fast_json_responses_drop_internal_fields(fast):
+    async def run():
+        await fast.db.insert_many('products', [{"name": f"Filtro {i}", "price": 3, "cost": 1} for i in range(3)])
+        await fast.db.insert_many('orders', [{"order_id": f"ORD-{i}", "total": 7, "notes_internal": "x"}
+                                             for i in range(250)])
+        async with api_client(fast) as client:
+            return (await client.get('/api/products?limit=2')).json(), (await client.get('/api/orders')).json()
+    products, orders = asyncio.run(run())
+    assert products['success'] and products['next_cursor'] and len(products['products']) == 2
+    assert all(set(product) == {"id", "name", "price"} and product['price'] == 3.0 for product in products['products'])
+    assert orders['success'] and len(orders['orders']) == 250
+    assert all(set(order) == {"id", "order_id", "total"} for order in orders['orders'])
+
+
+def test_large_responses_are_compressed_with_a_weak_etag(compressing):
+    async def run():
+        await compressing.db.insert_many('products', [{"name": f"Filtro {i}", "price": 3.5} for i in range(100)])
+        async with api_client(compressing) as client:
+            plain = await client.get('/api/products', headers={"Accept-Encoding": "identity"})
+            packed = await client.get('/api/products', headers={"Accept-Encoding": "gzip"})
+            revalidated = await client.get('/api/products', headers={"Accept-Encoding": "gzip",
+                                                                    "If-None-Match": packed.headers['etag']})
+            return plain, packed, revalidated
+    plain, packed, revalidated = asyncio.run(run())
+    assert 'content-encoding' not in plain.headers and not plain.headers['etag'].startswith('W/')
+    assert packed.headers['content-encoding'] == "gzip" and packed.headers['vary'] == "Accept-Encoding"
+    assert packed.headers['etag'] == "W/" + plain.headers['etag']
+    assert packed.json() == plain.json()
+    # 304s pass through untouched
+    assert revalidated.status_code == 304 and 'content-encoding' not in revalidated.headers
+
+
+def test_small_responses_are_not_compressed(compressing):
+    async def run():
+        async with api_client(compressing) as client:
+            return await client.get('/api/products', headers={"Accept-Encoding": "gzip"})
+    response = asyncio.run(run())
+    assert len(response.content) < fast_json.RESPONSE_COMPRESSION_MIN_SIZE
+    assert 'content-encoding' not in response.headers
+
+
+def test_streamed_responses_are_compressed_as_sent(compressing):
+    async def run():
+        await compressing.db.insert_many('orders', [{"order_id": f"ORD-{i}", "total": 7} for i in range(300)])
+        async with api_client(compressing) as client:
+            async with client.stream('GET', '/api/orders', headers={"Accept-Encoding": "gzip"}) as response:
+                raw = b"".join([chunk async for chunk in response.aiter_raw()])
+                return response.headers, raw
+    headers, raw = asyncio.run(run())
+    assert headers['content-encoding'] == "gzip" and 'content-length' not in headers
+    body = json.loads(gzip.decompress(raw))
+    assert body['success'] and len(body['orders']) == 300
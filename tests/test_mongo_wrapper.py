@@ -0,0 +1,111 @@
+"""
+MongoDBWrapper against an in-memory MongoDB (mongomock)
+"""
+import asyncio
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import db_adapter  # noqa: E402
+from conftest import api_client  # noqa: E402
+
+
+@pytest.fixture
+def mongo_db():
+    return db_adapter.MongoDBWrapper(db=mongomock.MongoClient().db)
+
+
+def test_string_ids_are_matched_and_queries_left_untouched(mongo_db):
+    async def run():
+        doc_id = (await mongo_db.insert_one('products', {"name": "Filtro", "stock": 1}))['inserted_id']
+        query = {"id": doc_id}
+        assert (await mongo_db.find_one('products', query))['name'] == "Filtro"
+        assert query == {"id": doc_id}
+        assert (await mongo_db.update_one('products', {"id": doc_id}, {"$set": {"stock": 2}}))['modified_count'] == 1
+        updated = await mongo_db.find_one_and_update('products', {"_id": doc_id}, {"$inc": {"stock": 3}})
+        assert updated == {"id": doc_id, "name": "Filtro", "stock": 5}
+        assert (await mongo_db.delete_one('products', {"id": doc_id}))['deleted_count'] == 1
+        assert await mongo_db.find_one('products', {"id": doc_id}) is None
+        # Not an ObjectId: matches nothing instead of failing
+        assert await mongo_db.find_one('products', {"id": "not-an-object-id"}) is None
+    asyncio.run(run())
+
+
+def test_iter_find_streams_in_batches_and_closes_early(mongo_db):
+    async def run():
+        await mongo_db.insert_many('orders', [{"n": i} for i in range(25)])
+        streamed = [doc["n"] async for doc in mongo_db.iter_find('orders', sort=[("id", -1)], batch_size=10)]
+        assert streamed == list(range(24, -1, -1))
+        docs = mongo_db.iter_find('orders', {"n": {"$gte": 5}}, batch_size=4)
+        first = [await docs.__anext__() for _ in range(3)]
+        await docs.aclose()
+        assert [doc["n"] for doc in first] == [5, 6, 7]
+    asyncio.run(run())
+
+
+def test_bulk_inserts_and_upserts_get_generated_ids(monkeypatch, mongo_db):
+    issued = iter(f"{i:024x}" for i in range(1, 100))
+    monkeypatch.setattr(db_adapter, 'generate_id', lambda: next(issued))
+
+    async def run():
+        result = await mongo_db.bulk_write([
+            {"op": "insert_one", "collection": "orders", "document": {"n": 1}},
+            {"op": "update_one", "collection": "config", "filter": {"type": "bank"},
+             "update": {"$set": {"account": "1"}}, "upsert": True},
+        ])
+        assert result['inserted_ids'] == [f"{1:024x}"] and result['upserted_ids'] == [f"{2:024x}"]
+        upserted = await mongo_db.update_one('config', {"type": "company"}, {"$set": {"name": "A"}}, upsert=True)
+        assert upserted['upserted_id'] == f"{3:024x}"
+        cart = await mongo_db.find_one_and_update('cart_items', {"session_id": "s1"}, {
+            "$inc": {"quantity": 1}, "$setOnInsert": {"product_id": "p1"}}, upsert=True)
+        assert cart == {"id": f"{4:024x}", "session_id": "s1", "quantity": 1, "product_id": "p1"}
+        # Matching an existing document uses no new id
+        again = await mongo_db.find_one_and_update('cart_items', {"session_id": "s1"}, {"$inc": {"quantity": 1}},
+                                                   upsert=True)
+        assert again["id"] == f"{4:024x}" and again["quantity"] == 2
+    asyncio.run(run())
+
+
+def test_many_writes_match_string_ids(mongo_db):
+    async def run():
+        ids = (await mongo_db.insert_many('orders', [{"n": i} for i in range(3)]))['inserted_ids']
+        assert (await mongo_db.update_many('orders', {"id": {"$in": ids[:2]}}, {"$set": {"seen": True}}))['matched_count'] == 2
+        assert (await mongo_db.delete_many('orders', {"id": ids[0]}))['deleted_count'] == 1
+        return ids, await mongo_db.find('orders', sort=[("id", 1)])
+    ids, orders = asyncio.run(run())
+    assert orders == [{"id": ids[1], "n": 1, "seen": True}, {"id": ids[2], "n": 2}]
+
+
+def test_bulk_write_mixes_inserts_updates_and_deletes(mongo_db):
+    async def run():
+        product_id = (await mongo_db.insert_one('products', {"name": "Filtro"}))['inserted_id']
+        await mongo_db.insert_many('cart_items', [{"product_id": product_id}, {"product_id": product_id},
+                                                  {"product_id": "other"}])
+        result = await mongo_db.bulk_write([
+            {"op": "insert_one", "collection": "orders", "document": {"n": 1}},
+            {"op": "update_many", "collection": "cart_items", "filter": {"product_id": "other"},
+             "update": {"$set": {"quantity": 2}}},
+            {"op": "delete_many", "collection": "cart_items", "filter": {"product_id": product_id}},
+            {"op": "delete_one", "collection": "products", "filter": {"id": product_id}},
+        ])
+        return result, await mongo_db.find('cart_items'), await mongo_db.count_documents('products')
+    result, cart, products = asyncio.run(run())
+    assert result['inserted_count'] == 1 and result['modified_count'] == 1 and result['deleted_count'] == 3
+    assert result['collections']['products']['deleted_count'] == 1
+    assert [item['product_id'] for item in cart] == ["other"] and products == 0
+
+
+def test_delete_product_cascades_to_cart_lines(monkeypatch, server, mongo_db):
+    monkeypatch.setattr(server, 'db', mongo_db)
+
+    async def run():
+        product_id = (await mongo_db.insert_one('products', {"name": "Filtro"}))['inserted_id']
+        await mongo_db.insert_one('cart_items', {"product_id": product_id, "session_id": "s1"})
+        async with api_client(server) as client:
+            deleted = await client.delete(f'/api/products/{product_id}')
+            missing = await client.delete(f'/api/products/{product_id}')
+        return deleted, missing, await mongo_db.count_documents('cart_items')
+    deleted, missing, cart_lines = asyncio.run(run())
+    assert deleted.status_code == 200 and missing.status_code == 404
+    assert cart_lines == 0
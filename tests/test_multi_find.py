@@ -0,0 +1,75 @@
+"""
+multi_find: identical reads run once, results in request order, one download per blob
+"""
+import asyncio
+
+import pytest
+
+import db_adapter
+
+REQUESTS = [
+    {"op": "count", "collection": "orders"},
+    {"op": "find", "collection": "orders", "query": {"status": "paid"}, "sort": [("n", 1)], "projection": {"n": 1}},
+    {"op": "find_one", "collection": "config", "query": {"type": "shipping"}},
+    {"op": "count", "collection": "orders", "query": {"status": "paid"}},
+    {"op": "find_one", "collection": "config", "query": {"type": "shipping"}},
+    {"op": "aggregate", "collection": "orders", "pipeline": [
+        {"$match": {"status": "paid"}}, {"$group": {"_id": None, "total": {"$sum": "$n"}}}]},
+    {"op": "count", "collection": "orders"},
+]
+
+
+async def seed(db):
+    await db.insert_many("orders", [{"n": n, "status": "paid" if n % 2 else "pending"} for n in range(6)])
+    await db.insert_one("config", {"type": "shipping", "cost": 5})
+
+
+def check(results):
+    assert len(results) == len(REQUESTS)
+    assert results[0] == results[6] == 6
+    assert [doc["n"] for doc in results[1]] == [1, 3, 5]
+    assert results[2]["cost"] == 5 and results[4] == results[2]
+    assert results[3] == 3
+    assert results[5] == [{"_id": None, "total": 9}]
+
+
+def test_blob_reads_each_blob_once(monkeypatch, blob_store, new_blob_db):
+    async def run():
+        await seed(new_blob_db())
+        db = new_blob_db()
+        reads = []
+        original = db_adapter._read
+
+        async def counted(adapter, request):
+            reads.append(request)
+            return await original(adapter, request)
+        monkeypatch.setattr(db_adapter, '_read', counted)
+        blob_store.downloads.clear()
+        results = await db.multi_find(REQUESTS)
+        return results, reads
+    results, reads = asyncio.run(run())
+    check(results)
+    # The two duplicated requests run once each
+    assert len(reads) == len(REQUESTS) - 2
+    # Four orders reads and one config read, one download per blob
+    assert len(blob_store.downloads) == 2
+
+
+def test_mongo_runs_identical_requests_once(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    db = db_adapter.MongoDBWrapper(db=mongomock.MongoClient().db)
+    calls = []
+    original = db._run
+
+    async def counted(fn):
+        calls.append(fn)
+        return await original(fn)
+    monkeypatch.setattr(db, '_run', counted)
+
+    async def run():
+        await seed(db)
+        calls.clear()
+        return await db.multi_find(REQUESTS)
+    results = asyncio.run(run())
+    check(results)
+    assert len(calls) == len(REQUESTS) - 2
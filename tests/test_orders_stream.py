@@ -0,0 +1,52 @@
+"""
+Streamed order list: errors before the first document answer 500, later ones end the body cleanly
+"""
+import json
+import asyncio
+
+import pytest
+
+from conftest import api_client
+
+
+async def get_orders(server, url='/api/orders'):
+    async with api_client(server) as client:
+        return await client.get(url)
+
+
+def failing_after(docs, count: int):
+    async def iter_find(*args, **kwargs):
+        for doc in docs[:count]:
+            yield doc
+        raise ConnectionError("connection reset")
+    return iter_find
+
+
+def test_orders_stream_in_one_envelope(server):
+    async def run():
+        for i in range(5):
+            await server.db.insert_one('orders', {"n": i})
+        return await get_orders(server, '/api/orders?limit=3')
+    response = asyncio.run(run())
+    body = response.json()
+    assert response.status_code == 200 and body['success'] is True
+    assert [order['n'] for order in body['orders']] == [4, 3, 2]
+    assert body['next_cursor']
+
+
+def test_error_before_the_first_document_is_a_500(monkeypatch, server):
+    monkeypatch.setattr(server.db, 'iter_find', failing_after([], 0))
+    with pytest.raises(ConnectionError):
+        asyncio.run(get_orders(server))
+
+
+def test_error_after_the_first_batch_ends_the_json_cleanly(monkeypatch, server):
+    monkeypatch.setattr(server, 'STREAM_BATCH', 2)
+    orders = [{"id": f"order-{i}", "n": i} for i in range(5)]
+    monkeypatch.setattr(server.db, 'iter_find', failing_after(orders, 3))
+    response = asyncio.run(get_orders(server))
+    body = json.loads(response.content)
+    assert response.status_code == 200
+    assert body['success'] is False and body['detail']
+    assert body['next_cursor'] is None
+    assert len(body['orders']) <= 3
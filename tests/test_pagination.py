@@ -0,0 +1,83 @@
+"""
+Cursor paging of the list endpoints: pages cover the full list with no gaps or duplicates
+"""
+import asyncio
+
+import pytest
+
+import db_adapter
+from conftest import api_client
+
+LISTS = [
+    ('/api/orders', 'orders', 'orders'),
+    ('/api/orders?status=paid', 'orders', 'orders'),
+    ('/api/products?category=filtros', 'products', 'products'),
+    ('/api/cart?session_id=s1', 'cart_items', 'items'),
+    ('/api/chatbot/responses', 'chatbot_responses', 'responses'),
+    ('/api/subscribers', 'subscribers', 'subscribers'),
+]
+
+
+def page_url(path: str, limit: int, cursor: str = None) -> str:
+    url = f"{path}{'&' if '?' in path else '?'}limit={limit}"
+    return url + (f"&cursor={cursor}" if cursor else "")
+
+
+async def fill(db, collection: str, count: int, start: int = 0):
+    for n in range(start, start + count):
+        await db.insert_one(collection, {"n": n, "status": "paid" if n % 2 else "pending", "category": "filtros",
+                                         "session_id": "s1", "keywords": [], "email": f"{n}@example.com"})
+
+
+async def walk(client, path: str, key: str, limit: int, between_pages=None):
+    seen, cursor = [], None
+    while True:
+        response = await client.get(page_url(path, limit, cursor))
+        assert response.status_code == 200, response.text
+        body = response.json()
+        assert len(body[key]) <= limit
+        seen += [doc['n'] for doc in body[key]]
+        cursor = body['next_cursor']
+        if not cursor:
+            return seen
+        if between_pages is not None:
+            await between_pages()
+
+
+@pytest.mark.parametrize("path, collection, key", LISTS)
+@pytest.mark.parametrize("limit", [1, 5, 23])
+def test_pages_cover_the_list_once(server, path, collection, key, limit):
+    async def run():
+        await fill(server.db, collection, 23)
+        async with api_client(server) as client:
+            full = [doc['n'] for doc in (await client.get(path)).json()[key]]
+            return full, await walk(client, path, key, limit)
+    full, paged = asyncio.run(run())
+    assert paged == full
+    assert len(set(paged)) == len(paged) and len(full) in (23, 11)
+
+
+def test_inserts_between_pages_cause_no_gaps_or_duplicates(monkeypatch, server):
+    monkeypatch.setattr(db_adapter, 'BLOB_SHARDED_COLLECTIONS', {'orders': (4, 'id')})
+    added = []
+
+    async def insert_newer():
+        await fill(server.db, 'orders', 1, start=100 + len(added))
+        added.append(1)
+
+    async def run():
+        await fill(server.db, 'orders', 17)
+        async with api_client(server) as client:
+            return await walk(client, '/api/orders', 'orders', 4, insert_newer)
+    paged = asyncio.run(run())
+    # Newest first; documents inserted after the first page are newer than the cursor
+    assert paged == list(range(16, -1, -1))
+
+
+def test_invalid_cursor_is_rejected(server):
+    async def run():
+        async with api_client(server) as client:
+            return [await client.get(page_url(path, 5, 'no-es-un-cursor!')) for path, _, _ in LISTS]
+    for response in asyncio.run(run()):
+        assert response.status_code == 400
+        assert response.json()['detail'] == "Cursor inválido"
@@ -0,0 +1,123 @@
+"""
+Query engine and index planning of the blob adapter
+"""
+import random
+import asyncio
+
+import pytest
+
+from document_set import DocumentSet
+from query_engine import compile_query, apply_sort, apply_projection
+
+DOCS = [
+    {"id": "a", "status": "paid", "total": 10, "tags": ["web", "promo"], "address": {"city": "Caracas"}},
+    {"id": "b", "status": "pending", "total": 25.5, "tags": ["whatsapp"], "address": {"city": "Valencia"}},
+    {"id": "c", "status": "paid", "total": 40, "tags": [], "notes": "Entregar en la mañana"},
+    {"id": "d", "status": "cancelled", "total": None, "tags": ["web"]},
+]
+
+
+def ids(query):
+    matches = compile_query(query)
+    return [doc["id"] for doc in DOCS if matches(doc)]
+
+
+@pytest.mark.parametrize("query, expected", [
+    ({}, ["a", "b", "c", "d"]),
+    ({"status": "paid"}, ["a", "c"]),
+    ({"status": {"$ne": "paid"}}, ["b", "d"]),
+    ({"status": {"$in": ["pending", "cancelled"]}}, ["b", "d"]),
+    ({"status": {"$nin": ["paid"]}}, ["b", "d"]),
+    ({"total": {"$gte": 25.5, "$lt": 40}}, ["b"]),
+    ({"total": {"$gt": 5}}, ["a", "b", "c"]),
+    ({"notes": {"$exists": True}}, ["c"]),
+    ({"notes": {"$exists": False}}, ["a", "b", "d"]),
+    ({"tags": "web"}, ["a", "d"]),
+    ({"tags": {"$in": ["promo", "whatsapp"]}}, ["a", "b"]),
+    ({"address.city": "Valencia"}, ["b"]),
+    ({"notes": {"$regex": "MAÑANA", "$options": "i"}}, ["c"]),
+    ({"total": {"$not": {"$gt": 20}}}, ["a", "d"]),
+    ({"$or": [{"status": "pending"}, {"total": 40}]}, ["b", "c"]),
+    ({"$nor": [{"status": "paid"}, {"tags": "web"}]}, ["b"]),
+    ({"$and": [{"status": "paid"}, {"tags": "promo"}]}, ["a"]),
+])
+def test_compile_query(query, expected):
+    assert ids(query) == expected
+
+
+def test_unsupported_operator_is_rejected():
+    with pytest.raises(ValueError):
+        compile_query({"total": {"$near": 1}})
+
+
+def test_sort_orders_types_like_mongo():
+    docs = [{"v": "b"}, {"v": 2}, {"v": None}, {"v": 1.5}, {}, {"v": "a"}]
+    assert [doc.get("v") for doc in apply_sort(docs, [("v", 1)])] == [None, None, 1.5, 2, "a", "b"]
+
+
+def test_bounded_sort_matches_full_sort():
+    rnd = random.Random(7)
+    docs = [{"id": i, "price": rnd.randint(1, 20), "stock": rnd.randint(1, 5)} for i in range(200)]
+    full = sorted(docs, key=lambda doc: (-doc["price"], doc["id"]))
+    assert apply_sort(docs, [("price", -1)], skip=10, limit=15) == full[10:25]
+    mixed = sorted(docs, key=lambda doc: (doc["stock"], -doc["price"]))
+    assert apply_sort(docs, [("stock", 1), ("price", -1)], limit=30) == mixed[:30]
+
+
+def test_projection():
+    doc = {"id": "a", "_id": "a", "name": "Filtro", "price": 3}
+    assert apply_projection(doc, {"name": 1}) == {"id": "a", "_id": "a", "name": "Filtro"}
+    assert apply_projection(doc, {"name": 1, "_id": 0}) == {"name": "Filtro"}
+    assert apply_projection(doc, {"price": 0}) == {"id": "a", "_id": "a", "name": "Filtro"}
+
+
+def test_candidates_use_the_smallest_index_bucket():
+    docs = DocumentSet([dict(doc) for doc in DOCS], indexed_fields=["status", "tags"])
+    assert [doc["id"] for doc in docs.candidates({"status": "paid", "tags": "promo"})] == ["a"]
+    assert [doc["id"] for doc in docs.candidates({"status": {"$in": ["cancelled", "pending"]}})] == ["b", "d"]
+    assert list(docs.candidates({"status": "refunded"})) == []
+    # Conditions the indexes cannot answer fall back to every document
+    assert len(list(docs.candidates({"total": {"$gt": 1}}))) == 4
+
+
+def test_indexes_follow_updates_and_deletes():
+    docs = DocumentSet([dict(doc) for doc in DOCS], indexed_fields=["status"])
+    docs.update("b", {"status": "paid"})
+    docs.delete("a")
+    assert [doc["id"] for doc in docs.candidates({"status": "paid"})] == ["b", "c"]
+    assert list(docs.candidates({"status": "pending"})) == []
+
+
+def test_id_range_candidates():
+    docs = DocumentSet([{"id": f"{i:04d}"} for i in range(100)], indexed_fields=["status"])
+    assert docs.id_ordered
+    assert [doc["id"] for doc in docs.candidates({"id": {"$lt": "0003"}})] == ["0000", "0001", "0002"]
+    assert [doc["id"] for doc in reversed(docs.candidates({"id": {"$gte": "0097"}}))] == ["0099", "0098", "0097"]
+
+
+def test_find_pushes_sort_limit_and_projection_down(new_blob_db):
+    rnd = random.Random(3)
+    db = new_blob_db()
+    docs = [{"status": rnd.choice(["paid", "pending"]), "total": rnd.randint(1, 100)} for _ in range(60)]
+
+    async def run():
+        await db.insert_many('orders', docs)
+        return await db.find('orders', {"status": "paid"}, sort=[("total", -1), ("id", 1)], skip=2, limit=5,
+                             projection={"total": 1})
+    found = asyncio.run(run())
+    expected = sorted((doc for doc in docs if doc["status"] == "paid"), key=lambda doc: (-doc["total"], doc["id"]))[2:7]
+    assert found == [{"id": doc["id"], "_id": doc["id"], "total": doc["total"]} for doc in expected]
+
+
+def test_id_ranges_follow_writes_without_copying_keys():
+    docs = DocumentSet([{"id": f"{i:04d}"} for i in range(0, 100, 2)])
+    page = docs.candidates({"id": {"$lt": "0010"}})
+    assert page.keys is docs._keys
+    docs.put({"id": "0005"})
+    docs.delete("0004")
+    # A range handed out before the writes reads the keys it was built on, minus deleted ones
+    assert [doc["id"] for doc in page] == ["0000", "0002", "0006", "0008"]
+    assert docs.id_ordered
+    assert [doc["id"] for doc in reversed(docs.candidates({"id": {"$lt": "0010"}}))] == [
+        "0008", "0006", "0005", "0002", "0000"]
+    assert list(docs.candidates({"id": {"$gt": "0050", "$lt": "0040"}})) == []
@@ -0,0 +1,126 @@
+"""
+Catalog response cache: ETags and 304s, targeted invalidation and loads racing writes
+"""
+import asyncio
+
+from starlette.requests import Request
+
+import response_cache
+from response_cache import ResponseCache
+from conftest import api_client
+
+
+def request(if_none_match: str = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers, "query_string": b""})
+
+
+async def add_product(client, name: str, category: str) -> str:
+    response = await client.post('/api/products', json={"name": name, "price": 10.0, "category": category})
+    return response.json()['product']['id']
+
+
+def test_etag_and_304(server):
+    async def run():
+        async with api_client(server) as client:
+            product_id = await add_product(client, "Filtro", "filtros")
+            first = await client.get(f'/api/products/{product_id}')
+            etag = first.headers['etag']
+            cached = await client.get(f'/api/products/{product_id}', headers={"If-None-Match": etag})
+            weak = await client.get(f'/api/products/{product_id}', headers={"If-None-Match": f'"x", W/{etag}'})
+            other = await client.get(f'/api/products/{product_id}', headers={"If-None-Match": '"x"'})
+            return first, cached, weak, other
+    first, cached, weak, other = asyncio.run(run())
+    assert first.status_code == 200 and first.json()['product']['name'] == "Filtro"
+    assert cached.status_code == 304 and cached.content == b"" and cached.headers['etag'] == first.headers['etag']
+    assert weak.status_code == 304
+    assert other.status_code == 200 and other.content == first.content
+
+
+def test_cached_until_a_write_through_the_api(server):
+    async def run():
+        async with api_client(server) as client:
+            product_id = await add_product(client, "Filtro", "filtros")
+            before = (await client.get(f'/api/products/{product_id}')).json()['product']
+            # Written behind the cache's back: still served from the cache
+            await server.db.update_one('products', {"id": product_id}, {"$set": {"name": "Directo"}})
+            cached = (await client.get(f'/api/products/{product_id}')).json()['product']
+            await client.put(f'/api/products/{product_id}', json={"price": 12.5})
+            after = (await client.get(f'/api/products/{product_id}')).json()['product']
+            return before, cached, after
+    before, cached, after = asyncio.run(run())
+    assert cached == before
+    assert after['name'] == "Directo" and after['price'] == 12.5
+
+
+def test_writes_drop_only_the_entries_they_affect(server):
+    async def run():
+        async with api_client(server) as client:
+            filter_id = await add_product(client, "Filtro", "filtros")
+            brake_id = await add_product(client, "Pastillas", "frenos")
+            other_id = await add_product(client, "Correa", "motor")
+            for url in ('/api/products?category=filtros', '/api/products?category=frenos', f'/api/products/{other_id}'):
+                await client.get(url)
+            cached = set(server.catalog_cache.entries)
+            # Contained in the frenos listing only
+            await client.put(f'/api/products/{brake_id}', json={"name": "Pastillas traseras"})
+            after_update = set(server.catalog_cache.entries)
+            # Contained in no listing, but matches the filtros query
+            await add_product(client, "Filtro de aire", "filtros")
+            after_insert = set(server.catalog_cache.entries)
+            await client.get(f'/api/products/{filter_id}')
+            await client.delete(f'/api/products/{filter_id}')
+            return cached, after_update, after_insert, set(server.catalog_cache.entries)
+    cached, after_update, after_insert, after_delete = asyncio.run(run())
+    filtros = next(key for key in cached if key[0] == "products" and "filtros" in key[1])
+    frenos = next(key for key in cached if key[0] == "products" and "frenos" in key[1])
+    assert len(cached) == 3
+    assert after_update == cached - {frenos}
+    assert after_insert == after_update - {filtros}
+    assert after_delete == after_insert
+
+
+def test_load_racing_a_write_is_not_stored():
+    cache = ResponseCache(ttl=60)
+
+    async def racing_load():
+        cache.invalidate("p1", {"id": "p1"})
+        return {"product": {"id": "p1"}}, ["p1"]
+
+    async def load():
+        return {"product": {"id": "p1"}}, ["p1"]
+
+    async def run():
+        raced = await cache.respond(request(), "p1", racing_load)
+        assert "p1" not in cache.entries and raced.status_code == 200
+        await cache.respond(request(), "p1", load)
+        assert "p1" in cache.entries
+    asyncio.run(run())
+
+
+def test_ttl_and_lru_bound(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(response_cache.time, 'monotonic', lambda: clock[0])
+    cache = ResponseCache(ttl=10, max_entries=2)
+    loads = []
+
+    def loader(key):
+        async def load():
+            loads.append(key)
+            return {"key": key}, []
+        return load
+
+    async def get(key):
+        return await cache.respond(request(), key, loader(key))
+
+    async def run():
+        await get("a")
+        await get("b")
+        await get("a")
+        await get("c")
+        # "b" was the least recently used
+        assert list(cache.entries) == ["a", "c"]
+        clock[0] += 11
+        await get("a")
+    asyncio.run(run())
+    assert loads == ["a", "b", "c", "a"]
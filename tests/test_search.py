@@ -0,0 +1,83 @@
+"""
+Product search: ranking, accent folding, prefixes and the search endpoint
+"""
+import random
+import asyncio
+
+import search_index
+from search_index import SearchIndex
+from conftest import api_client
+
+PRODUCTS = [
+    {"id": "01", "name": "Bujía NGK Iridium", "category": "encendido", "description": "Para motores a gasolina"},
+    {"id": "02", "name": "Cable de bujías", "category": "encendido", "description": "Juego de 4 cables"},
+    {"id": "03", "name": "Filtro de aceite", "category": "filtros", "description": "Compatible con Toyota Corolla"},
+    {"id": "04", "name": "Aceite 20W50", "category": "lubricantes", "description": "Ideal tras cambiar el filtro"},
+    {"id": "05", "name": "Pastillas de freno", "category": "frenos", "description": "Delanteras Toyota Hilux"},
+]
+
+
+def names(products):
+    return [product["name"] for product in products]
+
+
+def test_name_matches_rank_above_description_matches():
+    found, total = SearchIndex(PRODUCTS).search("filtro ")
+    assert total == 2 and names(found) == ["Filtro de aceite", "Aceite 20W50"]
+
+
+def test_accents_and_plurals_are_folded():
+    found, total = SearchIndex(PRODUCTS).search("bujias ")
+    assert total == 2 and set(names(found)) == {"Bujía NGK Iridium", "Cable de bujías"}
+    assert SearchIndex(PRODUCTS).search("BUJÍA ")[1] == 2
+
+
+def test_last_word_matches_as_a_prefix_while_typing():
+    index = SearchIndex(PRODUCTS)
+    assert names(index.search("toyota cor")[0]) == ["Filtro de aceite"]
+    # A finished word (trailing space) must match whole
+    assert index.search("toyota cor ")[1] == 0
+
+
+def test_every_word_must_match():
+    index = SearchIndex(PRODUCTS)
+    assert names(index.search("toyota freno")[0]) == ["Pastillas de freno"]
+    assert index.search("toyota iridium")[1] == 0
+
+
+def test_add_replaces_and_remove_forgets():
+    index = SearchIndex(PRODUCTS)
+    index.add({**PRODUCTS[4], "name": "Discos de freno"})
+    assert names(index.search("disco")[0]) == ["Discos de freno"]
+    assert index.search("pastillas")[1] == 0
+    index.remove("03")
+    assert names(index.search("filtro ")[0]) == ["Aceite 20W50"]
+
+
+def test_bitmap_matching_ranks_like_direct_scoring(monkeypatch):
+    rnd = random.Random(5)
+    words = ["filtro", "aceite", "freno", "bujia", "toyota", "chevrolet", "motor", "correa"]
+    products = [{"id": f"{i:04d}", "name": " ".join(rnd.sample(words, 3)), "description": rnd.choice(words)}
+                for i in range(300)]
+    expected = SearchIndex(products).search("filtro toyota mot", 15)
+    monkeypatch.setattr(search_index, 'SEARCH_SCAN_LIMIT', 10)
+    found = SearchIndex(products).search("filtro toyota mot", 15)
+    assert found[1] == expected[1]
+    assert [product["id"] for product in found[0]] == [product["id"] for product in expected[0]]
+
+
+def test_created_products_are_searchable_and_stored_intact(server):
+    product = {"name": "Amortiguador trasero", "description": "Par para Hyundai Getz", "price": 40.0,
+               "category": "suspension", "inventory": 3}
+
+    async def run():
+        async with api_client(server) as client:
+            created = (await client.post('/api/products', json=product)).json()['product']
+            found = (await client.get('/api/products/search', params={"q": "amortig"})).json()
+        stored = await server.db.find_one('products', {"id": created['id']})
+        return created, found, stored
+    created, found, stored = asyncio.run(run())
+    assert '_id' not in created
+    assert found['total'] == 1 and found['products'][0]['id'] == created['id']
+    # The response copy is trimmed, not the stored document
+    assert stored['_id'] == created['id']